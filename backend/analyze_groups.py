@@ -1,9 +1,12 @@
 import os
 import glob
-from fingerprint import engine
+import time
+import argparse
+from fingerprint import engine, export_similarity_matrix
+from feature_cache import extract_features_cached
 from difflib import SequenceMatcher
 
-def analyze_group(group_name, dir_path):
+def analyze_group(group_name, dir_path, export_dir=None, export_format="csv", symmetric=False, workers=None):
     print(f"\n{'='*20} Analyzing Group: {group_name} {'='*20}")
     
     files = sorted(glob.glob(os.path.join(dir_path, "*.pdf")) + glob.glob(os.path.join(dir_path, "*.PDF")))
@@ -15,7 +18,7 @@ def analyze_group(group_name, dir_path):
     for f in files:
         fname = os.path.basename(f)
         try:
-            feats = engine.extract_features(f)
+            feats, _ = extract_features_cached(f, engine)
             # Use internal helper to get signature for debugging display
             sig = engine._get_layout_signature(feats['layout_boxes'])
             features_list.append({
@@ -35,6 +38,16 @@ def analyze_group(group_name, dir_path):
     for item in features_list:
         print(f"{item['name'][:30]:<30} | {item['box_count']:<5} | {item['aspect_ratio']:<6.3f} | {item['signature']}")
 
+    # 一次性计算整组得分矩阵 (签名只预处理一次，大组多进程；--upper 时只算上三角)
+    start = time.perf_counter()
+    matrix = engine.similarity_matrix([item['features'] for item in features_list], symmetric=symmetric, workers=workers)
+    print(f"\nSimilarity matrix computed in {time.perf_counter() - start:.2f}s")
+    if export_dir:
+        os.makedirs(export_dir, exist_ok=True)
+        out_path = os.path.join(export_dir, f"{group_name}.{export_format}")
+        export_similarity_matrix(matrix, [item['name'] for item in features_list], out_path)
+        print(f"Matrix exported to {out_path}")
+
     # Print Matrix
     print("\nSimilarity Matrix:")
     # Header
@@ -51,10 +64,7 @@ def analyze_group(group_name, dir_path):
         print(f"{short_name:<20}", end="")
         
         for j, item2 in enumerate(features_list):
-            if i == j:
-                score = 1.0
-            else:
-                score = engine.calculate_score(item1['features'], item2['features'])
+            score = matrix[i, j]
             
             # Highlight low scores
             score_str = f"{score:.4f}"
@@ -69,7 +79,7 @@ def analyze_group(group_name, dir_path):
     base_item = features_list[0] # Compare everyone to the first one as a baseline
     for i in range(1, len(features_list)):
         target_item = features_list[i]
-        score = engine.calculate_score(base_item['features'], target_item['features'])
+        score = matrix[0, i]
         
         if score < 0.8:
             print(f"Comparing {base_item['name']} <-> {target_item['name']} (Score: {score:.4f})")
@@ -96,6 +106,15 @@ def analyze_group(group_name, dir_path):
                     print(f"    {tag}: {sig1[i1:i2]} -> {sig2[j1:j2]}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-group fingerprint similarity analysis")
+    parser.add_argument("dirs", nargs="*", help="group directories (default: built-in sample groups)")
+    parser.add_argument("--export", help="directory to export each group's matrix to")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="export format")
+    parser.add_argument("--upper", action="store_true",
+                        help="score only the upper triangle and mirror it (about 2x faster; scores are not strictly symmetric)")
+    parser.add_argument("--workers", type=int, default=None, help="processes for the matrix (default: CPU count)")
+    args = parser.parse_args()
+
     groups = {
         "Group 2": "/Users/icychick/Projects/industry_PDF/PDF测试汇总/同类型-2 组",
         "Group 3": "/Users/icychick/Projects/industry_PDF/PDF测试汇总/同类型-3 组",
@@ -103,5 +122,9 @@ if __name__ == "__main__":
         "Group 5": "/Users/icychick/Projects/industry_PDF/PDF测试汇总/同类型-5 组",
     }
     
+    if args.dirs:
+        groups = {os.path.basename(os.path.normpath(d)): d for d in args.dirs}
+
     for name, path in groups.items():
-        analyze_group(name, path)
+        analyze_group(name, path, export_dir=args.export, export_format=args.format,
+                      symmetric=args.upper, workers=args.workers)
@@ -1,68 +1,359 @@
+"""
+批量文档分类：按视觉版面指纹把目录中的 PDF 归为若干组。
+
+    python batch_classify.py SOURCE_DIR [--threshold 0.8] [--workers N] [--link hardlink]
+                             [--output DIR] [--recursive] [--resume]
+
+1. 特征提取：进程池并行 (每个 worker 单会话推理)，按文件 MD5 复用持久化特征缓存
+   (feature_cache)。每个文件的结果追加写入 <output>/.classify_state.jsonl，
+   中断后 --resume 跳过 (路径, 大小, mtime) 未变的文件。
+2. 聚类：与原实现相同的 leader 贪心规则 (按文件顺序，归入得分 > threshold 的最佳分组，
+   否则新建分组)。每个文件与全部 leader 的得分先经宽高比门限和向量化上界
+   (fingerprint_index.score_upper_bounds) 预筛选，只对可能超过阈值的 leader 精确打分，
+   结果与逐个比较一致。内容完全相同 (MD5 相同) 的文件直接归入同一组。
+3. 输出：<output>/NN/ 下创建硬链接 (跨设备时回退为符号链接)，或 --link manifest
+   仅写 manifest.json，--link copy 保持旧的复制行为。重新运行时只删除上次 manifest.json
+   中列出的分组目录；非空且不含 manifest.json / 续跑状态文件的 --output 目录会被拒绝。
+"""
+
+import argparse
+import json
+import multiprocessing
 import os
 import shutil
-import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import numpy as np
+
 from fingerprint import engine
+from fingerprint_index import AR_GATE, SIGNATURE_LETTERS, score_upper_bounds, signature_counts
 
-def batch_classify_pdfs(source_dir, threshold=0.8):
-    # 1. 获取所有 PDF 文件
-    files = [f for f in os.listdir(source_dir) if f.lower().endswith('.pdf')]
-    if not files:
-        print("未发现 PDF 文件。")
-        return
+STATE_FILENAME = ".classify_state.jsonl"
+MANIFEST_FILENAME = "manifest.json"
+LINK_MODES = ("hardlink", "symlink", "manifest", "copy")
+
+
+# ========== 特征提取 (worker 进程) ==========
+
+def _init_worker(threads: int):
+    # 每个 worker 只用进程内单会话推理，线程数按 worker 数均分，避免超订
+    os.environ["INFERENCE_WORKERS"] = "0"
+    os.environ["LAYOUT_POOL_SIZE"] = "1"
+    os.environ["LAYOUT_POOL_INTRA_THREADS"] = str(threads)
+
+
+def _extract(path: str) -> Dict:
+    from feature_cache import extract_features_cached
+    start = time.perf_counter()
+    try:
+        features, cached = extract_features_cached(path, engine)
+        return {"features": features, "md5": features.get("md5") or engine.get_md5(path),
+                "cached": cached, "seconds": time.perf_counter() - start}
+    except Exception as e:
+        return {"error": str(e), "seconds": time.perf_counter() - start}
+
+
+def list_pdfs(source_dir: str, recursive: bool = False, exclude: Optional[str] = None) -> List[str]:
+    """相对路径列表 (排序后即聚类顺序)"""
+    files = []
+    if recursive:
+        exclude = os.path.abspath(exclude) if exclude else None
+        for root, dirs, names in os.walk(source_dir):
+            if exclude:
+                dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude]
+            files.extend(os.path.relpath(os.path.join(root, n), source_dir) for n in names if n.lower().endswith('.pdf'))
+    else:
+        files = [f for f in os.listdir(source_dir) if f.lower().endswith('.pdf')]
+    return sorted(files)
+
+
+def _file_key(path: str):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def load_state(state_path: str) -> Dict[str, Dict]:
+    state = {}
+    if not os.path.exists(state_path):
+        return state
+    with open(state_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                state[record["path"]] = record
+            except (ValueError, KeyError):
+                continue  # 中断时写了一半的行
+    return state
+
+
+def extract_all(source_dir: str, files: List[str], state_path: str, workers: int,
+                resume: bool, progress_every: float = 5.0) -> Dict[str, Dict]:
+    state = load_state(state_path) if resume else {}
+    if not resume and os.path.exists(state_path):
+        os.remove(state_path)
+
+    pending = []
+    for rel in files:
+        record = state.get(rel)
+        size, mtime = _file_key(os.path.join(source_dir, rel))
+        if record and record.get("size") == size and record.get("mtime") == mtime and "features" in record:
+            continue
+        pending.append((rel, size, mtime))
+
+    done = len(files) - len(pending)
+    if done:
+        print(f"续跑：跳过 {done} 个已处理文件")
+    if not pending:
+        return state
+
+    cpus = multiprocessing.cpu_count()
+    threads = max(1, cpus // max(1, workers))
+    print(f"开始提取 {len(pending)} 个文件的特征 ({workers} 进程 x {threads} 线程)...")
+
+    stats = {"cached": 0, "errors": 0}
+    start = last_report = time.perf_counter()
+    with open(state_path, "a", encoding="utf-8") as state_file, ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(threads,),
+    ) as executor:
+        futures = {
+            executor.submit(_extract, os.path.join(source_dir, rel)): (rel, size, mtime)
+            for rel, size, mtime in pending
+        }
+        for n, future in enumerate(as_completed(futures), 1):
+            rel, size, mtime = futures[future]
+            result = future.result()
+            record = {"path": rel, "size": size, "mtime": mtime, **result}
+            if "error" in result:
+                stats["errors"] += 1
+                print(f"处理文件 {rel} 出错: {result['error']}")
+            elif result.get("cached"):
+                stats["cached"] += 1
+            state[rel] = record
+            state_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            state_file.flush()
+
+            now = time.perf_counter()
+            if now - last_report >= progress_every or n == len(pending):
+                last_report = now
+                rate = n / max(now - start, 1e-9)
+                eta = (len(pending) - n) / rate if rate > 0 else 0
+                print(f"  [{n}/{len(pending)}] {rate:.2f} 文件/秒, 缓存命中 {stats['cached']}, "
+                      f"错误 {stats['errors']}, 预计剩余 {eta:.0f}s")
+
+    elapsed = time.perf_counter() - start
+    print(f"特征提取完成：{len(pending)} 个文件, 用时 {elapsed:.1f}s ({len(pending) / max(elapsed, 1e-9):.2f} 文件/秒)")
+    return state
+
+
+# ========== 聚类 ==========
+
+class LeaderSet:
+    """分组 leader 的向量化视图 (宽高比 / 签名字母计数 / 签名长度)，按需扩容"""
+
+    def __init__(self, capacity: int = 64):
+        self.prepared = []
+        self._ar = np.zeros(capacity)
+        self._counts = np.zeros((capacity, len(SIGNATURE_LETTERS)), dtype=np.int32)
+        self._sig_len = np.zeros(capacity, dtype=np.int32)
 
-    # 2. 存储分组信息
-    # groups = [ { "leader_features": feat, "files": [path1, path2...] }, ... ]
+    def __len__(self):
+        return len(self.prepared)
+
+    def add(self, prepared):
+        n = len(self.prepared)
+        if n == len(self._ar):
+            self._ar = np.resize(self._ar, 2 * n)
+            self._counts = np.resize(self._counts, (2 * n, len(SIGNATURE_LETTERS)))
+            self._sig_len = np.resize(self._sig_len, 2 * n)
+        self._ar[n] = float(prepared.aspect_ratio or 0)
+        self._counts[n] = signature_counts(prepared.signature)
+        self._sig_len[n] = len(prepared.signature)
+        self.prepared.append(prepared)
+
+    def candidates(self, target, threshold: float) -> np.ndarray:
+        """可能得分 > threshold 的 leader 下标 (升序)"""
+        n = len(self.prepared)
+        if n == 0 or not target.has_boxes:
+            return np.empty((0,), dtype=np.int64)
+        ok = np.abs(float(target.aspect_ratio or 0) - self._ar[:n]) <= AR_GATE
+        bounds = score_upper_bounds(target.signature, self._counts[:n], self._sig_len[:n])
+        ok &= bounds + 1e-9 > threshold
+        return np.nonzero(ok)[0]
+
+
+def cluster(files: List[str], state: Dict[str, Dict], threshold: float):
+    """返回 (groups, errors)；groups[i] = {"leader", "files": [{"path", "score", "md5", "duplicate_of"?}]}"""
     groups = []
-    
-    print(f"开始处理 {len(files)} 个文件...")
+    leaders = LeaderSet()
+    by_md5 = {}
+    errors = []
+    exact_scores = 0
+
+    for rel in files:
+        record = state.get(rel)
+        if record is None or "features" not in record:
+            errors.append({"path": rel, "error": (record or {}).get("error", "not processed")})
+            continue
+
+        md5 = record.get("md5")
+        if md5 and md5 in by_md5:
+            group_idx, first = by_md5[md5]
+            groups[group_idx]["files"].append({"path": rel, "score": 1.0, "md5": md5, "duplicate_of": first})
+            continue
+
+        target = engine.prepare(record["features"])
+        matched_group_idx = -1
+        best_score = 0
+        for idx in leaders.candidates(target, threshold):
+            score = engine.score_cascaded(target, leaders.prepared[idx], max(threshold, best_score))
+            exact_scores += 1
+            if score is not None and score > threshold and score > best_score:
+                best_score = score
+                matched_group_idx = int(idx)
+
+        if matched_group_idx != -1:
+            groups[matched_group_idx]["files"].append({"path": rel, "score": round(best_score, 4), "md5": md5})
+        else:
+            matched_group_idx = len(groups)
+            groups.append({"leader": rel, "files": [{"path": rel, "score": 1.0, "md5": md5}]})
+            leaders.add(target)
+        if md5:
+            by_md5[md5] = (matched_group_idx, rel)
+
+    print(f"聚类完成：{len(groups)} 个分组, 精确打分 {exact_scores} 次")
+    return groups, errors
 
-    for filename in files:
-        file_path = os.path.join(source_dir, filename)
+
+# ========== 输出 ==========
+
+def _place(src: str, dst: str, mode: str) -> str:
+    """返回实际使用的方式；硬链接失败 (跨设备等) 时回退为符号链接"""
+    if mode == "copy":
+        shutil.copy2(src, dst)
+        return mode
+    if mode == "hardlink":
         try:
-            print(f"分析文件: {filename}")
-            features = engine.extract_features(file_path)
-            
-            # 与已有分组的 leader 进行对比
-            matched_group_idx = -1
-            best_score = 0
-            
-            for idx, group in enumerate(groups):
-                score = engine.calculate_score(features, group["leader_features"])
-                if score > threshold and score > best_score:
-                    best_score = score
-                    matched_group_idx = idx
-            
-            if matched_group_idx != -1:
-                groups[matched_group_idx]["files"].append(file_path)
-                print(f"  -> 归入分组 {matched_group_idx + 1:02d} (得分: {best_score:.4f})")
-            else:
-                groups.append({
-                    "leader_features": features,
-                    "files": [file_path]
-                })
-                print(f"  -> 创建新分组 {len(groups):02d}")
-                
-        except Exception as e:
-            print(f"处理文件 {filename} 出错: {e}")
-
-    # 3. 创建文件夹并移动文件
-    output_base = os.path.join(source_dir, "Classified_Results")
-    if os.path.exists(output_base):
-        shutil.rmtree(output_base)
-    os.makedirs(output_base)
-
-    print("\n--- 分类完成，正在移动文件 ---")
+            os.link(src, dst)
+            return mode
+        except OSError:
+            mode = "symlink"
+    os.symlink(os.path.abspath(src), dst)
+    return mode
+
+
+def previous_group_ids(output_base: str) -> List[str]:
+    """上次运行写入的分组目录名 (来自 manifest.json)；没有或无法解析时返回空列表"""
+    try:
+        with open(os.path.join(output_base, MANIFEST_FILENAME), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return []
+    ids = [str(g.get("id", "")) for g in manifest.get("groups", []) if isinstance(g, dict)]
+    # 只接受本工具生成的编号，防止 manifest 被改写后指向 output 之外的路径
+    return [i for i in ids if i.isdigit()]
+
+
+def is_foreign_output(output_base: str) -> bool:
+    """非空且既无 manifest.json 也无续跑状态文件的目录不是本工具的输出目录"""
+    if not os.path.isdir(output_base) or not os.listdir(output_base):
+        return False
+    return not any(os.path.exists(os.path.join(output_base, name)) for name in (MANIFEST_FILENAME, STATE_FILENAME))
+
+
+def write_results(source_dir: str, output_base: str, groups: List[Dict], errors: List[Dict],
+                  link: str, threshold: float, stats: Dict):
+    os.makedirs(output_base, exist_ok=True)
+    # 清理上次的分组目录：只删除上次 manifest.json 中列出的分组 (保留续跑状态文件与其他目录)
+    for group_id in previous_group_ids(output_base):
+        path = os.path.join(output_base, group_id)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+
+    fallback = False
     for idx, group in enumerate(groups):
-        folder_name = f"{idx + 1:02d}"
-        target_dir = os.path.join(output_base, folder_name)
+        group["id"] = f"{idx + 1:02d}"
+        if link == "manifest":
+            continue
+        target_dir = os.path.join(output_base, group["id"])
         os.makedirs(target_dir, exist_ok=True)
-        
-        for file_path in group["files"]:
-            shutil.copy(file_path, target_dir)
-            
+        for item in group["files"]:
+            name = item["path"].replace(os.sep, "__")
+            used = _place(os.path.join(source_dir, item["path"]), os.path.join(target_dir, name), link)
+            fallback = fallback or used != link
+    if fallback:
+        print("部分文件无法创建硬链接 (跨设备)，已改用符号链接")
+
+    manifest = {
+        "source_dir": os.path.abspath(source_dir),
+        "threshold": threshold,
+        "link": link,
+        "stats": stats,
+        "groups": groups,
+        "errors": errors,
+    }
+    with open(os.path.join(output_base, MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+
+def batch_classify_pdfs(source_dir, threshold=0.8, output=None, workers=None, link="hardlink",
+                        recursive=False, resume=False):
+    output_base = output or os.path.join(source_dir, "Classified_Results")
+    if is_foreign_output(output_base):
+        print(f"输出目录 {output_base} 非空且不是之前的分类结果 (缺少 {MANIFEST_FILENAME})，请指定空目录。")
+        return
+    files = list_pdfs(source_dir, recursive, exclude=output_base)
+    if not files:
+        print("未发现 PDF 文件。")
+        return
+
+    os.makedirs(output_base, exist_ok=True)
+    workers = workers or max(1, multiprocessing.cpu_count() // 2)
+    start = time.perf_counter()
+    state = extract_all(source_dir, files, os.path.join(output_base, STATE_FILENAME), workers, resume)
+    extract_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups, errors = cluster(files, state, threshold)
+    cluster_seconds = time.perf_counter() - start
+
+    stats = {
+        "files": len(files),
+        "groups": len(groups),
+        "errors": len(errors),
+        "extract_seconds": round(extract_seconds, 2),
+        "cluster_seconds": round(cluster_seconds, 2),
+        "files_per_second": round(len(files) / max(extract_seconds + cluster_seconds, 1e-9), 2),
+    }
+    write_results(source_dir, output_base, groups, errors, link, threshold, stats)
+
     print(f"结果已保存至: {output_base}")
     print(f"共发现 {len(groups)} 个不同类型的文档。")
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按版面指纹批量分类 PDF")
+    parser.add_argument("source_dir", help="待分类的 PDF 目录")
+    parser.add_argument("--threshold", type=float, default=0.8, help="归入分组的最低得分")
+    parser.add_argument("--output", help="输出目录 (默认 SOURCE_DIR/Classified_Results)")
+    parser.add_argument("--workers", type=int, default=None, help="特征提取进程数 (默认 CPU 核数的一半)")
+    parser.add_argument("--link", choices=LINK_MODES, default="hardlink", help="分组目录中的文件形式")
+    parser.add_argument("--recursive", action="store_true", help="递归扫描子目录")
+    parser.add_argument("--resume", action="store_true", help="跳过上次已处理且未修改的文件")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source_dir):
+        print(f"目录不存在: {args.source_dir}")
+        sys.exit(1)
+    batch_classify_pdfs(args.source_dir, threshold=args.threshold, output=args.output, workers=args.workers,
+                        link=args.link, recursive=args.recursive, resume=args.resume)
+
 
 if __name__ == "__main__":
-    source = "/Users/icychick/Projects/industry_PDF/PDF测试汇总"
-    batch_classify_pdfs(source)
+    main()
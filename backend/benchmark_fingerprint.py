@@ -0,0 +1,501 @@
+"""
+Fingerprint matching benchmark: latency per stage and match quality per threshold.
+
+The thresholds in use (0.7 in /analyze and TaskWorker, 0.8 in batch_classify,
+FINGERPRINT_TEXT_THRESHOLD for the text tier) were picked by hand. This
+harness measures them on a labelled folder of PDFs:
+
+    DATASET_DIR/<label>/**/*.pdf     one sub-directory per layout (label)
+
+or several label directories on the command line (like analyze_groups.py).
+
+1. Features: every document goes through the same steps as
+   FingerprintEngine.extract_features, timed separately: hash, text layer,
+   render, inference (page 1), inference of pages 2..N (one batch), dedup
+   (class mapping + merge_overlapping_regions + sort). The layout cache is
+   bypassed unless --layout-cache is given.
+2. Scoring: every ordered pair (i, j), i != j, is scored with each scorer variant:
+       visual        calculate_score on page 1 (score_prepared)
+       visual_pages  best score over all page pairs (multi-page fingerprints)
+       text          text-layer score (0 when either page has no text layer)
+       tiered        text score if both have a text layer and it reaches the
+                     text threshold, else visual; for matching, the best text
+                     match is taken when it reaches the text threshold, else the
+                     best visual match (what find_best_match does)
+   Same label = positive pair. Reported per threshold: precision, recall,
+   FPR, F1 (pairs), plus exact ROC AUC.
+3. Matching: leave-one-out, each document against all others (best score,
+   ties to the earlier document). Per threshold: match precision (best match
+   has the same label) and recall (over documents with another document of
+   their label). The index query latency (FingerprintIndex.match_page /
+   match_text with the query removed from the library) is timed per document.
+
+Results are written as JSON (--output). With --baseline, AUC and the match
+precision / recall at the operating thresholds are compared to an earlier run;
+a drop larger than --tolerance (or, with --latency-tolerance, a relative
+increase of a stage's mean latency) exits with status 1, so CI can gate on it.
+
+Usage:
+    python benchmark_fingerprint.py DATASET_DIR [--output results.json] [--baseline previous.json]
+                                    [--variants visual,visual_pages,text,tiered] [--thresholds 0.5:0.95:0.05]
+                                    [--max-pages 3] [--tolerance 0.02] [--latency-tolerance 0.5]
+"""
+
+import argparse
+import contextlib
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pdfplumber
+
+from fingerprint import engine, fingerprint_max_pages
+from fingerprint_index import FingerprintIndex
+from inference_service import predict_layout, predict_layout_batch
+from text_fingerprint import PreparedText, extract_text_features, text_similarity, text_threshold
+from utils import file_md5, render_pdf_pages_for_model
+
+VARIANTS = ["visual", "visual_pages", "text", "tiered"]
+STAGES = ["hash", "text_layer", "render", "inference", "inference_extra_pages", "dedup"]
+OPERATING_POINTS = {
+    "analyze_document": 0.7,
+    "batch_classify": 0.8,
+}
+
+
+# ========== 数据集 ==========
+
+def _pdfs(folder: str) -> List[str]:
+    files = glob.glob(os.path.join(folder, "**", "*.pdf"), recursive=True)
+    files += glob.glob(os.path.join(folder, "**", "*.PDF"), recursive=True)
+    return sorted(set(files))
+
+
+def load_dataset(dirs: List[str]) -> List[Tuple[str, str]]:
+    """-> [(label, path)]；含子目录的目录按子目录分组，否则目录本身为一组"""
+    items = []
+    for d in dirs:
+        subdirs = sorted(e.path for e in os.scandir(d) if e.is_dir())
+        groups = [(os.path.basename(s), s) for s in subdirs] or [(os.path.basename(os.path.normpath(d)), d)]
+        for label, folder in groups:
+            items += [(label, path) for path in _pdfs(folder)]
+    return items
+
+
+# ========== 特征提取 (分阶段计时) ==========
+
+@contextlib.contextmanager
+def _quiet(enabled: bool = True):
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def profile_document(path: str, max_pages: int, use_cache: bool) -> Tuple[Dict, Dict[str, float]]:
+    """与 FingerprintEngine.extract_features(max_pages) 相同的特征，附各阶段耗时 (秒)"""
+    timings = {}
+
+    start = time.perf_counter()
+    md5 = file_md5(path)
+    timings["hash"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text = extract_text_features(path)
+    timings["text_layer"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with pdfplumber.open(path) as pdf:
+        page_count = len(pdf.pages)
+        ratios = [round(float(p.width) / float(p.height), 3) for p in pdf.pages[:max(1, max_pages)]]
+    rasters = render_pdf_pages_for_model(path, range(len(ratios)), imgsz=1024)
+    timings["render"] = time.perf_counter() - start
+
+    regions_list = []
+    start = time.perf_counter()
+    if rasters:
+        regions_list.append(predict_layout(rasters[0], conf=0.1, imgsz=1024, fast_mode=True, use_cache=use_cache))
+    timings["inference"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if len(rasters) > 1:
+        regions_list += predict_layout_batch(rasters[1:], conf=0.1, imgsz=1024, fast_mode=True, use_cache=use_cache)
+    timings["inference_extra_pages"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    layouts = [engine._layout_from_regions(regions) for regions in regions_list]
+    timings["dedup"] = time.perf_counter() - start
+
+    features = {
+        "version": "v2_visual",
+        "md5": md5,
+        "aspect_ratio": ratios[0] if ratios else 0.0,
+        "layout_boxes": layouts[0] if layouts else [],
+        "text_layer": text["text_layer"] if text else None,
+    }
+    if max_pages > 1:
+        features["page_count"] = page_count
+        features["extra_pages"] = [
+            {"aspect_ratio": ratio, "layout_boxes": boxes} for ratio, boxes in zip(ratios[1:], layouts[1:])
+        ]
+    return features, timings
+
+
+def latency_summary(samples: List[float]) -> Dict:
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    if not len(values):
+        return {"count": 0}
+    return {
+        "count": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "total_s": round(float(values.sum()) / 1000, 3),
+    }
+
+
+# ========== 打分 ==========
+
+def score_matrices(features: List[Dict], variants: List[str]) -> Tuple[Dict[str, np.ndarray], Dict[str, float]]:
+    """-> ({variant: N×N 得分矩阵 (行 = target)}, {variant: 打分耗时 (秒)})"""
+    n = len(features)
+    prepared = [engine.prepare(f) for f in features]
+    pages = [engine.prepare_pages(f) for f in features]
+    texts = [PreparedText.from_features(f) for f in features]
+    t_threshold = text_threshold()
+
+    def visual(i, j):
+        return engine.score_prepared(prepared[i], prepared[j])
+
+    def visual_pages(i, j):
+        return max(engine.score_prepared(a, b) for a in pages[i] for b in pages[j])
+
+    def text(i, j):
+        if texts[i] is None or texts[j] is None:
+            return 0.0
+        return text_similarity(texts[i], texts[j])
+
+    def tiered(i, j):
+        score = text(i, j)
+        return score if score >= t_threshold else visual(i, j)
+
+    scorers = {"visual": visual, "visual_pages": visual_pages, "text": text, "tiered": tiered}
+    matrices, seconds = {}, {}
+    for name in variants:
+        scorer = scorers[name]
+        matrix = np.eye(n, dtype=np.float64)
+        start = time.perf_counter()
+        with _quiet():
+            for i in range(n):
+                for j in range(n):
+                    if i != j:
+                        matrix[i, j] = scorer(i, j)
+        seconds[name] = time.perf_counter() - start
+        matrices[name] = matrix
+    return matrices, seconds
+
+
+# ========== 指标 ==========
+
+def roc_auc(scores: np.ndarray, positive: np.ndarray) -> Optional[float]:
+    """Mann-Whitney 形式的精确 AUC (同分取平均秩)"""
+    n_pos = int(positive.sum())
+    n_neg = int(len(positive) - n_pos)
+    if n_pos == 0 or n_neg == 0:
+        return None
+    order = np.argsort(scores, kind="mergesort")
+    _, first, counts = np.unique(scores[order], return_index=True, return_counts=True)
+    ranks = np.empty(len(scores), dtype=np.float64)
+    ranks[order] = np.repeat(first + (counts + 1) / 2.0, counts)
+    return float((ranks[positive].sum() - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_neg))
+
+
+def _ratio(num, den) -> Optional[float]:
+    return round(float(num) / float(den), 4) if den else None
+
+
+def pair_metrics(scores: np.ndarray, positive: np.ndarray, threshold: float) -> Dict:
+    predicted = scores >= threshold
+    tp = int((predicted & positive).sum())
+    fp = int((predicted & ~positive).sum())
+    fn = int((~predicted & positive).sum())
+    tn = int((~predicted & ~positive).sum())
+    precision = _ratio(tp, tp + fp)
+    recall = _ratio(tp, tp + fn)
+    f1 = round(2 * precision * recall / (precision + recall), 4) if precision and recall else 0.0
+    return {"threshold": round(threshold, 4), "tp": tp, "fp": fp, "fn": fn, "tn": tn,
+            "precision": precision, "recall": recall, "fpr": _ratio(fp, fp + tn), "f1": f1}
+
+
+def best_matches(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """留一法：每个文档与其余文档比对，-> (最佳文档下标, 最高分)，同分取靠前者"""
+    masked = matrix.copy()
+    np.fill_diagonal(masked, -np.inf)
+    best = np.argmax(masked, axis=1)
+    return best, masked[np.arange(len(matrix)), best]
+
+
+def tiered_best_matches(text: np.ndarray, visual: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """与 find_best_match 一致：文本层最佳匹配达到文本阈值即采用，否则取视觉最佳匹配"""
+    text_best, text_score = best_matches(text)
+    visual_best, visual_score = best_matches(visual)
+    use_text = text_score >= text_threshold()
+    return np.where(use_text, text_best, visual_best), np.where(use_text, text_score, visual_score)
+
+
+def match_metrics(best: np.ndarray, best_score: np.ndarray, labels: List[str], threshold: float) -> Dict:
+    n = len(labels)
+    labels_arr = np.asarray(labels)
+    has_positive = np.array([(labels_arr == labels_arr[i]).sum() > 1 for i in range(n)])
+    predicted = best_score >= threshold
+    correct = predicted & (labels_arr[best] == labels_arr)
+    return {
+        "threshold": round(threshold, 4),
+        "matched": int(predicted.sum()),
+        "correct": int(correct.sum()),
+        "wrong": int((predicted & ~correct).sum()),
+        "precision": _ratio(correct.sum(), predicted.sum()),
+        "recall": _ratio(correct.sum(), has_positive.sum()),
+    }
+
+
+def evaluate_variant(matrix: np.ndarray, best: Tuple[np.ndarray, np.ndarray], labels: List[str],
+                     thresholds: List[float], operating_points: Dict[str, float]) -> Dict:
+    n = len(labels)
+    off_diag = ~np.eye(n, dtype=bool)
+    labels_arr = np.asarray(labels)
+    positive = (labels_arr[:, None] == labels_arr[None, :])[off_diag]
+    scores = matrix[off_diag]
+    pairs = [pair_metrics(scores, positive, t) for t in thresholds]
+    best_pair = max(pairs, key=lambda row: (row["f1"], row["threshold"])) if pairs else None
+    auc = roc_auc(scores, positive)
+    return {
+        "auc": round(auc, 4) if auc is not None else None,
+        "best_f1": best_pair,
+        "pairs": pairs,
+        "match": [match_metrics(*best, labels, t) for t in thresholds],
+        "operating_points": {
+            name: {"pairs": pair_metrics(scores, positive, t), "match": match_metrics(*best, labels, t)}
+            for name, t in operating_points.items()
+        },
+    }
+
+
+# ========== 索引查询延迟 ==========
+
+def time_index_queries(items: List[Tuple[str, str]], features: List[Dict]) -> Dict[str, List[float]]:
+    """留一法计时 FingerprintIndex.match_page / match_text (不含索引重建)"""
+    candidates = [
+        {"id": str(i), "fingerprint": f["md5"], "fingerprint_text": json.dumps(f)}
+        for i, f in enumerate(features)
+    ]
+    index = FingerprintIndex(engine)
+    index.build(candidates)
+    samples = {"match_visual": [], "match_text": []}
+    with _quiet():
+        for i, f in enumerate(features):
+            index.remove(str(i))
+            index.text_count()  # 在计时前重建向量化视图
+            start = time.perf_counter()
+            index.match_page(f)
+            samples["match_visual"].append(time.perf_counter() - start)
+            if f.get("text_layer"):
+                start = time.perf_counter()
+                index.match_text({"aspect_ratio": f["aspect_ratio"], "text_layer": f["text_layer"]},
+                                 threshold=text_threshold())
+                samples["match_text"].append(time.perf_counter() - start)
+            index.upsert(candidates[i])
+    return samples
+
+
+# ========== 回归比较 ==========
+
+def compare_to_baseline(report: Dict, baseline: Dict, tolerance: float,
+                        latency_tolerance: Optional[float]) -> List[str]:
+    regressions = []
+    for name, current in report["variants"].items():
+        previous = baseline.get("variants", {}).get(name)
+        if not previous:
+            continue
+        if previous.get("auc") is not None and current.get("auc") is not None \
+                and current["auc"] < previous["auc"] - tolerance:
+            regressions.append(f"{name}: AUC {previous['auc']} -> {current['auc']}")
+        for point, values in current["operating_points"].items():
+            before = previous.get("operating_points", {}).get(point, {}).get("match", {})
+            for metric in ("precision", "recall"):
+                old, new = before.get(metric), values["match"].get(metric)
+                if old is not None and new is not None and new < old - tolerance:
+                    regressions.append(f"{name} @ {point}: match {metric} {old} -> {new}")
+    if latency_tolerance is not None:
+        for stage, current in report["latency"].items():
+            previous = baseline.get("latency", {}).get(stage, {})
+            old, new = previous.get("mean_ms"), current.get("mean_ms")
+            if old and new is not None and new > old * (1 + latency_tolerance):
+                regressions.append(f"latency {stage}: {old} ms -> {new} ms")
+    return regressions
+
+
+# ========== 入口 ==========
+
+def parse_thresholds(spec: str) -> List[float]:
+    """'0.5:0.95:0.05' (起:止:步长，含终点) 或 '0.6,0.7,0.8'"""
+    if ":" in spec:
+        lo, hi, step = (float(v) for v in spec.split(":"))
+        return [round(v, 4) for v in np.arange(lo, hi + step / 2, step)]
+    return [float(v) for v in spec.split(",") if v.strip()]
+
+
+def run(args) -> Tuple[Dict, int]:
+    missing = [d for d in args.dirs if not os.path.isdir(d)]
+    if missing:
+        print(f"Not a directory: {', '.join(missing)}")
+        return {}, 2
+    items = load_dataset(args.dirs)
+    labels = [label for label, _ in items]
+    if len(items) < 2:
+        print("Need at least two labelled PDFs")
+        return {}, 2
+    variants = [v.strip() for v in args.variants.split(",") if v.strip()]
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        print(f"Unknown scorer variant(s): {', '.join(sorted(unknown))}")
+        return {}, 2
+    thresholds = parse_thresholds(args.thresholds)
+    max_pages = args.max_pages or fingerprint_max_pages()
+    operating_points = dict(OPERATING_POINTS, text_tier=text_threshold())
+
+    print(f"Dataset: {len(items)} documents, {len(set(labels))} labels")
+    features, stage_samples = [], {stage: [] for stage in STAGES}
+    start = time.perf_counter()
+    for k, (label, path) in enumerate(items, 1):
+        with _quiet(not args.verbose):
+            f, timings = profile_document(path, max_pages, args.layout_cache)
+        features.append(f)
+        for stage, seconds in timings.items():
+            stage_samples[stage].append(seconds)
+        print(f"  [{k}/{len(items)}] {label}/{os.path.basename(path)}  "
+              f"{sum(timings.values()) * 1000:.0f} ms  boxes={len(f['layout_boxes'])}  "
+              f"text={'yes' if f['text_layer'] else 'no'}")
+    extract_seconds = time.perf_counter() - start
+
+    matrices, score_seconds = score_matrices(features, variants)
+    best = {name: best_matches(matrix) for name, matrix in matrices.items()}
+    if "tiered" in matrices:
+        text = matrices["text"] if "text" in matrices else score_matrices(features, ["text"])[0]["text"]
+        visual = matrices["visual"] if "visual" in matrices else score_matrices(features, ["visual"])[0]["visual"]
+        best["tiered"] = tiered_best_matches(text, visual)
+    stage_samples.update(time_index_queries(items, features))
+    pairs = len(items) * (len(items) - 1)
+
+    from inference import resolve_model_variant
+    report = {
+        "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "model_variant": resolve_model_variant()[0],
+            "max_pages": max_pages,
+            "layout_cache": bool(args.layout_cache),
+            "text_threshold": text_threshold(),
+            "thresholds": thresholds,
+            "operating_points": operating_points,
+            "python": platform.python_version(),
+            "platform": sys.platform,
+            "cpu_count": os.cpu_count(),
+        },
+        "dataset": {
+            "dirs": [os.path.abspath(d) for d in args.dirs],
+            "documents": len(items),
+            "labels": {label: labels.count(label) for label in sorted(set(labels))},
+            "native_text_layer": sum(1 for f in features if f["text_layer"]),
+            "positive_pairs": int(sum(labels.count(l) * (labels.count(l) - 1) for l in set(labels))),
+            "pairs": pairs,
+        },
+        "latency": {stage: latency_summary(samples) for stage, samples in stage_samples.items()},
+        "throughput": {
+            "documents_per_second": round(len(items) / extract_seconds, 3) if extract_seconds > 0 else None,
+            "pairs_per_second": {
+                name: round(pairs / seconds, 1) if seconds > 0 else None for name, seconds in score_seconds.items()
+            },
+        },
+        "variants": {
+            name: evaluate_variant(matrix, best[name], labels, thresholds, operating_points)
+            for name, matrix in matrices.items()
+        },
+    }
+    if args.include_scores:
+        report["documents"] = [{"label": label, "path": path} for label, path in items]
+        report["scores"] = {name: np.round(m, 4).tolist() for name, m in matrices.items()}
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance, args.latency_tolerance)
+        report["baseline"] = {"path": os.path.abspath(args.baseline), "regressions": regressions}
+        status = 1 if regressions else 0
+    return report, status
+
+
+def print_report(report: Dict):
+    print("\n--- Latency per document (ms) ---")
+    for stage, summary in report["latency"].items():
+        if summary.get("count"):
+            print(f"  {stage:<22} mean {summary['mean_ms']:>9.2f}  p50 {summary['p50_ms']:>9.2f}  p95 {summary['p95_ms']:>9.2f}")
+    throughput = report["throughput"]
+    print(f"\nThroughput: {throughput['documents_per_second']} documents/s (feature extraction)")
+    for name, value in throughput["pairs_per_second"].items():
+        print(f"  scoring {name}: {value} pairs/s")
+
+    for name, result in report["variants"].items():
+        best = result["best_f1"]
+        print(f"\n=== {name}: AUC {result['auc']}, best pair F1 {best['f1']} @ {best['threshold']} ===")
+        print(f"  {'thr':>5} | {'pair P':>7} {'pair R':>7} {'FPR':>7} {'F1':>6} | {'match P':>7} {'match R':>7} {'wrong':>5}")
+        for pair, match in zip(result["pairs"], result["match"]):
+            print(f"  {pair['threshold']:>5.2f} | {str(pair['precision']):>7} {str(pair['recall']):>7} "
+                  f"{str(pair['fpr']):>7} {pair['f1']:>6} | {str(match['precision']):>7} "
+                  f"{str(match['recall']):>7} {match['wrong']:>5}")
+        for point, values in result["operating_points"].items():
+            match = values["match"]
+            print(f"  operating point {point} ({match['threshold']}): match P {match['precision']} "
+                  f"R {match['recall']}, wrong matches {match['wrong']}")
+
+    for regression in report.get("baseline", {}).get("regressions", []):
+        print(f"  [REGRESSION] {regression}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fingerprint latency and match quality on labelled PDFs")
+    parser.add_argument("dirs", nargs="+", help="dataset directory (one sub-directory per label) or label directories")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier JSON report; exit 1 when quality (or latency) regresses")
+    parser.add_argument("--variants", default=",".join(VARIANTS), help=f"scorer variants ({','.join(VARIANTS)})")
+    parser.add_argument("--thresholds", default="0.5:0.95:0.05", help="start:stop:step or comma-separated list")
+    parser.add_argument("--max-pages", type=int, default=None, help="pages fingerprinted (default FINGERPRINT_MAX_PAGES)")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="allowed drop of AUC / match precision / recall")
+    parser.add_argument("--latency-tolerance", type=float, default=None,
+                        help="allowed relative increase of mean stage latency (e.g. 0.5 = +50%%); off by default")
+    parser.add_argument("--layout-cache", action="store_true", help="allow layout cache hits (default: always run inference)")
+    parser.add_argument("--include-scores", action="store_true", help="also write the full score matrices")
+    parser.add_argument("--verbose", action="store_true", help="show extraction logs")
+    args = parser.parse_args()
+
+    report, status = run(args)
+    if not report:
+        sys.exit(status)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"\nReport written to {args.output}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Vectorized box utilities shared by layout inference and fingerprinting.
+
+All functions operate on NumPy arrays of boxes in [x1, y1, x2, y2] format
+(any consistent unit: pixels or normalized coordinates).
+"""
+
+import numpy as np
+
+
+def xywh_to_xyxy(boxes: np.ndarray) -> np.ndarray:
+    """[xc, yc, w, h] -> [x1, y1, x2, y2]"""
+    half_w = boxes[:, 2] / 2
+    half_h = boxes[:, 3] / 2
+    return np.stack([
+        boxes[:, 0] - half_w,
+        boxes[:, 1] - half_h,
+        boxes[:, 0] + half_w,
+        boxes[:, 1] + half_h,
+    ], axis=1)
+
+
+def box_area(boxes: np.ndarray) -> np.ndarray:
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def iou_matrix(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """
+    Pairwise IoU between two sets of xyxy boxes.
+    Returns an [len(a), len(b)] matrix.
+    """
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return np.zeros((len(boxes_a), len(boxes_b)), dtype=np.float32)
+
+    lt = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    rb = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+
+    union = box_area(boxes_a)[:, None] + box_area(boxes_b)[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float = 0.45) -> np.ndarray:
+    """
+    Greedy NMS. Returns indices of kept boxes, sorted by descending score.
+    """
+    if len(boxes) == 0:
+        return np.empty((0,), dtype=np.int64)
+
+    order = np.argsort(-scores, kind="stable")
+    areas = box_area(boxes)
+    keep = []
+
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        if order.size == 1:
+            break
+
+        rest = order[1:]
+        xx1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        yy1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        xx2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        yy2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        union = areas[i] + areas[rest] - inter
+        iou = np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.asarray(keep, dtype=np.int64)
+
+
+def batched_nms(boxes: np.ndarray, scores: np.ndarray, class_ids: np.ndarray,
+                iou_threshold: float = 0.45, agnostic: bool = False) -> np.ndarray:
+    """
+    Class-aware NMS using the coordinate offset trick: boxes of different
+    classes are shifted apart so they can never overlap, then a single NMS
+    pass is run over the whole set.
+    """
+    if len(boxes) == 0:
+        return np.empty((0,), dtype=np.int64)
+    if agnostic:
+        return nms(boxes, scores, iou_threshold)
+
+    max_coord = float(boxes.max()) + 1.0
+    offsets = class_ids.astype(boxes.dtype)[:, None] * max_coord
+    return nms(boxes + offsets, scores, iou_threshold)
+
+
+def match_f1(ref_boxes: np.ndarray, ref_classes: np.ndarray,
+             boxes: np.ndarray, classes: np.ndarray, iou_threshold: float = 0.5) -> float:
+    """
+    Agreement between two detections of the same page: greedy one-to-one
+    matching (same class, IoU >= threshold, best IoU first), reported as F1.
+    Two empty sets agree perfectly.
+    """
+    if len(ref_boxes) == 0 and len(boxes) == 0:
+        return 1.0
+    if len(ref_boxes) == 0 or len(boxes) == 0:
+        return 0.0
+
+    iou = iou_matrix(ref_boxes, boxes)
+    # identical boxes agree even when degenerate (zero area -> IoU 0)
+    iou = np.where(np.all(ref_boxes[:, None, :] == boxes[None, :, :], axis=-1), 1.0, iou)
+    iou = np.where(ref_classes[:, None] == classes[None, :], iou, 0.0)
+
+    matched = 0
+    ref_used = np.zeros(len(ref_boxes), dtype=bool)
+    used = np.zeros(len(boxes), dtype=bool)
+    for flat in np.argsort(-iou, axis=None, kind="stable"):
+        i, j = divmod(int(flat), len(boxes))
+        if iou[i, j] < iou_threshold:
+            break
+        if ref_used[i] or used[j]:
+            continue
+        ref_used[i] = used[j] = True
+        matched += 1
+
+    return 2.0 * matched / (len(ref_boxes) + len(boxes))
+
+
+def weighted_boxes_fusion(boxes: np.ndarray, scores: np.ndarray, class_ids: np.ndarray,
+                          iou_threshold: float = 0.55):
+    """
+    Single-model weighted boxes fusion for merging overlapping detections
+    (e.g. the same object seen by neighbouring tiles). Boxes are visited in
+    descending score order and joined to the first same-class cluster whose
+    fused box overlaps by >= iou_threshold; each cluster's box is the
+    score-weighted mean of its members and its score is the member maximum.
+
+    Returns (fused_boxes, fused_scores, fused_class_ids), sorted by score.
+    """
+    if len(boxes) == 0:
+        return boxes.reshape(0, 4), scores[:0], class_ids[:0]
+
+    order = np.argsort(-scores, kind="stable")
+    weighted_sum = np.zeros((len(boxes), 4), dtype=np.float64)
+    weight = np.zeros(len(boxes), dtype=np.float64)
+    fused = np.zeros((len(boxes), 4), dtype=np.float64)
+    fused_scores = np.zeros(len(boxes), dtype=np.float64)
+    fused_cls = np.zeros(len(boxes), dtype=class_ids.dtype)
+    n = 0
+
+    for i in order:
+        box, score, cls = boxes[i], float(scores[i]), class_ids[i]
+        target = -1
+        if n:
+            same = np.flatnonzero(fused_cls[:n] == cls)
+            if same.size:
+                ious = iou_matrix(box[None, :], fused[same])[0]
+                best = int(np.argmax(ious))
+                if ious[best] >= iou_threshold:
+                    target = int(same[best])
+        if target < 0:
+            target = n
+            fused_cls[n] = cls
+            fused_scores[n] = score
+            n += 1
+        weighted_sum[target] += box * score
+        weight[target] += score
+        fused[target] = weighted_sum[target] / max(weight[target], 1e-12)
+
+    return fused[:n].astype(boxes.dtype), fused_scores[:n].astype(scores.dtype), fused_cls[:n]
+
+
+MERGE_IOU_THRESHOLDS = {"moderate": 0.5, "aggressive": 0.3}
+
+
+def merge_overlapping(boxes: np.ndarray, class_ids: np.ndarray, iou_threshold: float = 0.5):
+    """
+    Greedy same-class merge ("smart deduplication", as in the frontend
+    TemplateCreator). Boxes are top-left [x, y, w, h].
+
+    Seeds are visited in input order; each seed absorbs every later unmerged
+    box of its class whose IoU with the *grown* seed is >= iou_threshold,
+    growing to the union bounding box after each absorption. The IoU of the
+    grown seed against all remaining boxes is evaluated as one array
+    operation per absorption, with the same float64 arithmetic as the scalar
+    loop, so results are identical to it.
+
+    Returns (merged [k, 4] top-left xywh, seed indices [k]) in seed order.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n = len(boxes)
+    if n == 0:
+        return boxes.copy(), np.empty((0,), dtype=np.int64)
+
+    x, y, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    x2, y2 = x + w, y + h
+    areas = w * h
+    class_ids = list(class_ids)
+    groups = {}
+    for i, cls in enumerate(class_ids):
+        groups.setdefault(cls, []).append(i)
+
+    merged = {}
+    for members in groups.values():
+        members = np.asarray(members, dtype=np.int64)
+        alive = np.ones(len(members), dtype=bool)
+        for s in range(len(members)):
+            if not alive[s]:
+                continue
+            alive[s] = False
+            seed = members[s]
+            cx, cy, cw, ch = x[seed], y[seed], w[seed], h[seed]
+            start = s + 1
+            while start < len(members):
+                rest = np.nonzero(alive[start:])[0] + start
+                if rest.size == 0:
+                    break
+                idx = members[rest]
+                ix1 = np.maximum(cx, x[idx])
+                iy1 = np.maximum(cy, y[idx])
+                ix2 = np.minimum(cx + cw, x2[idx])
+                iy2 = np.minimum(cy + ch, y2[idx])
+                inter = np.where((ix2 <= ix1) | (iy2 <= iy1), 0.0, (ix2 - ix1) * (iy2 - iy1))
+                union = cw * ch + areas[idx] - inter
+                iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+                hits = np.nonzero(iou >= iou_threshold)[0]
+                if hits.size == 0:
+                    break
+                # 吸收第一个命中的框后种子变大，其后的框需按新种子重新计算
+                k = rest[hits[0]]
+                j = members[k]
+                nx = min(cx, x[j])
+                ny = min(cy, y[j])
+                nx2 = max(cx + cw, x2[j])
+                ny2 = max(cy + ch, y2[j])
+                cx, cy, cw, ch = nx, ny, nx2 - nx, ny2 - ny
+                alive[k] = False
+                start = k + 1
+            merged[int(seed)] = (cx, cy, cw, ch)
+
+    seeds = np.asarray(sorted(merged), dtype=np.int64)
+    out = np.asarray([merged[s] for s in seeds], dtype=np.float64).reshape(-1, 4)
+    return out, seeds
+
+
+def merge_region_dicts(regions, mode: str = "moderate"):
+    """
+    merge_overlapping for predict() style region dicts (x, y, width, height,
+    type — the format the frontend dedup works on). Merged regions keep the
+    seed's other fields.
+    """
+    if mode == "off" or not regions:
+        return regions
+    boxes = np.array([[r["x"], r["y"], r["width"], r["height"]] for r in regions], dtype=np.float64)
+    merged, seeds = merge_overlapping(boxes, [r.get("type") for r in regions], MERGE_IOU_THRESHOLDS.get(mode, 0.5))
+    result = []
+    for (bx, by, bw, bh), s in zip(merged.tolist(), seeds.tolist()):
+        region = dict(regions[s])
+        region.update({"x": bx, "y": by, "width": bw, "height": bh})
+        result.append(region)
+    return result
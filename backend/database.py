@@ -4,6 +4,8 @@ import os
 import datetime
 from typing import List, Optional, Dict
 
+from fingerprint_codec import encode_features_text
+
 base_data = os.environ.get("APP_DATA_DIR", "data")
 DB_PATH = os.path.join(base_data, "metadata.db")
 
@@ -26,6 +28,7 @@ def init_db():
             name TEXT NOT NULL,
             fingerprint TEXT,
             fingerprint_text TEXT,
+            fingerprint_blob BLOB,
             tags TEXT,
             filename TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -36,14 +39,60 @@ def init_db():
     # Indexes
     c.execute('CREATE INDEX IF NOT EXISTS idx_mode ON templates (mode)')
     c.execute('CREATE INDEX IF NOT EXISTS idx_fingerprint ON templates (fingerprint)')
-    
+
+    _create_meta_table(c)
     conn.commit()
     conn.close()
 
+def _create_meta_table(c):
+    # 键值元数据；library_version 为模板库版本号 (匹配结果缓存的失效依据)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('library_version', 0)")
+
+def _bump_library_version(c):
+    """与模板写入在同一事务内递增模板库版本号"""
+    c.execute("UPDATE meta SET value = value + 1 WHERE key = 'library_version'")
+
+def _stored_mode(c, t_id: str) -> Optional[str]:
+    row = c.execute("SELECT mode FROM templates WHERE id = ?", (t_id,)).fetchone()
+    return row['mode'] if row else None
+
+def migrate_db():
+    """旧库升级：补充 fingerprint_blob 列 (由 fingerprint_text 回填二进制指纹) 与 meta 表"""
+    conn = get_db_connection()
+    c = conn.cursor()
+    _create_meta_table(c)
+    columns = {row['name'] for row in c.execute("PRAGMA table_info(templates)")}
+    if 'fingerprint_blob' not in columns:
+        c.execute('ALTER TABLE templates ADD COLUMN fingerprint_blob BLOB')
+        rows = c.execute(
+            "SELECT id, fingerprint_text FROM templates WHERE fingerprint_text IS NOT NULL"
+        ).fetchall()
+        for row in rows:
+            blob = encode_features_text(row['fingerprint_text'])
+            if blob is not None:
+                c.execute("UPDATE templates SET fingerprint_blob = ? WHERE id = ?", (blob, row['id']))
+        print(f"Database migrated: fingerprint_blob column added ({len(rows)} templates backfilled)")
+    conn.commit()
+    conn.close()
+
+def _public_row(row) -> Dict:
+    """API 返回用：去掉二进制指纹列 (不可 JSON 序列化)"""
+    d = dict(row)
+    d.pop('fingerprint_blob', None)
+    return d
+
 class Database:
     def __init__(self):
         if not os.path.exists(DB_PATH):
             init_db()
+        else:
+            migrate_db()
             
     def save_template(self, 
                       t_id: str, 
@@ -52,30 +101,53 @@ class Database:
                       filename: str,
                       fingerprint: Optional[str] = None, 
                       fingerprint_text: Optional[str] = None,
-                      tags: List[str] = None):
+                      tags: List[str] = None,
+                      fingerprint_blob: Optional[bytes] = None):
         if tags is None:
             tags = []
+        if fingerprint_blob is None:
+            fingerprint_blob = encode_features_text(fingerprint_text)
             
         conn = get_db_connection()
         c = conn.cursor()
         
+        # 自动匹配库只包含 auto 模板：写入前后任一为 auto 时才使匹配缓存失效
+        affects_auto = mode == 'auto' or _stored_mode(c, t_id) == 'auto'
+
         # Upsert
         c.execute('''
-            INSERT OR REPLACE INTO templates (id, mode, name, fingerprint, fingerprint_text, tags, filename, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (t_id, mode, name, fingerprint, fingerprint_text, json.dumps(tags), filename))
-        
+            INSERT OR REPLACE INTO templates (id, mode, name, fingerprint, fingerprint_text, fingerprint_blob, tags, filename, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (t_id, mode, name, fingerprint, fingerprint_text, fingerprint_blob, json.dumps(tags), filename))
+        if affects_auto:
+            _bump_library_version(c)
+
         conn.commit()
         conn.close()
 
-    def get_template(self, t_id: str):
+    def update_fingerprints(self, updates: List[tuple]):
+        """批量更新指纹 (单个事务)：updates 为 [(t_id, fingerprint_text), ...]"""
+        if not updates:
+            return
+        conn = get_db_connection()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE templates SET fingerprint_text = ?, fingerprint_blob = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                    [(text, encode_features_text(text), t_id) for t_id, text in updates]
+                )
+                _bump_library_version(conn)
+        finally:
+            conn.close()
+
+    def get_template(self, t_id: str, include_blob: bool = False):
         conn = get_db_connection()
         c = conn.cursor()
         c.execute('SELECT * FROM templates WHERE id = ?', (t_id,))
         row = c.fetchone()
         conn.close()
         if row:
-            d = dict(row)
+            d = dict(row) if include_blob else _public_row(row)
             d['tags'] = json.loads(d['tags'] or '[]')
             
             # Load regions from JSON file if it exists
@@ -114,7 +186,7 @@ class Database:
         
         results = []
         for r in rows:
-            d = dict(r)
+            d = _public_row(r)
             d['tags'] = json.loads(d['tags'] or '[]')
             
             # Load regions from JSON file if it exists
@@ -156,9 +228,20 @@ class Database:
     def delete_template(self, t_id: str):
         conn = get_db_connection()
         c = conn.cursor()
+        affects_auto = _stored_mode(c, t_id) == 'auto'
         c.execute("DELETE FROM templates WHERE id = ?", (t_id,))
+        if affects_auto:
+            _bump_library_version(c)
         conn.commit()
         conn.close()
 
+    def get_library_version(self) -> int:
+        conn = get_db_connection()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'library_version'").fetchone()
+            return row['value'] if row else 0
+        finally:
+            conn.close()
+
 # Global instance
 db = Database()
@@ -0,0 +1,120 @@
+"""
+Persistent fingerprint feature cache.
+
+extract_features renders the first page and runs layout inference; for batch
+jobs over historical archives that cost dominates. Features are stored per
+file content (MD5) under <APP_DATA_DIR>/cache/features/<version>+<text layer version>-<variant>/,
+in the binary fingerprint_codec layout (JSON only for features the codec does
+not support). The layout model variant is part of the directory name, so
+switching models never serves stale features. Multi-page features
+(max_pages > 1) are stored next to the page-1 entry as <md5>.p<max_pages>.*.
+
+Set FEATURE_CACHE_ENABLED=0 to disable.
+"""
+
+import os
+import json
+import threading
+import logging
+from typing import Dict, Optional, Tuple
+
+from fingerprint_codec import decode_features, encode_features
+from text_fingerprint import TEXT_LAYER_VERSION
+
+logger = logging.getLogger("backend.feature_cache")
+
+base_data = os.environ.get("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+FEATURE_CACHE_DIR = os.path.join(base_data, "cache", "features")
+FEATURE_VERSION = "v2_visual"
+
+
+class FeatureCache:
+    def __init__(self, cache_dir: str = FEATURE_CACHE_DIR, variant: Optional[str] = None):
+        if variant is None:
+            from inference import resolve_model_variant
+            variant = resolve_model_variant()[0]
+        self.variant = variant
+        self.cache_dir = os.path.join(cache_dir, f"{FEATURE_VERSION}+{TEXT_LAYER_VERSION}-{variant}")
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, md5: str, ext: str, max_pages: int = 1) -> str:
+        name = md5 if max_pages <= 1 else f"{md5}.p{max_pages}"
+        return os.path.join(self.cache_dir, md5[:2], f"{name}.{ext}")
+
+    def get(self, md5: str, max_pages: int = 1) -> Optional[Dict]:
+        features = None
+        try:
+            with open(self._path(md5, "fp", max_pages), "rb") as f:
+                features = decode_features(f.read())
+        except FileNotFoundError:
+            try:
+                with open(self._path(md5, "json", max_pages), "r", encoding="utf-8") as f:
+                    features = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Failed to load feature cache for {md5}: {e}")
+        except Exception as e:
+            logger.error(f"Failed to load feature cache for {md5}: {e}")
+
+        with self._lock:
+            if features is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return features
+
+    def put(self, md5: str, features: Dict, max_pages: int = 1):
+        blob = encode_features(features)
+        path = self._path(md5, "fp" if blob is not None else "json", max_pages)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            if blob is not None:
+                with open(tmp_path, "wb") as f:
+                    f.write(blob)
+            else:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(features, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Failed to save feature cache for {md5}: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"variant": self.variant, "hits": self.hits, "misses": self.misses}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_feature_cache() -> Optional[FeatureCache]:
+    """全局缓存实例；FEATURE_CACHE_ENABLED=0 时返回 None"""
+    global _cache
+    if os.environ.get("FEATURE_CACHE_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = FeatureCache()
+    return _cache
+
+
+def extract_features_cached(file_path: str, engine=None, max_pages: int = 1) -> Tuple[Dict, bool]:
+    """返回 (features, 是否命中缓存)；提取失败的空布局不写入缓存"""
+    if engine is None:
+        from fingerprint import engine
+    cache = get_feature_cache()
+    if cache is None:
+        return engine.extract_features(file_path, max_pages=max_pages), False
+    md5 = engine.get_md5(file_path)
+    features = cache.get(md5, max_pages)
+    if features is not None:
+        return features, True
+    features = engine.extract_features(file_path, max_pages=max_pages)
+    if features.get("layout_boxes"):
+        cache.put(md5, features, max_pages)
+    return features, False
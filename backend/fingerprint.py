@@ -1,4 +1,3 @@
-import hashlib
 import pdfplumber
 import os
 import re
@@ -8,7 +7,44 @@ import fitz  # PyMuPDF
 from PIL import Image
 from typing import List, Dict, Optional, Tuple
 from difflib import SequenceMatcher
-from inference import get_layout_engine
+from inference_service import predict_layout
+from utils import file_md5
+from box_ops import MERGE_IOU_THRESHOLDS, merge_overlapping
+from text_fingerprint import extract_text_features, extract_text_layer, text_threshold, text_tier_enabled
+from match_cache import get_match_cache
+
+# 签名类别分组 (见 FingerprintEngine._get_layout_signature)
+SIGNATURE_GROUPS = {
+    0: 'T', 1: 'T',
+    3: 'S', 5: 'S',
+    4: 'C', 6: 'C', 7: 'C',
+    8: 'F', 9: 'F'
+}
+
+# 级联打分的上界比较容差 (浮点误差)，保证剪枝不会漏掉实际可达的候选
+SCORE_EPS = 1e-9
+
+
+class PreparedFingerprint:
+    """
+    解析后的指纹特征：签名、过滤后的框序列等打分所需数据只计算一次，
+    layout_boxes 以 NumPy 数组保存 (供向量化预筛选使用)。
+    """
+    __slots__ = ('features', 'version', 'aspect_ratio', 'boxes', 'has_boxes', 'signature', 'filtered', 'sequence')
+
+    def __init__(self, engine: "FingerprintEngine", features: Dict,
+                 signature: Optional[str] = None, boxes: Optional[np.ndarray] = None):
+        layout_boxes = features.get("layout_boxes", []) or []
+        self.features = features
+        self.version = features.get("version")
+        self.aspect_ratio = features.get("aspect_ratio", 0)
+        # signature / boxes 可由二进制指纹 (fingerprint_codec) 直接提供
+        self.boxes = boxes if boxes is not None else np.asarray(layout_boxes, dtype=np.float64).reshape(-1, 5)
+        self.has_boxes = bool(layout_boxes)
+        self.signature = signature if signature is not None else engine._get_layout_signature(layout_boxes)
+        self.filtered = engine._filter_signature_boxes(layout_boxes)
+        self.sequence = [SIGNATURE_GROUPS.get(b[0], 'X') for b in self.filtered]
+
 
 class FingerprintEngine:
     def __init__(self):
@@ -16,89 +52,127 @@ class FingerprintEngine:
         pass
 
     def get_md5(self, file_path: str) -> str:
-        hasher = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            buf = f.read()
-            hasher.update(buf)
-        return hasher.hexdigest()
+        return file_md5(file_path)
 
-    def extract_features(self, file_path: str) -> Dict:
+    def extract_features(self, file_path: str, max_pages: int = 1) -> Dict:
         """
         Extracts visual layout features using DocLayout-YOLO.
         Features include: box categories and their relative positions.
+        max_pages > 1 additionally fingerprints pages 2..max_pages
+        ("page_count" + "extra_pages", see page_features).
+        Native PDFs also get the model-free text-layer fingerprint of page 1
+        ("text_layer", see text_fingerprint; None for scanned pages).
         """
         features = {
             "version": "v2_visual",
             "md5": self.get_md5(file_path),
             "aspect_ratio": 0.0,
-            "layout_boxes": [] # List of [class_id, x_center, y_center, width, height]
+            "layout_boxes": [], # List of [class_id, x_center, y_center, width, height]
+            "text_layer": None
         }
         
         try:
-            # 1. 基础宽高比 (使用 pdfplumber 快速获取)
+            # 1. 基础宽高比与文本层指纹 (使用 pdfplumber 快速获取)
             with pdfplumber.open(file_path) as pdf:
-                if len(pdf.pages) > 0:
+                page_count = len(pdf.pages)
+                if page_count > 0:
                     page = pdf.pages[0]
                     features["aspect_ratio"] = round(float(page.width) / float(page.height), 3)
+                    features["text_layer"] = extract_text_layer(page)
             
-            # 2. 视觉布局提取 (复用 singleton 引擎)
-            engine_instance = get_layout_engine()
+            # 2. 视觉布局提取 (会话池或进程池推理服务)
+            # 只渲染第一页，且直接以模型输入分辨率渲染 (不落盘，推理前无需缩放)
+            from utils import render_pdf_page_for_model
             
-            # 将 PDF 第一页转为图像进行推理
-            from utils import pdf_to_images
-            import tempfile
+            first_page_img = render_pdf_page_for_model(file_path, imgsz=1024)
             
-            # 使用临时目录生成图像
-            with tempfile.TemporaryDirectory() as temp_dir:
-                image_paths = pdf_to_images(file_path, temp_dir, dpi=200)
+            if first_page_img is not None:
+                # === OPTIMIZATION: Fingerprint sequence depends on layout blocks, not fine pixels ===
+                # Use fast_mode=True to skip expensive image enhancement filters
+                regions = predict_layout(first_page_img, conf=0.1, imgsz=1024, fast_mode=True)
+                features["layout_boxes"] = self._layout_from_regions(regions)
+
+            # 3. 其余页 (批量推理)
+            if max_pages > 1:
+                features["page_count"] = page_count
+                features["extra_pages"] = [
+                    page for _, page in self.extract_page_features(file_path, range(1, min(page_count, max_pages)))
+                ]
                 
-                if image_paths and len(image_paths) > 0:
-                    # 只处理第一页
-                    first_page_img = image_paths[0]
-                    
-                    # === OPTIMIZATION: Fingerprint sequence depends on layout blocks, not fine pixels ===
-                    # Use fast_mode=True to skip expensive image enhancement filters
-                    regions = engine_instance.predict(first_page_img, conf=0.1, imgsz=1024, fast_mode=True)
-                    
-                    layout_data = []
-                    # 遍历识别出的区块
-                    for region in regions:
-                        # 提取归一化坐标
-                        x_center = region['x'] + region['width'] / 2
-                        y_center = region['y'] + region['height'] / 2
-                        
-                        # 尝试从 label 反向查找 class_id
-                        label = region['label']
-                        cls_id = 0
-                        for cid, cname in [(0, 'title'), (1, 'plain text'), (2, 'abandon'), 
-                                          (3, 'figure'), (4, 'figure_caption'), (5, 'table'), 
-                                          (6, 'table_caption'), (7, 'table_footnote'), 
-                                          (8, 'isolate_formula'), (9, 'formula_caption')]:
-                            if cname.lower() == label.lower():
-                                cls_id = cid
-                                break
-                        
-                        # [类别, x_center, y_center, width, height]
-                        layout_data.append([
-                            cls_id,
-                            round(x_center, 4),
-                            round(y_center, 4),
-                            round(region['width'], 4),
-                            round(region['height'], 4)
-                        ])
-                    
-                    # Apply Smart Deduplication (Moderate Mode)
-                    layout_data = self.merge_overlapping_regions(layout_data, mode='moderate')
-                    
-                    # 按 Y 轴中心点排序，确保指纹序列的一致性
-                    layout_data.sort(key=lambda x: x[2])
-                    features["layout_boxes"] = layout_data
-                    
         except Exception as e:
             print(f"Error extracting visual features: {e}")
             
         return features
 
+    def extract_page_features(self, file_path: str, page_indices) -> List[Tuple[int, Dict]]:
+        """
+        指定页 (0-based) 的版面特征，返回 [(页码, {"aspect_ratio", "layout_boxes"})]，超出页数的页码被跳过。
+        所有页一次提交 predict_layout_batch，由会话池 / 推理进程池批量并行推理。
+        """
+        from utils import render_pdf_pages_for_model
+        from inference_service import predict_layout_batch
+
+        rasters = render_pdf_pages_for_model(file_path, list(page_indices), imgsz=1024)
+        if not rasters:
+            return []
+        with pdfplumber.open(file_path) as pdf:
+            ratios = [round(float(pdf.pages[r.page_idx].width) / float(pdf.pages[r.page_idx].height), 3) for r in rasters]
+        regions_list = predict_layout_batch(rasters, conf=0.1, imgsz=1024, fast_mode=True)
+        return [
+            (r.page_idx, {"aspect_ratio": ratio, "layout_boxes": self._layout_from_regions(regions)})
+            for r, ratio, regions in zip(rasters, ratios, regions_list)
+        ]
+
+    def _layout_from_regions(self, regions: List[Dict]) -> List[List]:
+        """版面识别结果 -> 去重并按 Y 排序的 [类别, x_center, y_center, width, height]"""
+        layout_data = []
+        # 遍历识别出的区块
+        for region in regions:
+            # 提取归一化坐标
+            x_center = region['x'] + region['width'] / 2
+            y_center = region['y'] + region['height'] / 2
+            
+            # 尝试从 label 反向查找 class_id
+            label = region['label']
+            cls_id = 0
+            for cid, cname in [(0, 'title'), (1, 'plain text'), (2, 'abandon'), 
+                              (3, 'figure'), (4, 'figure_caption'), (5, 'table'), 
+                              (6, 'table_caption'), (7, 'table_footnote'), 
+                              (8, 'isolate_formula'), (9, 'formula_caption')]:
+                if cname.lower() == label.lower():
+                    cls_id = cid
+                    break
+            
+            # [类别, x_center, y_center, width, height]
+            layout_data.append([
+                cls_id,
+                round(x_center, 4),
+                round(y_center, 4),
+                round(region['width'], 4),
+                round(region['height'], 4)
+            ])
+        
+        # Apply Smart Deduplication (Moderate Mode)
+        layout_data = self.merge_overlapping_regions(layout_data, mode='moderate')
+        
+        # 按 Y 轴中心点排序，确保指纹序列的一致性
+        layout_data.sort(key=lambda x: x[2])
+        return layout_data
+
+    def page_features(self, features: Dict) -> List[Dict]:
+        """
+        多页指纹拆成逐页的 features：第 1 页即 features 本身，
+        extra_pages 中的第 2..N 页补上 version 后可直接 prepare / 打分。
+        """
+        pages = [features]
+        for page in features.get("extra_pages") or []:
+            pages.append({
+                "version": features.get("version"),
+                "aspect_ratio": page.get("aspect_ratio", 0),
+                "layout_boxes": page.get("layout_boxes", []),
+            })
+        return pages
+
     def merge_overlapping_regions(self, regions: List[List], mode: str = 'moderate') -> List[List]:
         """
         Smart Deduplication: Merge overlapping regions of the same class.
@@ -108,84 +182,21 @@ class FingerprintEngine:
             return regions
             
         # IoU Threshold: moderate=0.5, aggressive=0.3
-        iou_threshold = 0.3 if mode == 'aggressive' else 0.5
-        
-        # Region format: [cls_id, x_center, y_center, width, height]
-        # Convert to: [cls_id, x, y, width, height] for easier calc
-        # Actually we need x, y (top-left) to calc intersection
-        
-        def get_rect(r):
-            w = r[3]
-            h = r[4]
-            x = r[1] - w / 2
-            y = r[2] - h / 2
-            return {'x': x, 'y': y, 'w': w, 'h': h, 'cls': r[0]}
-            
-        rects = [get_rect(r) for r in regions]
+        iou_threshold = MERGE_IOU_THRESHOLDS['aggressive'] if mode == 'aggressive' else MERGE_IOU_THRESHOLDS['moderate']
         
-        merged_indices = set()
-        final_rects = []
-        
-        for i in range(len(rects)):
-            if i in merged_indices:
-                continue
-                
-            current = rects[i].copy()
-            merged_indices.add(i)
-            
-            for j in range(i + 1, len(rects)):
-                if j in merged_indices:
-                    continue
-                    
-                other = rects[j]
-                
-                # Only merge same type
-                if current['cls'] != other['cls']:
-                    continue
-                    
-                # Calculate IoU
-                x1 = max(current['x'], other['x'])
-                y1 = max(current['y'], other['y'])
-                x2 = min(current['x'] + current['w'], other['x'] + other['w'])
-                y2 = min(current['y'] + current['h'], other['y'] + other['h'])
-                
-                if x2 <= x1 or y2 <= y1:
-                    intersection = 0
-                else:
-                    intersection = (x2 - x1) * (y2 - y1)
-                    
-                areaA = current['w'] * current['h']
-                areaB = other['w'] * other['h']
-                union = areaA + areaB - intersection
-                
-                if union <= 0: iou = 0
-                else: iou = intersection / union
-                
-                if iou >= iou_threshold:
-                    # Merge: take bounding box of both
-                    new_x = min(current['x'], other['x'])
-                    new_y = min(current['y'], other['y'])
-                    new_x2 = max(current['x'] + current['w'], other['x'] + other['w'])
-                    new_y2 = max(current['y'] + current['h'], other['y'] + other['h'])
-                    
-                    current['x'] = new_x
-                    current['y'] = new_y
-                    current['w'] = new_x2 - new_x
-                    current['h'] = new_y2 - new_y
-                    
-                    merged_indices.add(j)
-            
-            final_rects.append(current)
+        # Region format: [cls_id, x_center, y_center, width, height] -> top-left [x, y, width, height]
+        rects = [[r[1] - r[3] / 2, r[2] - r[4] / 2, r[3], r[4]] for r in regions]
+        merged, seeds = merge_overlapping(np.array(rects, dtype=np.float64), [r[0] for r in regions], iou_threshold)
 
         # Convert back to center format [cls_id, x_center, y_center, width, height]
         result = []
-        for r in final_rects:
+        for (x, y, w, h), s in zip(merged.tolist(), seeds.tolist()):
             result.append([
-                r['cls'],
-                round(r['x'] + r['w'] / 2, 4),
-                round(r['y'] + r['h'] / 2, 4),
-                round(r['w'], 4),
-                round(r['h'], 4)
+                regions[s][0],
+                round(x + w / 2, 4),
+                round(y + h / 2, 4),
+                round(w, 4),
+                round(h, 4)
             ])
             
         print(f"Smart Deduplication ({mode}): {len(regions)} -> {len(result)} regions")
@@ -199,13 +210,6 @@ class FingerprintEngine:
         # Formula Group: isolate_formula(8), formula_caption(9) -> F
         # Ignore: abandon(2)
         
-        group_map = {
-            0: 'T', 1: 'T',
-            3: 'S', 5: 'S',
-            4: 'C', 6: 'C', 7: 'C',
-            8: 'F', 9: 'F'
-        }
-        
         sig_chars = []
         last_char = None
         
@@ -216,8 +220,8 @@ class FingerprintEngine:
             if area < 0.002:
                 continue
                 
-            if cls_id in group_map:
-                char = group_map[cls_id]
+            if cls_id in SIGNATURE_GROUPS:
+                char = SIGNATURE_GROUPS[cls_id]
                 # Collapse consecutive duplicates
                 if char != last_char:
                     sig_chars.append(char)
@@ -225,6 +229,18 @@ class FingerprintEngine:
                 
         return "".join(sig_chars)
 
+    def _filter_signature_boxes(self, boxes: List[List]) -> List[List]:
+        """与 _get_layout_signature 相同的过滤规则 (面积 >= 0.2% 且属于签名类别)，不折叠"""
+        return [b for b in boxes if (b[3] * b[4]) >= 0.002 and b[0] in [0,1,3,4,5,6,7,8,9]]
+
+    def prepare(self, features: Dict) -> "PreparedFingerprint":
+        """预先计算打分所需的签名与过滤序列，供 score_prepared / 指纹索引复用"""
+        return PreparedFingerprint(self, features)
+
+    def prepare_pages(self, features: Dict) -> List["PreparedFingerprint"]:
+        """每页一个 PreparedFingerprint (page_features 的顺序)"""
+        return [self.prepare(page) for page in self.page_features(features)]
+
     def is_subsequence(self, s1: str, s2: str) -> bool:
         """Check if s1 is a subsequence of s2"""
         it = iter(s2)
@@ -235,10 +251,6 @@ class FingerprintEngine:
         Calculates spatial similarity based on matched blocks.
         Only considers Y-coordinates (vertical layout) and Height.
         """
-        matches = matcher.get_matching_blocks()
-        total_weight = 0.0
-        total_score = 0.0
-        
         # Filter source boxes to match the signature construction logic (remove small boxes, etc)
         # Note: self._get_layout_signature filters boxes < 0.2% area. 
         # We need to apply the same filtering to get correct indices, OR rely on the fact that
@@ -250,8 +262,8 @@ class FingerprintEngine:
         
         # Let's simplify: 
         # 1. Get filtered lists first
-        t_filtered = [b for b in t_boxes if (b[3] * b[4]) >= 0.002 and b[0] in [0,1,3,4,5,6,7,8,9]]
-        c_filtered = [b for b in c_boxes if (b[3] * b[4]) >= 0.002 and b[0] in [0,1,3,4,5,6,7,8,9]]
+        t_filtered = self._filter_signature_boxes(t_boxes)
+        c_filtered = self._filter_signature_boxes(c_boxes)
         
         # 2. Get collapsed lists (keeping track of original boxes is hard with simple collapse)
         # For now, let's assume specific "Key Elements" like Tables/Figures are not collapsed often 
@@ -263,15 +275,14 @@ class FingerprintEngine:
         # Instead of complex mapping, let's compare the raw filtered lists using the same SequenceMatcher
         # taking just the class ID for matching, then checking spatial for matches.
         
-        group_map = {
-            0: 'T', 1: 'T',
-            3: 'S', 5: 'S',
-            4: 'C', 6: 'C', 7: 'C',
-            8: 'F', 9: 'F'
-        }
+        t_seq = [SIGNATURE_GROUPS.get(b[0], 'X') for b in t_filtered]
+        c_seq = [SIGNATURE_GROUPS.get(b[0], 'X') for b in c_filtered]
         
-        t_seq = [group_map.get(b[0], 'X') for b in t_filtered]
-        c_seq = [group_map.get(b[0], 'X') for b in c_filtered]
+        return self._spatial_similarity(t_filtered, c_filtered, t_seq, c_seq)
+
+    def _spatial_similarity(self, t_filtered: List[List], c_filtered: List[List], t_seq: List[str], c_seq: List[str]) -> float:
+        total_weight = 0.0
+        total_score = 0.0
         
         # Re-run matcher on uncollapsed sequence for spatial alignment
         spatial_matcher = SequenceMatcher(None, t_seq, c_seq)
@@ -318,25 +329,59 @@ class FingerprintEngine:
         2. Layout Category Sequence (60%)
         3. Spatial Position Correlation (40%)
         """
-        # 0. Check version
-        if candidate_features.get("version") != "v2_visual":
+        return self.score_prepared(self.prepare(target), self.prepare(candidate_features))
+
+    def score_prepared(self, t: "PreparedFingerprint", c: "PreparedFingerprint") -> float:
+        """calculate_score 的预处理版本 (签名与过滤序列已缓存在 PreparedFingerprint 中)"""
+        seq_sim = self._sequence_similarity(t, c)
+        if seq_sim is None:
             return 0.0
 
+        # 4. Spatial Similarity
+        # If sequence is completely off, spatial doesn't matter much.
+        # But if sequence is good, spatial discriminates same-structure different-layout.
+        spatial_sim = 0.0
+        if seq_sim > 0.3: # Only calculate if there's some structural resemblance
+            spatial_sim = self._spatial_similarity(t.filtered, c.filtered, t.sequence, c.sequence)
+        
+        # Final Score Mix
+        # Sequence is foundation (0.6), Spatial is refinement (0.4)
+        final_score = seq_sim * 0.6 + spatial_sim * 0.4
+        
+        return final_score
+
+    def score_cascaded(self, t: "PreparedFingerprint", c: "PreparedFingerprint", cutoff: float) -> Optional[float]:
+        """
+        级联打分：序列相似度算出后，若 seq_sim * 0.6 + 0.4 (空间得分上限) 仍低于 cutoff，
+        跳过第二次 SequenceMatcher 与空间比对，返回 None；否则返回与 score_prepared 相同的精确分数。
+        """
+        seq_sim = self._sequence_similarity(t, c)
+        if seq_sim is None:
+            return 0.0 if cutoff <= 0.0 else None
+        spatial_cap = 0.4 if seq_sim > 0.3 else 0.0
+        if seq_sim * 0.6 + spatial_cap + SCORE_EPS < cutoff:
+            return None
+        spatial_sim = 0.0
+        if seq_sim > 0.3:
+            spatial_sim = self._spatial_similarity(t.filtered, c.filtered, t.sequence, c.sequence)
+        return seq_sim * 0.6 + spatial_sim * 0.4
+
+    def _sequence_similarity(self, t: "PreparedFingerprint", c: "PreparedFingerprint") -> Optional[float]:
+        """版本 / 宽高比 / 空框门限未通过时返回 None，否则返回含子序列加成的序列相似度"""
+        # 0. Check version
+        if c.version != "v2_visual":
+            return None
+
         # 1. Aspect Ratio
-        t_ar = target.get("aspect_ratio", 0)
-        c_ar = candidate_features.get("aspect_ratio", 0)
-        if abs(t_ar - c_ar) > 0.05:
-            return 0.0
+        if abs(t.aspect_ratio - c.aspect_ratio) > 0.05:
+            return None
             
-        t_boxes = target.get("layout_boxes", [])
-        c_boxes = candidate_features.get("layout_boxes", [])
-        
-        if not t_boxes or not c_boxes:
-            return 0.0
+        if not t.has_boxes or not c.has_boxes:
+            return None
             
         # 2. Sequence Similarity
-        t_sig = self._get_layout_signature(t_boxes)
-        c_sig = self._get_layout_signature(c_boxes)
+        t_sig = t.signature
+        c_sig = c.signature
         
         matcher = SequenceMatcher(None, t_sig, c_sig)
         seq_sim = matcher.ratio()
@@ -364,56 +409,206 @@ class FingerprintEngine:
                         # Let's simple boost: average of original and 1.0, scaled by length ratio
                         boost_factor = min_len / max_len
                         seq_sim = max(seq_sim, 0.6 + 0.3 * boost_factor)
-
-        # 4. Spatial Similarity
-        # If sequence is completely off, spatial doesn't matter much.
-        # But if sequence is good, spatial discriminates same-structure different-layout.
-        spatial_sim = 0.0
-        if seq_sim > 0.3: # Only calculate if there's some structural resemblance
-            spatial_sim = self.calculate_spatial_similarity(t_boxes, c_boxes, matcher)
-        
-        # Final Score Mix
-        # Sequence is foundation (0.6), Spatial is refinement (0.4)
-        final_score = seq_sim * 0.6 + spatial_sim * 0.4
-        
-        return final_score
+        return seq_sim
 
     def find_best_match(self, 
                         target_file: str, 
-                        candidates: List[Dict], 
-                        threshold: float = 0.7) -> Tuple[Optional[Dict], float]:
+                        candidates: Optional[List[Dict]] = None, 
+                        threshold: float = 0.7,
+                        index=None) -> Tuple[Optional[Dict], float]:
+        """
+        在模板库中查找最佳匹配。
+        默认使用全局自动模板索引 (fingerprint_index)；传入 candidates 时为其临时建立索引。
+
+        原生 PDF 先用文本层指纹匹配 (不渲染、不推理)，得分达到 FINGERPRINT_TEXT_THRESHOLD 即返回；
+        扫描页或文本层未命中时使用视觉指纹。
+        视觉逐页匹配：先用第 1 页与所有模板页比对，得分达到 FINGERPRINT_CONFIDENT_SCORE 时直接返回；
+        否则把第 2..FINGERPRINT_MAX_PAGES 页一次批量推理后逐页比对 (如首页是封面的多页文件)。
+        特征匹配返回的候选附带 matched_page (文件页码) 与 template_page (模板页码，均从 1 开始)
+        以及 match_tier ("text" | "visual")。
+        全局索引上的结果按 (MD5, 模板库版本号) 缓存 (match_cache)，未匹配的结果也会缓存。
+        """
+        from fingerprint_index import FingerprintIndex, get_template_index
+        if index is None:
+            if candidates is None:
+                index = get_template_index()
+            else:
+                index = FingerprintIndex(self)
+                index.build(candidates)
         
         # 1. MD5 Fast Match (首选完全匹配)
         target_md5 = self.get_md5(target_file)
-        for cand in candidates:
-            # 兼容字段名 fingerprint，通常存储的是 md5
-            if cand.get('fingerprint') == target_md5:
-                return cand, 1.0
+        # 兼容字段名 fingerprint，通常存储的是 md5
+        exact = index.lookup_md5(target_md5)
+        if exact is not None:
+            return exact, 1.0
+
+        # 2. 匹配结果缓存 (含未匹配的负缓存)，键包含模板库版本号，模板保存/删除后自动失效
+        cache = get_match_cache() if index.library_version is not None else None
+        cache_key = (target_md5, index.library_version, threshold, _match_config())
+        if cache is not None:
+            hit = cache.get(cache_key)
+            if hit is not None:
+                if hit["template_id"] is None:
+                    print(f"Match cache hit: no template matched (best score {hit['score']:.3f})")
+                    return None, hit["score"]
+                cand = index.candidate(hit["template_id"])
+                if cand is not None:
+                    print(f"Match cache hit: {hit['template_id']} with score {hit['score']:.3f}")
+                    return dict(cand, **hit["match"]), hit["score"]
+
+        cand, score, cacheable = self._match_features(target_file, index, threshold)
+        if cache is not None and cacheable:
+            match = {k: cand[k] for k in ("matched_page", "template_page", "match_tier")} if cand else None
+            cache.put(cache_key, cand['id'] if cand else None, score, match)
+        return cand, score
+
+    def _match_features(self, target_file: str, index, threshold: float) -> Tuple[Optional[Dict], float, bool]:
+        """
+        文本层 / 视觉逐页匹配，返回 (候选, 分数, 结果是否可缓存)。
+        特征提取失败 (空布局) 的未匹配结果不可缓存，避免把临时错误记成负缓存。
+        """
+        # 文本层快速指纹 (原生 PDF)
+        if text_tier_enabled() and index.text_count():
+            target_text = extract_text_features(target_file)
+            if target_text is not None:
+                cand, score = index.match_text(target_text, threshold=text_threshold())
+                if cand is not None:
+                    print(f"Text-layer match: {cand['id']} with score {score:.3f}")
+                    return dict(cand, matched_page=1, template_page=1, match_tier="text"), score, True
                 
-        # 2. 视觉特征提取与对比
+        # 视觉特征提取与对比 (宽高比门限 + 上界预筛选 + 精确打分)，先只看第 1 页
         target_features = self.extract_features(target_file)
-        best_score = 0.0
-        best_cand = None
-        
-        for cand in candidates:
-            # candidate.fingerprint_text 存储的是特征 JSON 字符串
-            try:
-                raw_fp = cand.get('fingerprint_text') or '{}'
-                cand_features = json.loads(raw_fp)
-                if not cand_features: continue
-                
-                score = self.calculate_score(target_features, cand_features)
-                if score > best_score:
-                    best_score = score
-                    best_cand = cand
-            except Exception as e:
-                print(f"Match error for candidate {cand.get('id')}: {e}")
-                continue
-                
-        if best_score >= threshold:
-            return best_cand, best_score
-            
-        return None, best_score
+        best_cand, best_score, template_page = index.match_page(target_features, threshold=threshold)
+        matched_page = 0
+
+        # 首页不够确定时再看后续页
+        confident = float(os.environ.get("FINGERPRINT_CONFIDENT_SCORE", "0.9"))
+        max_pages = fingerprint_max_pages()
+        if best_score < confident and max_pages > 1 and len(index):
+            for page_idx, page in self.extract_page_features(target_file, range(1, max_pages)):
+                page["version"] = target_features["version"]
+                cand, score, t_page = index.match_page(page, threshold=threshold)
+                if score > best_score and (cand is not None or best_cand is None):
+                    best_cand, best_score, template_page, matched_page = cand, score, t_page, page_idx
+                if best_score >= confident:
+                    break
+
+        cacheable = bool(target_features.get("layout_boxes"))
+        if best_cand is None:
+            return None, best_score, cacheable
+        if matched_page or template_page:
+            print(f"Multi-page match: document page {matched_page + 1} -> template page {template_page + 1}")
+        return dict(best_cand, matched_page=matched_page + 1, template_page=template_page + 1,
+                    match_tier="visual"), best_score, True
+
+    def similarity_matrix(self, features_list: List[Dict], symmetric: bool = True,
+                          workers: Optional[int] = None) -> np.ndarray:
+        """
+        N×N 得分矩阵，matrix[i, j] = calculate_score(features_list[i], features_list[j])，对角线为 1.0。
+        每个文档的签名与过滤序列只计算一次。
+        symmetric=True 时只计算上三角并镜像 (空间得分按 target 框面积加权，
+        得分并不严格对称；需要双向精确值时传 symmetric=False)。
+        配对数超过 MATRIX_PARALLEL_MIN_PAIRS 时按行分块到多个进程 (workers 默认 CPU 核数)。
+        """
+        n = len(features_list)
+        matrix = np.eye(n, dtype=np.float64)
+        if n < 2:
+            return matrix
+
+        pairs = n * (n - 1) // 2 if symmetric else n * (n - 1)
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or pairs < MATRIX_PARALLEL_MIN_PAIRS:
+            prepared = [self.prepare(f) for f in features_list]
+            for i in range(n):
+                matrix[i] = _matrix_row(prepared, i, symmetric, self)
+        else:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # 上三角每行工作量不同：交错分配行号使各块负载接近
+            chunks = [list(range(k, n, workers * 4)) for k in range(min(n, workers * 4))]
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_matrix_worker_init,
+                initargs=(features_list,),
+            ) as executor:
+                for rows, values in executor.map(_matrix_rows, chunks, [symmetric] * len(chunks)):
+                    matrix[rows] = values
+
+        if symmetric:
+            upper = np.triu(matrix, 1)
+            matrix = upper + upper.T + np.eye(n)
+        return matrix
+
+
+def _match_config() -> Tuple:
+    """影响匹配结果的配置项 (匹配结果缓存键的一部分)"""
+    return (
+        fingerprint_max_pages(),
+        text_tier_enabled(),
+        text_threshold(),
+        os.environ.get("FINGERPRINT_CONFIDENT_SCORE", "0.9"),
+        os.environ.get("FINGERPRINT_TOPK", "0"),
+        os.environ.get("FINGERPRINT_LSH", "0"),
+    )
+
+
+def fingerprint_max_pages() -> int:
+    """模板指纹与上传文件逐页匹配的最大页数 (FINGERPRINT_MAX_PAGES，默认 3；1 表示只看首页)"""
+    return max(1, int(os.environ.get("FINGERPRINT_MAX_PAGES", "3")))
+
+
+# ========== 得分矩阵 (进程池 worker) ==========
+
+MATRIX_PARALLEL_MIN_PAIRS = 20000
+_matrix_prepared: List["PreparedFingerprint"] = []
+
+
+def _matrix_row(prepared: List["PreparedFingerprint"], i: int, symmetric: bool, engine_: "FingerprintEngine") -> np.ndarray:
+    row = np.zeros(len(prepared), dtype=np.float64)
+    row[i] = 1.0
+    for j in range(i + 1 if symmetric else 0, len(prepared)):
+        if j != i:
+            row[j] = engine_.score_prepared(prepared[i], prepared[j])
+    return row
+
+
+def _matrix_worker_init(features_list: List[Dict]):
+    global _matrix_prepared
+    _matrix_prepared = [engine.prepare(f) for f in features_list]
+
+
+def _matrix_rows(rows: List[int], symmetric: bool):
+    return rows, np.stack([_matrix_row(_matrix_prepared, i, symmetric, engine) for i in rows])
+
+
+def export_similarity_matrix(matrix: np.ndarray, labels: List[str], path: str):
+    """按扩展名导出：.csv (带行列标签) 或 .npy (标签另存为同名 .labels.json)"""
+    if path.lower().endswith(".npy"):
+        np.save(path, matrix)
+        with open(path[:-4] + ".labels.json", "w", encoding="utf-8") as f:
+            json.dump(list(labels), f, ensure_ascii=False, indent=2)
+        return
+    import csv
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([""] + list(labels))
+        for label, row in zip(labels, matrix):
+            writer.writerow([label] + [f"{v:.4f}" for v in row])
+
 
 # Global instance
 engine = FingerprintEngine()
+
+
+def extraction_page(match_cand: Dict, page_count: int) -> Optional[int]:
+    """
+    匹配结果 -> 提取区域所用的文件页下标 (0-based)；无可用页时返回 None。
+    模板区域画在模板第 1 页上：文件第 matched_page 页对应模板第 template_page 页，
+    所以模板第 1 页对应文件第 matched_page - template_page + 1 页。
+    """
+    page_idx = match_cand.get('matched_page', 1) - match_cand.get('template_page', 1)
+    if page_idx < 0 or page_idx >= max(page_count, 1):
+        return None
+    return page_idx
@@ -0,0 +1,300 @@
+"""
+Versioned binary layout for fingerprint features (templates.fingerprint_blob).
+
+The v2_visual JSON in templates.fingerprint_text had to be json.loads'ed and
+turned back into box lists on every match. The blob stores the same features
+packed, so the loader hands FingerprintEngine ready-to-score arrays:
+
+    header  <4sBBHdI  magic b"IMFP", format version, flags, reserved,
+                      aspect_ratio (float64), box count n
+    str     version   u8 length + utf-8 (e.g. "v2_visual")
+    str     md5       u8 length + ascii
+    str     signature u16 length + ascii (precomputed layout signature)
+    boxes   n x uint8 class ids, then n x 4 coords (x_center, y_center, w, h)
+            as float32, or float64 when FLAG_FLOAT64 is set
+
+Format version 2 (multi-page features, i.e. with page_count / extra_pages)
+appends after the page-1 boxes:
+
+    pages   <HH page_count, number of extra pages m
+    page    m x (<dI aspect_ratio, box count; u16 signature; boxes as above)
+
+Single-page features are still written as version 1.
+
+FLAG_TEXT_LAYER marks a trailing text-layer section (text_fingerprint), written
+whenever features carry the "text_layer" key:
+
+    text    u8 present (0 = scanned page, text_layer None); if present:
+            u8 version string, <HBBH grid cells, h bins, v bins, token count,
+            grid uint8, h_lines / v_lines uint16, tokens u8 length + utf-8
+
+extract_features rounds coords to 4 decimals, which float32 + round(4)
+reproduces exactly; the encoder verifies the round trip and falls back to
+float64 otherwise, so decoding is always lossless. Features with keys the
+format does not know are not encoded (encode_features returns None) and keep
+using the JSON column. The JSON column stays written and readable.
+"""
+
+import json
+import struct
+from typing import Dict, Optional
+
+import numpy as np
+
+MAGIC = b"IMFP"
+FORMAT_VERSION = 2
+FLAG_FLOAT64 = 0x01
+FLAG_TEXT_LAYER = 0x02
+
+_HEADER = struct.Struct("<4sBBHdI")
+_PAGES = struct.Struct("<HH")
+_PAGE = struct.Struct("<dI")
+_TEXT = struct.Struct("<HBBH")
+_KNOWN_KEYS = {"version", "md5", "aspect_ratio", "layout_boxes", "page_count", "extra_pages", "text_layer"}
+_PAGE_KEYS = {"aspect_ratio", "layout_boxes"}
+_TEXT_KEYS = {"version", "grid", "h_lines", "v_lines", "tokens"}
+_COORD_DECIMALS = 4
+
+
+def _pack_str(value: str, width: str) -> bytes:
+    data = (value or "").encode("utf-8")
+    return struct.pack(f"<{width}", len(data)) + data
+
+
+def _unpack_str(blob, offset: int, width: str):
+    size = struct.calcsize(width)
+    (length,) = struct.unpack_from(f"<{width}", blob, offset)
+    offset += size
+    return bytes(blob[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def _coords_f32_exact(coords: np.ndarray) -> bool:
+    restored = np.round(coords.astype(np.float32).astype(np.float64), _COORD_DECIMALS)
+    return bool(np.array_equal(restored, coords))
+
+
+def _box_arrays(boxes) -> Optional[tuple]:
+    """layout_boxes -> (uint8 类别, float64 坐标)；框格式或类别不支持时返回 None"""
+    if any(len(b) != 5 for b in boxes):
+        return None
+    classes = [b[0] for b in boxes]
+    if any(int(c) != c or not 0 <= c < 256 for c in classes):
+        return None
+    coords = np.asarray([b[1:] for b in boxes], dtype=np.float64).reshape(-1, 4)
+    return np.asarray(classes, dtype=np.uint8), coords
+
+
+def encode_features(features: Dict, signature: Optional[str] = None) -> Optional[bytes]:
+    """features -> blob；包含本格式不支持的字段或类别非整数时返回 None (继续使用 JSON)"""
+    if not features or set(features) - _KNOWN_KEYS:
+        return None
+
+    from fingerprint import engine
+    extra_pages = features.get("extra_pages") or []
+    if any(not isinstance(p, dict) or set(p) - _PAGE_KEYS for p in extra_pages):
+        return None
+    multi_page = "page_count" in features or "extra_pages" in features
+
+    pages = []
+    for page in [features] + list(extra_pages):
+        boxes = page.get("layout_boxes") or []
+        arrays = _box_arrays(boxes)
+        if arrays is None:
+            return None
+        pages.append((page, boxes, arrays))
+
+    if signature is None:
+        signature = engine._get_layout_signature(pages[0][1])
+
+    flags = 0
+    text_section = b""
+    if "text_layer" in features:
+        text_section = _pack_text_layer(features["text_layer"])
+        if text_section is None:
+            return None
+        flags |= FLAG_TEXT_LAYER
+    if not all(_coords_f32_exact(coords) for _, _, (_, coords) in pages):
+        flags |= FLAG_FLOAT64
+    dtype = "<f8" if flags & FLAG_FLOAT64 else "<f4"
+
+    classes, coords = pages[0][2]
+    parts = [
+        _HEADER.pack(MAGIC, 2 if multi_page else 1, flags, 0,
+                     float(features.get("aspect_ratio", 0) or 0), len(classes)),
+        _pack_str(features.get("version", ""), "B"),
+        _pack_str(features.get("md5", ""), "B"),
+        _pack_str(signature, "H"),
+        classes.tobytes(),
+        coords.astype(dtype).tobytes(),
+    ]
+    if multi_page:
+        parts.append(_PAGES.pack(int(features.get("page_count", 0) or 0), len(extra_pages)))
+        for page, boxes, (classes, coords) in pages[1:]:
+            parts += [
+                _PAGE.pack(float(page.get("aspect_ratio", 0) or 0), len(classes)),
+                _pack_str(engine._get_layout_signature(boxes), "H"),
+                classes.tobytes(),
+                coords.astype(dtype).tobytes(),
+            ]
+    parts.append(text_section)
+    return b"".join(parts)
+
+
+def _pack_text_layer(text_layer: Optional[Dict]) -> Optional[bytes]:
+    """text_layer -> 文本层区段；字段或取值超出格式范围时返回 None"""
+    if text_layer is None:
+        return b"\x00"
+    if not isinstance(text_layer, dict) or set(text_layer) != _TEXT_KEYS:
+        return None
+    grid, h_lines, v_lines = text_layer["grid"], text_layer["h_lines"], text_layer["v_lines"]
+    tokens = [t.encode("utf-8") for t in text_layer["tokens"]]
+    if (len(grid) > 65535 or len(h_lines) > 255 or len(v_lines) > 255 or len(tokens) > 65535
+            or any(len(t) > 255 for t in tokens)
+            or any(int(v) != v or not 0 <= v < 256 for v in grid)
+            or any(int(v) != v or not 0 <= v < 65536 for v in list(h_lines) + list(v_lines))):
+        return None
+    parts = [
+        b"\x01",
+        _pack_str(text_layer["version"], "B"),
+        _TEXT.pack(len(grid), len(h_lines), len(v_lines), len(tokens)),
+        np.asarray(grid, dtype=np.uint8).tobytes(),
+        np.asarray(list(h_lines) + list(v_lines), dtype="<u2").tobytes(),
+    ]
+    parts += [struct.pack("<B", len(t)) + t for t in tokens]
+    return b"".join(parts)
+
+
+def _unpack_text_layer(blob, offset: int) -> Optional[Dict]:
+    if blob[offset] == 0:
+        return None
+    version, offset = _unpack_str(blob, offset + 1, "B")
+    n_grid, n_h, n_v, n_tokens = _TEXT.unpack_from(blob, offset)
+    offset += _TEXT.size
+    grid = np.frombuffer(blob, dtype=np.uint8, count=n_grid, offset=offset).tolist()
+    offset += n_grid
+    lines = np.frombuffer(blob, dtype="<u2", count=n_h + n_v, offset=offset).tolist()
+    offset += 2 * (n_h + n_v)
+    tokens = []
+    for _ in range(n_tokens):
+        token, offset = _unpack_str(blob, offset, "B")
+        tokens.append(token)
+    return {"version": version, "grid": grid, "h_lines": lines[:n_h], "v_lines": lines[n_h:], "tokens": tokens}
+
+
+def encode_features_text(fingerprint_text: Optional[str]) -> Optional[bytes]:
+    """fingerprint_text (JSON) -> blob；无法解析或不支持时返回 None"""
+    if not fingerprint_text:
+        return None
+    try:
+        return encode_features(json.loads(fingerprint_text))
+    except (ValueError, TypeError):
+        return None
+
+
+def _unpack_boxes(blob, offset: int, n: int, flags: int):
+    classes = np.frombuffer(blob, dtype=np.uint8, count=n, offset=offset).astype(np.int64)
+    offset += n
+    if flags & FLAG_FLOAT64:
+        coords = np.frombuffer(blob, dtype="<f8", count=n * 4, offset=offset).reshape(n, 4).astype(np.float64)
+        offset += n * 32
+    else:
+        coords = np.frombuffer(blob, dtype="<f4", count=n * 4, offset=offset).reshape(n, 4).astype(np.float64)
+        coords = np.round(coords, _COORD_DECIMALS)
+        offset += n * 16
+    return classes, coords, offset
+
+
+def decode_arrays(blob) -> Dict:
+    """
+    blob -> {"version", "md5", "aspect_ratio", "signature", "classes", "coords"}
+    classes 为 int64 (n,)，coords 为 float64 (n, 4)，不经过 JSON 解析。
+    多页格式另含 "page_count" 与 "extra_pages" (每页 {"aspect_ratio", "signature", "classes", "coords"})，
+    带文本层时另含 "text_layer" (与 features 中的字典相同)
+    """
+    blob = memoryview(blob)
+    magic, fmt, flags, _, aspect_ratio, n = _HEADER.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a fingerprint blob")
+    if fmt > FORMAT_VERSION:
+        raise ValueError(f"Unsupported fingerprint blob version {fmt}")
+
+    offset = _HEADER.size
+    version, offset = _unpack_str(blob, offset, "B")
+    md5, offset = _unpack_str(blob, offset, "B")
+    signature, offset = _unpack_str(blob, offset, "H")
+    classes, coords, offset = _unpack_boxes(blob, offset, n, flags)
+
+    arrays = {
+        "version": version,
+        "md5": md5,
+        "aspect_ratio": aspect_ratio,
+        "signature": signature,
+        "classes": classes,
+        "coords": coords,
+    }
+    if fmt >= 2:
+        page_count, m = _PAGES.unpack_from(blob, offset)
+        offset += _PAGES.size
+        extra_pages = []
+        for _ in range(m):
+            page_ar, page_n = _PAGE.unpack_from(blob, offset)
+            page_sig, offset = _unpack_str(blob, offset + _PAGE.size, "H")
+            page_classes, page_coords, offset = _unpack_boxes(blob, offset, page_n, flags)
+            extra_pages.append({"aspect_ratio": page_ar, "signature": page_sig,
+                                "classes": page_classes, "coords": page_coords})
+        arrays["page_count"] = page_count
+        arrays["extra_pages"] = extra_pages
+    if flags & FLAG_TEXT_LAYER:
+        arrays["text_layer"] = _unpack_text_layer(blob, offset)
+    return arrays
+
+
+def _layout_boxes(arrays: Dict) -> list:
+    return [[c] + xywh for c, xywh in zip(arrays["classes"].tolist(), arrays["coords"].tolist())]
+
+
+def _features_from_arrays(arrays: Dict) -> Dict:
+    features = {
+        "version": arrays["version"],
+        "md5": arrays["md5"],
+        "aspect_ratio": arrays["aspect_ratio"],
+        "layout_boxes": _layout_boxes(arrays),
+    }
+    if "extra_pages" in arrays:
+        features["page_count"] = arrays["page_count"]
+        features["extra_pages"] = [
+            {"aspect_ratio": p["aspect_ratio"], "layout_boxes": _layout_boxes(p)} for p in arrays["extra_pages"]
+        ]
+    if "text_layer" in arrays:
+        features["text_layer"] = arrays["text_layer"]
+    return features
+
+
+def _box_matrix(arrays: Dict) -> np.ndarray:
+    return np.concatenate([arrays["classes"][:, None].astype(np.float64), arrays["coords"]], axis=1)
+
+
+def decode_features(blob) -> Dict:
+    """blob -> 与 v2_visual JSON 等价的 features 字典"""
+    return _features_from_arrays(decode_arrays(blob))
+
+
+def decode_prepared(blob, engine=None):
+    """blob -> PreparedFingerprint (第 1 页；签名直接取自 blob，不重新计算)"""
+    return decode_prepared_pages(blob, engine)[0]
+
+
+def decode_prepared_pages(blob, engine=None) -> list:
+    """blob -> 每页一个 PreparedFingerprint (与 FingerprintEngine.prepare_pages 一致)"""
+    return prepared_pages_from_arrays(decode_arrays(blob), engine)
+
+
+def prepared_pages_from_arrays(arrays: Dict, engine=None) -> list:
+    """decode_arrays 的结果 -> 每页一个 PreparedFingerprint"""
+    from fingerprint import PreparedFingerprint, engine as default_engine
+    engine = engine or default_engine
+    features = _features_from_arrays(arrays)
+    pages = [PreparedFingerprint(engine, features, signature=arrays["signature"], boxes=_box_matrix(arrays))]
+    for page, page_features in zip(arrays.get("extra_pages", []), engine.page_features(features)[1:]):
+        pages.append(PreparedFingerprint(engine, page_features, signature=page["signature"], boxes=_box_matrix(page)))
+    return pages
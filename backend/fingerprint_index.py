@@ -0,0 +1,490 @@
+"""
+In-memory index over the auto-template fingerprint library.
+
+find_best_match used to json.loads every candidate's fingerprint_text and run
+two SequenceMatcher passes per template on every upload. The index parses each
+template once into a PreparedFingerprint and keeps the vectorizable parts in
+NumPy arrays:
+
+    * aspect ratios sorted once, so the 0.05 hard gate is a searchsorted range
+    * per-template signature letter counts, giving a vectorized upper bound
+      of FingerprintEngine.score_prepared (quick_ratio + subsequence boost cap)
+    * candidates are scored in descending bound order with a running best:
+      scanning stops once the bound drops below max(threshold, best), and
+      FingerprintEngine.score_cascaded skips the spatial pass for candidates
+      whose sequence score already rules them out (FINGERPRINT_TOPK optionally
+      caps the number scored; default 0 = no cap, exact)
+    * multi-page templates (extra_pages) contribute one row per page, so a
+      document page can match any fingerprinted template page; rows are
+      keyed (template id, page index)
+    * templates with a text-layer fingerprint (text_fingerprint) are also kept
+      as stacked unit vectors: match_text scores grid / ruling-line cosines
+      with one matrix product per query and computes the token Dice only in
+      descending upper-bound order, with the same running-best cutoff
+    * optionally a MinHash/LSH table (fingerprint_lsh) first narrows the gate
+      to near neighbours. It trades recall for speed, so it is opt-in
+      (FINGERPRINT_LSH: 0 (default) | 1 | auto; auto turns it on from
+      FINGERPRINT_LSH_MIN_TEMPLATES templates, default 1000)
+
+The exact score is FingerprintEngine.score_prepared, i.e. identical to
+calculate_score. The global index is refreshed incrementally: /templates save,
+delete and migrate call refresh_template / remove_template, and a cheap
+(count, max(rowid), max(updated_at), library_version) stamp check picks up
+writes from other processes. library_version (the meta-table counter bumped on
+every template write) is exposed on the global index as the match_cache key.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from fingerprint import SCORE_EPS, FingerprintEngine, PreparedFingerprint, engine as default_engine
+from fingerprint_codec import decode_arrays, prepared_pages_from_arrays
+from fingerprint_lsh import LSHTable
+from text_fingerprint import GRID_COLS, GRID_ROWS, LINE_BINS, PreparedText, combine_scores, token_dice
+
+SIGNATURE_LETTERS = "TSCF"
+AR_GATE = 0.05
+# 行的库内顺序 = 模板顺序 * PAGE_SLOTS + 页码 (同分时先比模板顺序，再比页码)
+PAGE_SLOTS = 1 << 16
+
+
+class IndexEntry:
+    __slots__ = ('cand', 'raw', 'pages', 'text', 'order')
+
+    def __init__(self, cand: Dict, raw, pages: List[PreparedFingerprint], text: Optional[PreparedText], order: int):
+        # 候选记录会随 /analyze 结果返回，不保留二进制指纹列
+        self.cand = {k: v for k, v in cand.items() if k != 'fingerprint_blob'}
+        self.raw = raw
+        self.pages = pages
+        self.text = text
+        self.order = order
+
+    @property
+    def prepared(self) -> Optional[PreparedFingerprint]:
+        """第 1 页"""
+        return self.pages[0] if self.pages else None
+
+
+def _raw(cand: Dict):
+    return cand.get('fingerprint_blob') or cand.get('fingerprint_text') or '{}'
+
+
+def _parse(cand: Dict, engine: FingerprintEngine) -> Tuple[List[PreparedFingerprint], Optional[PreparedText]]:
+    """-> (每页的视觉指纹, 文本层指纹)"""
+    # 优先使用二进制指纹 (无需 JSON 解析)，旧数据回退到 fingerprint_text
+    blob = cand.get('fingerprint_blob')
+    if blob:
+        arrays = decode_arrays(blob)
+        return prepared_pages_from_arrays(arrays, engine), PreparedText.from_features(arrays)
+    features = json.loads(cand.get('fingerprint_text') or '{}')
+    if not features:
+        return [], None
+    return engine.prepare_pages(features), PreparedText.from_features(features)
+
+
+def _usable(prepared: Optional[PreparedFingerprint]) -> bool:
+    # 只有 v2_visual 且有框的模板可能得分 > 0
+    return prepared is not None and prepared.version == "v2_visual" and prepared.has_boxes
+
+
+def signature_counts(signature: str) -> np.ndarray:
+    return np.array([signature.count(ch) for ch in SIGNATURE_LETTERS], dtype=np.int32)
+
+
+def score_upper_bounds(signature: str, counts: np.ndarray, sig_len: np.ndarray) -> np.ndarray:
+    """
+    score_prepared 的上界 (向量化)：
+    seq_sim <= max(quick_ratio, 子序列加成上限 0.6 + 0.3 * 长度比)，spatial <= 1
+    counts / sig_len 为候选签名的字母计数 (signature_counts) 与长度
+    """
+    t_len = len(signature)
+    c_len = np.asarray(sig_len).astype(np.float64)
+    common = np.minimum(counts, signature_counts(signature)[None, :]).sum(axis=1)
+    total = c_len + t_len
+    quick = np.where(total > 0, 2.0 * common / np.maximum(total, 1), 1.0)
+
+    min_len = np.minimum(c_len, t_len)
+    max_len = np.maximum(c_len, t_len)
+    ratio = np.where(max_len > 0, min_len / np.maximum(max_len, 1), 0.0)
+    boost = np.where((min_len > 0) & (ratio > 0.3), 0.6 + 0.3 * ratio, 0.0)
+
+    seq_ub = np.maximum(quick, boost)
+    return seq_ub * 0.6 + np.where(seq_ub > 0.3, 0.4, 0.0)
+
+
+class FingerprintIndex:
+    def __init__(self, engine: FingerprintEngine = None):
+        self.engine = engine or default_engine
+        self._entries: Dict[str, IndexEntry] = {}
+        self._by_md5: Dict[str, str] = {}
+        self._next_order = 0
+        self._lock = threading.RLock()
+        self._dirty = True
+        self.stamp = None
+        # 模板库版本号 (仅全局索引设置)；None 表示临时索引，不使用匹配结果缓存
+        self.library_version = None
+        self.lsh = LSHTable()
+        # 向量化视图 (按宽高比排序)
+        self._ids: List[str] = []
+        self._ar = np.zeros(0)
+        self._counts = np.zeros((0, len(SIGNATURE_LETTERS)), dtype=np.int32)
+        self._sig_len = np.zeros(0, dtype=np.int32)
+        self._order = np.zeros(0, dtype=np.int64)
+        self._text_ids: List[str] = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ---------- 维护 ----------
+
+    def build(self, candidates: List[Dict]):
+        """按给定顺序 (即原 find_best_match 的遍历顺序) 重建；fingerprint_text 未变的条目直接复用"""
+        with self._lock:
+            old = self._entries
+            self._entries = {}
+            self._next_order = 0
+            for cand in candidates:
+                t_id = cand.get('id')
+                raw = _raw(cand)
+                prev = old.get(t_id)
+                if prev is not None and prev.raw == raw:
+                    pages, text = prev.pages, prev.text
+                else:
+                    try:
+                        pages, text = _parse(cand, self.engine)
+                    except Exception as e:
+                        print(f"Match error for candidate {t_id}: {e}")
+                        pages, text = [], None
+                self._entries[t_id] = IndexEntry(cand, raw, pages, text, self._next_order)
+                self._next_order += 1
+                if prev is not None and prev.pages is pages:
+                    continue
+                self._lsh_update(t_id, prev, pages)
+            for t_id, entry in old.items():
+                if t_id not in self._entries:
+                    self._lsh_update(t_id, entry, [])
+            self._rebuild_md5()
+            self._dirty = True
+
+    def upsert(self, cand: Dict):
+        """新增或替换模板 (与 INSERT OR REPLACE 一致，替换后排在末尾)"""
+        t_id = cand.get('id')
+        raw = _raw(cand)
+        try:
+            pages, text = _parse(cand, self.engine)
+        except Exception as e:
+            print(f"Match error for candidate {t_id}: {e}")
+            pages, text = [], None
+        with self._lock:
+            prev = self._entries.pop(t_id, None)
+            self._entries[t_id] = IndexEntry(cand, raw, pages, text, self._next_order)
+            self._next_order += 1
+            self._lsh_update(t_id, prev, pages)
+            self._rebuild_md5()
+            self._dirty = True
+
+    def remove(self, t_id: str):
+        with self._lock:
+            prev = self._entries.pop(t_id, None)
+            if prev is not None:
+                self._lsh_update(t_id, prev, [])
+                self._rebuild_md5()
+                self._dirty = True
+
+    def _lsh_update(self, t_id: str, prev: Optional[IndexEntry], pages: List[PreparedFingerprint]):
+        """LSH 表以 (模板 id, 页码) 为键：移除旧条目多出的页，插入 / 替换可用页"""
+        for page in range(len(pages), len(prev.pages) if prev is not None else 0):
+            self.lsh.remove((t_id, page))
+        for page, prepared in enumerate(pages):
+            if _usable(prepared):
+                self.lsh.insert((t_id, page), prepared)
+            else:
+                self.lsh.remove((t_id, page))
+
+    def _rebuild_md5(self):
+        self._by_md5 = {}
+        for t_id, entry in self._entries.items():
+            md5 = entry.cand.get('fingerprint')
+            if md5 and md5 not in self._by_md5:
+                self._by_md5[md5] = t_id
+
+    def _ensure_arrays(self):
+        if not self._dirty:
+            return
+        usable = [
+            ((t_id, page), e.order * PAGE_SLOTS + page, prepared)
+            for t_id, e in self._entries.items()
+            for page, prepared in enumerate(e.pages) if _usable(prepared)
+        ]
+        ar = np.array([float(prepared.aspect_ratio or 0) for _, _, prepared in usable], dtype=np.float64)
+        order = np.argsort(ar, kind="stable")
+        rows = [usable[i] for i in order]
+        self._ids = [key for key, _, _ in rows]
+        self._ar = ar[order]
+        self._counts = (
+            np.stack([signature_counts(prepared.signature) for _, _, prepared in rows])
+            if rows else np.zeros((0, len(SIGNATURE_LETTERS)), dtype=np.int32)
+        )
+        self._sig_len = np.array([len(prepared.signature) for _, _, prepared in rows], dtype=np.int32)
+        self._order = np.array([row_order for _, row_order, _ in rows], dtype=np.int64)
+
+        # 文本层 (不按宽高比排序：每次查询对全部行做一次矩阵乘法)
+        texts = [(t_id, e) for t_id, e in self._entries.items() if e.text is not None]
+        self._text_ids = [t_id for t_id, _ in texts]
+        self._text_ar = np.array([e.text.aspect_ratio for _, e in texts], dtype=np.float64)
+        self._text_grid = (np.stack([e.text.grid for _, e in texts]) if texts
+                           else np.zeros((0, GRID_ROWS * GRID_COLS)))
+        self._text_lines = (np.stack([e.text.lines for _, e in texts]) if texts
+                            else np.zeros((0, 2 * LINE_BINS)))
+        self._text_has_lines = np.array([e.text.has_lines for _, e in texts], dtype=bool)
+        self._text_order = np.array([e.order for _, e in texts], dtype=np.int64)
+        self._dirty = False
+
+    def text_count(self) -> int:
+        """带文本层指纹的模板数"""
+        with self._lock:
+            self._ensure_arrays()
+            return len(self._text_ids)
+
+    def page(self, key: Tuple[str, int]) -> Optional[PreparedFingerprint]:
+        """行键 (模板 id, 页码) -> 该页的 PreparedFingerprint"""
+        entry = self._entries.get(key[0])
+        if entry is None or key[1] >= len(entry.pages):
+            return None
+        return entry.pages[key[1]]
+
+    # ---------- 查询 ----------
+
+    def candidate(self, t_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(t_id)
+            return entry.cand if entry is not None else None
+
+    def lookup_md5(self, md5: str) -> Optional[Dict]:
+        with self._lock:
+            t_id = self._by_md5.get(md5)
+            return self._entries[t_id].cand if t_id is not None else None
+
+    def score_upper_bounds(self, target: PreparedFingerprint, sl: slice) -> np.ndarray:
+        return score_upper_bounds(target.signature, self._counts[sl], self._sig_len[sl])
+
+    def use_lsh(self) -> bool:
+        mode = os.environ.get("FINGERPRINT_LSH", "0").lower()
+        if mode in ("0", "false", "no", "off"):
+            return False
+        if mode in ("1", "true", "yes", "on"):
+            return True
+        return len(self._entries) >= int(os.environ.get("FINGERPRINT_LSH_MIN_TEMPLATES", "1000"))
+
+    def lsh_candidates(self, target: PreparedFingerprint) -> set:
+        with self._lock:
+            return self.lsh.query(target)
+
+    def gated_candidates(self, target: PreparedFingerprint,
+                         allowed: Optional[set] = None) -> Tuple[List[Tuple[str, int]], np.ndarray, np.ndarray]:
+        """
+        宽高比硬门限 (区间查找 + 精确复核)，返回 (行键, 上界, 库内顺序)；
+        行键为 (模板 id, 页码)，allowed 为 LSH 近邻行键集合
+        """
+        with self._lock:
+            self._ensure_arrays()
+            t_ar = float(target.aspect_ratio or 0)
+            lo = np.searchsorted(self._ar, t_ar - AR_GATE - 1e-9, side="left")
+            hi = np.searchsorted(self._ar, t_ar + AR_GATE + 1e-9, side="right")
+            sl = slice(lo, hi)
+            # 与 score_prepared 相同的浮点判断，避免区间边界误差
+            exact = np.abs(t_ar - self._ar[sl]) <= AR_GATE
+            if allowed is not None:
+                exact &= np.fromiter((t_id in allowed for t_id in self._ids[lo:hi]), dtype=bool, count=hi - lo)
+            ids = [t_id for t_id, ok in zip(self._ids[lo:hi], exact) if ok]
+            bounds = self.score_upper_bounds(target, sl)[exact]
+            order = self._order[sl][exact]
+            return ids, bounds, order
+
+    def match(self, target_features: Dict, threshold: float = 0.7,
+              top_k: Optional[int] = None, use_lsh: Optional[bool] = None) -> Tuple[Optional[Dict], float]:
+        """返回 (最佳候选, 分数)，见 match_page"""
+        cand, score, _ = self.match_page(target_features, threshold=threshold, top_k=top_k, use_lsh=use_lsh)
+        return cand, score
+
+    def match_page(self, target_features: Dict, threshold: float = 0.7,
+                   top_k: Optional[int] = None, use_lsh: Optional[bool] = None) -> Tuple[Optional[Dict], float, int]:
+        """
+        单页目标与所有模板页比对，返回 (最佳候选, 分数, 命中的模板页码 (0-based))。
+        分数相同时取库中顺序靠前者 (与逐个遍历一致)，同一模板取靠前的页。
+        启用 LSH 时只对近邻打分；近邻为空 (签名过短/罕见布局) 时退回全量门限候选。
+
+        级联打分：候选按上界降序遍历，上界低于 max(阈值, 当前最佳) 即停止；
+        单个候选在序列相似度之后再判断一次，无法达到时跳过空间比对。
+        匹配结果与逐个精确打分一致；未达阈值时返回的分数为已完整评估候选中的最高分。
+        """
+        if top_k is None:
+            top_k = int(os.environ.get("FINGERPRINT_TOPK", "0"))
+        target = self.engine.prepare(target_features)
+        if not target.has_boxes:
+            return None, 0.0, 0
+
+        if use_lsh is None:
+            use_lsh = self.use_lsh()
+        ids, bounds, order = [], None, None
+        if use_lsh:
+            ids, bounds, order = self.gated_candidates(target, allowed=self.lsh_candidates(target))
+        if not ids:
+            ids, bounds, order = self.gated_candidates(target)
+        if not ids:
+            return None, 0.0, 0
+
+        # 按上界降序 (同上界按库顺序)；top_k > 0 时额外限制打分数量 (有损)
+        rank = np.lexsort((order, -bounds))
+        if top_k and top_k > 0:
+            rank = rank[:top_k]
+
+        best_score = 0.0
+        best_order = None
+        best_key = None
+        scored = 0
+        full = 0
+        for i in rank:
+            cutoff = max(threshold, best_score)
+            if bounds[i] + SCORE_EPS < cutoff:
+                break  # 之后的候选上界更低，不可能达到阈值或超过当前最佳
+            prepared = self.page(ids[i])
+            if prepared is None:
+                continue
+            scored += 1
+            try:
+                score = self.engine.score_cascaded(target, prepared, cutoff)
+            except Exception as e:
+                print(f"Match error for candidate {ids[i][0]}: {e}")
+                continue
+            if score is None:
+                continue
+            full += 1
+            if score > best_score or (score == best_score and best_order is not None and order[i] < best_order):
+                best_score = score
+                best_order = order[i]
+                best_key = ids[i]
+
+        print(f"Fingerprint index: {len(self._entries)} templates, {len(ids)} pages within aspect-ratio gate, "
+              f"{scored} sequence-scored, {full} fully scored{' (lsh)' if use_lsh else ''}")
+        entry = self._entries.get(best_key[0]) if best_key is not None else None
+        if best_score >= threshold and entry is not None:
+            return entry.cand, best_score, best_key[1]
+        return None, best_score, 0
+
+    def match_text(self, target_features: Dict, threshold: float = 0.7) -> Tuple[Optional[Dict], float]:
+        """
+        文本层指纹匹配，target_features 为 {"aspect_ratio", "text_layer"}，返回 (最佳候选, 分数)。
+        宽高比门限后，网格与直线余弦一次矩阵乘法算出；关键词 Dice 取 1 得到上界，
+        按上界降序逐个计算 Dice，上界低于 max(阈值, 当前最佳) 即停止。同分取库中顺序靠前者。
+        """
+        target = PreparedText.from_features(target_features)
+        if target is None:
+            return None, 0.0
+        with self._lock:
+            self._ensure_arrays()
+            gate = np.nonzero(np.abs(self._text_ar - target.aspect_ratio) <= AR_GATE)[0]
+            ids = [self._text_ids[i] for i in gate]
+            grid_sim = self._text_grid[gate] @ target.grid
+            has_lines = self._text_has_lines[gate]
+            line_sim = np.where(has_lines, self._text_lines[gate] @ target.lines, 0.0) if target.has_lines \
+                else np.zeros(len(gate))
+            both_without = ~has_lines if not target.has_lines else np.zeros(len(gate), dtype=bool)
+            order = self._text_order[gate]
+        if not ids:
+            return None, 0.0
+
+        bounds = combine_scores(1.0, grid_sim, line_sim, both_without)
+        best_score = 0.0
+        best_order = None
+        best_id = None
+        scored = 0
+        for i in np.lexsort((order, -bounds)):
+            if bounds[i] + SCORE_EPS < max(threshold, best_score):
+                break
+            entry = self._entries.get(ids[i])
+            if entry is None or entry.text is None:
+                continue
+            scored += 1
+            score = float(combine_scores(token_dice(target.tokens, entry.text.tokens),
+                                         grid_sim[i], line_sim[i], both_without[i]))
+            if score > best_score or (score == best_score and best_order is not None and order[i] < best_order):
+                best_score = score
+                best_order = order[i]
+                best_id = ids[i]
+
+        print(f"Text-layer index: {len(self._text_ids)} templates, {len(ids)} within aspect-ratio gate, "
+              f"{scored} token-scored")
+        entry = self._entries.get(best_id) if best_id is not None else None
+        if best_score >= threshold and entry is not None:
+            return entry.cand, best_score
+        return None, best_score
+
+
+# ========== 全局索引 (自动模板库) ==========
+
+_index: Optional[FingerprintIndex] = None
+_index_lock = threading.Lock()
+
+
+def _db_stamp() -> Tuple:
+    """
+    自动模板库的变更戳：INSERT OR REPLACE 会分配新 rowid，删除会改变数量；
+    最后一项为 meta 表中的模板库版本号
+    """
+    from database import get_db_connection
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT COUNT(*), MAX(rowid), MAX(updated_at), "
+            "(SELECT value FROM meta WHERE key = 'library_version') FROM templates WHERE mode = 'auto'"
+        ).fetchone()
+        return tuple(row)
+    finally:
+        conn.close()
+
+
+def _set_stamp(index: FingerprintIndex, stamp: Tuple):
+    index.stamp = stamp
+    index.library_version = stamp[-1] if stamp[-1] is not None else 0
+
+
+def get_template_index() -> FingerprintIndex:
+    """全局自动模板索引；数据库被其他进程修改时按变更戳检测并增量重建"""
+    global _index
+    from database import db
+    with _index_lock:
+        stamp = _db_stamp()
+        if _index is None:
+            _index = FingerprintIndex()
+        if _index.stamp != stamp:
+            _index.build(db.get_all_auto_templates())
+            _set_stamp(_index, stamp)
+        return _index
+
+
+def refresh_template(t_id: str):
+    """模板保存后同步索引 (非 auto 模式的模板从索引移除)"""
+    from database import db
+    with _index_lock:
+        if _index is None:
+            return
+        row = db.get_template(t_id, include_blob=True)
+        if row and row.get('mode') == 'auto':
+            row.pop('regions', None)
+            _index.upsert(row)
+        else:
+            _index.remove(t_id)
+        _set_stamp(_index, _db_stamp())
+
+
+def remove_template(t_id: str):
+    with _index_lock:
+        if _index is None:
+            return
+        _index.remove(t_id)
+        _set_stamp(_index, _db_stamp())
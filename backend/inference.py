@@ -3,7 +3,20 @@ import numpy as np
 from PIL import Image
 import os
 import sys
-from typing import List, Dict, Union
+import json
+from typing import List, Dict, Optional, Tuple
+
+import threading
+import time
+import queue
+import multiprocessing
+from contextlib import contextmanager
+import cv2
+
+from box_ops import xywh_to_xyxy, batched_nms, weighted_boxes_fusion
+from utils import PageRaster, get_page_raster
+from layout_cache import get_layout_cache, image_digest
+from ort_profile import create_session, get_profile, resolve_providers
 
 # DocLayout-YOLO 类别名称映射
 DOCLAYOUT_CLASSES = {
@@ -19,97 +32,231 @@ DOCLAYOUT_CLASSES = {
     9: 'formula_caption'
 }
 
+# YOLO 惯用填充色 114，按原实现以 float32 计算归一化值
+_PAD_VALUE = np.float32(114) / np.float32(255.0)
+
+def to_rgb_array(image) -> np.ndarray:
+    """
+    将各种图像输入统一为 HxWx3 uint8 RGB 数组 (尽量零拷贝)。
+    支持: 文件路径、PageRaster、PIL Image、NumPy 数组、PyMuPDF Pixmap。
+    """
+    if isinstance(image, PageRaster):
+        return image.array
+    
+    if isinstance(image, str):
+        # 同一请求已渲染的页面直接复用内存像素，避免重新解码 PNG
+        raster = get_page_raster(image)
+        if raster is not None:
+            return raster.array
+        # np.fromfile + imdecode 兼容 Windows 下的中文路径
+        data = np.fromfile(image, dtype=np.uint8)
+        bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError(f"Unable to decode image: {image}")
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    
+    if isinstance(image, Image.Image):
+        return np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+    
+    if hasattr(image, 'samples') and hasattr(image, 'stride'):
+        # PyMuPDF Pixmap: 直接引用像素内存 (samples_mv 为零拷贝 memoryview)
+        samples = getattr(image, 'samples_mv', None) or image.samples
+        n = image.n
+        arr = np.frombuffer(samples, dtype=np.uint8).reshape(image.height, image.stride)
+        arr = arr[:, :image.width * n].reshape(image.height, image.width, n)
+        image = arr
+    
+    if isinstance(image, np.ndarray):
+        if image.dtype != np.uint8:
+            image = np.clip(image, 0, 255).astype(np.uint8)
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        if image.ndim == 3 and image.shape[2] == 1:
+            return cv2.cvtColor(image[:, :, 0], cv2.COLOR_GRAY2RGB)
+        if image.ndim == 3 and image.shape[2] == 4:
+            return image[:, :, :3]
+        if image.ndim == 3 and image.shape[2] == 3:
+            return image
+        raise ValueError(f"Unsupported image array shape: {image.shape}")
+    
+    raise TypeError(f"Unsupported image input type: {type(image).__name__}")
+
 def get_device_providers():
     """
-    获取可用的 ONNX Runtime 执行提供者
-    优先级: CUDA > CoreML (MPS) > CPU
+    获取 ONNX Runtime 执行提供者 (由 ort_profile 决定)
+    默认优先级: CUDA > CoreML (MPS) > CPU
+    """
+    return resolve_providers(get_profile()["options"])
+
+def default_thread_budget() -> int:
+    """
+    推理可用的 CPU 线程总预算：
+    1. 核心数 <= 4: 使用 cpus - 1, 留 1 核给 UI
+    2. 核心数 > 4: 使用 cpus // 2, 保持系统整体响应
     """
-    available = ort.get_available_providers()
+    cpus = multiprocessing.cpu_count()
+    if cpus <= 4:
+        return max(1, cpus - 1)
+    return cpus // 2
+
+# 模型变体注册表：variant -> 文件名
+# 由 scripts/optimize_model.py (simplified / int8_static) 与 scripts/quantize_model_legacy.py (int8_dynamic) 生成，
+# 通过 scripts/autotune_model.py 在本机测速并校验精度后选定
+MODEL_VARIANTS = {
+    "fp32": "yolov10-doclayout.onnx",
+    "simplified": "yolov10-doclayout_sim.onnx",
+    "int8_dynamic": "yolov10-doclayout_int8.onnx",
+    "int8_static": "yolov10-doclayout_int8_static.onnx",
+}
+DEFAULT_MODEL_VARIANT = "fp32"
+AUTOTUNE_FILENAME = "layout_autotune.json"
+
+def get_models_dir() -> str:
+    base_data = os.environ.get("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    return os.path.join(base_data, "models")
+
+def find_model_file(filename: str) -> Optional[str]:
+    """按优先级查找模型文件：用户数据目录 > 打包资源 > 开发目录"""
+    # 1. User Data Directory
+    candidates = [os.path.join(get_models_dir(), filename)]
     
-    if 'CUDAExecutionProvider' in available:
-        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
-    elif 'CoreMLExecutionProvider' in available:
-        return ['CoreMLExecutionProvider', 'CPUExecutionProvider']
-    else:
-        return ['CPUExecutionProvider']
+    # 2. Bundled Resources
+    if getattr(sys, 'frozen', False):
+        candidates.append(os.path.join(sys._MEIPASS, "models", filename))
+    
+    # 3. Development / CWD locations
+    candidates.extend([
+        os.path.join("data", "models", filename),
+        os.path.join("models", filename),
+    ])
+    
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+def available_model_variants() -> Dict[str, str]:
+    """本机已存在的模型变体 {variant: path}"""
+    found = {}
+    for variant, filename in MODEL_VARIANTS.items():
+        path = find_model_file(filename)
+        if path:
+            found[variant] = path
+    return found
+
+def host_signature() -> Dict:
+    """autotune 结果仅对同一类主机有效"""
+    import platform
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "onnxruntime": ort.__version__,
+    }
+
+def load_autotune_result() -> Optional[Dict]:
+    path = os.path.join(get_models_dir(), AUTOTUNE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+    except Exception as e:
+        print(f"Failed to read autotune result {path}: {e}")
+        return None
+    if result.get("host") != host_signature():
+        print("Autotune result was produced on a different host/runtime, ignoring it")
+        return None
+    return result
+
+def resolve_model_variant(variant: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """
+    选择模型变体，优先级：显式参数 > 环境变量 LAYOUT_MODEL_VARIANT > 本机 autotune 结果 > fp32。
+    所选变体文件不存在时回退到 fp32。
+    """
+    source = "argument"
+    if not variant:
+        variant, source = os.environ.get("LAYOUT_MODEL_VARIANT"), "env"
+    if not variant:
+        tuned = load_autotune_result()
+        variant, source = (tuned or {}).get("selected"), "autotune"
+    if not variant:
+        variant, source = DEFAULT_MODEL_VARIANT, "default"
+    
+    if variant not in MODEL_VARIANTS:
+        print(f"Unknown model variant '{variant}' ({source}), falling back to {DEFAULT_MODEL_VARIANT}")
+        variant = DEFAULT_MODEL_VARIANT
+    
+    path = find_model_file(MODEL_VARIANTS[variant])
+    if path is None and variant != DEFAULT_MODEL_VARIANT:
+        print(f"Model variant '{variant}' not found, falling back to {DEFAULT_MODEL_VARIANT}")
+        variant = DEFAULT_MODEL_VARIANT
+        path = find_model_file(MODEL_VARIANTS[variant])
+    return variant, path
 
 class LayoutEngine:
-    def __init__(self, model_path=None, device=None):
+    def __init__(self, model_path=None, device=None, intra_op_num_threads=None, inter_op_num_threads=None, variant=None):
         if model_path is None:
-            base_data = os.environ.get("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
-            is_windows = sys.platform.startswith('win')
-            
-            # Model filename candidates
-            # Reverting back to original FP32 model as INT8 failed on Windows
-            model_filenames = ["yolov10-doclayout.onnx"]
-            
-            candidates = []
-            for filename in model_filenames:
-                # 1. User Data Directory
-                candidates.append(os.path.join(base_data, "models", filename))
-                
-                # 2. Bundled Resources
-                if getattr(sys, 'frozen', False):
-                    candidates.append(os.path.join(sys._MEIPASS, "models", filename))
-                
-                # 3. Development / CWD locations
-                candidates.extend([
-                    os.path.join("data", "models", filename),
-                    os.path.join("models", filename),
-                ])
-            
-            # Find the first existing path
-            for path in candidates:
-                if os.path.exists(path):
-                    model_path = path
-                    break
+            variant, model_path = resolve_model_variant(variant)
             
             # Fallback for error message if nothing found
             if model_path is None:
-                model_path = os.path.join(base_data, "models", "yolov10-doclayout.onnx")
+                model_path = os.path.join(get_models_dir(), MODEL_VARIANTS[variant])
+        else:
+            variant = variant or "custom"
+        
+        self.variant = variant
+        self.model_path = model_path
+        # 结果缓存键的一部分：模型文件被替换后旧缓存自动失效
+        try:
+            st = os.stat(model_path)
+            self.model_tag = f"{variant}:{os.path.basename(model_path)}:{st.st_size}:{int(st.st_mtime)}"
+        except OSError:
+            self.model_tag = f"{variant}:{os.path.basename(model_path)}"
         
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"MODEL_MISSING: {os.path.basename(model_path)}")
         
-        # 确定执行提供者
-        if device == 'cuda':
-            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        elif device == 'mps':
-            providers = ['CoreMLExecutionProvider', 'CPUExecutionProvider']
-        else:
-            providers = get_device_providers()
-        
-        print(f"Initializing LayoutEngine with providers: {providers}")
+        # 确定执行提供者与会话选项 (见 ort_profile)
+        profile = get_profile()
+        options = profile["options"]
+        providers = resolve_providers(options, device)
         
-        # 加载 ONNX 模型
-        sess_options = ort.SessionOptions()
-        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        print(f"Initializing LayoutEngine ({self.variant}: {os.path.basename(model_path)}) with providers: {providers}")
         
-        # CPU 性能优化：根据核心数设置线程
-        import multiprocessing
+        # CPU 性能优化：根据核心数设置线程 (会话池会按会话数切分线程预算)
         cpus = multiprocessing.cpu_count()
-        
-        # 优化策略：
-        # 1. 核心数 <= 4: 使用 cpus - 1, 留 1 核给 UI
-        # 2. 核心数 > 4: 使用 cpus // 2, 保持系统整体响应
-        if cpus <= 4:
-            threads = max(1, cpus - 1)
-        else:
-            threads = cpus // 2
-            
-        sess_options.intra_op_num_threads = threads
+        threads = intra_op_num_threads or options.get("intra_op_num_threads") or default_thread_budget()
+        inter_threads = inter_op_num_threads or options.get("inter_op_num_threads")
         print(f"CPU threads optimized: {threads} threads for {cpus} cores")
         
-        self.session = ort.InferenceSession(
-            model_path,
-            sess_options=sess_options,
-            providers=providers
+        # 加载 ONNX 模型
+        self.session, session_info = create_session(
+            model_path, self.model_tag, options, providers, threads, inter_threads
         )
+        self.session_info = {
+            "profile": profile["name"],
+            "providers": self.session.get_providers(),
+            "intra_op_num_threads": threads,
+            "inter_op_num_threads": inter_threads,
+            **session_info,
+        }
         
         # 获取模型输入输出信息
         self.input_name = self.session.get_inputs()[0].name
         self.output_names = [output.name for output in self.session.get_outputs()]
         
+        # 动态 batch 维度在 ONNX 中表现为字符串 (如 'batch') 或 None
+        input_shape = self.session.get_inputs()[0].shape
+        self.supports_dynamic_batch = not isinstance(input_shape[0], int)
+        self.input_size = input_shape[2] if isinstance(input_shape[2], int) else 1024
+        
+        # 复用的预处理缓冲区：池化会话由 checkout 独占，缓冲区挂在引擎上 (每会话一份)；
+        # 未池化的单例可能被多个线程并发调用，缓冲区按线程隔离
+        self.pooled = False
+        self._input = None
+        self._buffers = threading.local()
+        
         print(f"Model loaded successfully. Input: {self.input_name}")
         print(f"Active providers: {self.session.get_providers()}")
         
@@ -139,55 +286,77 @@ class LayoutEngine:
         
         return img
 
-    def preprocess_image(self, image: Union[str, Image.Image], imgsz: int = 1024, fast_mode: bool = False):
+    def _input_buffer(self, batch: int) -> np.ndarray:
+        """
+        获取复用的 NCHW float32 输入缓冲区 (按需扩容，不随请求重复分配)。
+        池化会话同一时刻只有一个借用者，整个引擎共用一份；未池化的引擎
+        (ORT 的同一 session 可被多个线程并发调用) 按线程隔离。
+        """
+        buf = self._input if self.pooled else getattr(self._buffers, 'input', None)
+        if buf is None or buf.shape[0] < batch:
+            buf = np.empty((batch, 3, self.input_size, self.input_size), dtype=np.float32)
+            if self.pooled:
+                self._input = buf
+            else:
+                self._buffers.input = buf
+        return buf[:batch]
+
+    def preprocess_image(self, image, imgsz: int = 1024, fast_mode: bool = False, out: np.ndarray = None):
         """
         预处理图像为 ONNX 模型输入格式
+        
+        image 支持文件路径、PIL Image、NumPy 数组 (HxWx3 RGB) 或 PyMuPDF Pixmap。
+        结果直接 letterbox 写入预分配缓冲区 out ([1, 3, H, W] 视图)；
+        未指定 out 时使用线程复用缓冲区，因此返回的数组在同线程下一次调用前有效。
         """
-        # 加载图像
-        if isinstance(image, str):
-            img = Image.open(image).convert('RGB')
-        else:
-            img = image.convert('RGB')
+        # 加载图像 (HxWx3 uint8 RGB)
+        img = to_rgb_array(image)
         
         # 应用图像增强策略 (fast_mode 时跳过以提升速度)
         if not fast_mode:
-            img = self.enhance_image(img)
+            img = np.asarray(self.enhance_image(Image.fromarray(img)))
         
         # 保存原始尺寸
-        orig_width, orig_height = img.size
+        orig_height, orig_width = img.shape[:2]
         
         # Resize 到模型输入尺寸 (强制 1024，因为现有模型不支持动态尺寸或 640)
         # 即使未来支持 640，此处的 imgsz 也应由模型输入决定
-        model_h, model_w = self.session.get_inputs()[0].shape[2:]
-        imgsz = model_h # Typically 1024
+        imgsz = self.input_size # Typically 1024
         
         scale = min(imgsz / orig_width, imgsz / orig_height)
         new_width = int(orig_width * scale)
         new_height = int(orig_height * scale)
         
-        # 使用更高效的插值方式 (fast_mode 下使用 BILINEAR, 正常模式使用 LANCZOS 提升精度)
-        # 注意：PIL.Image.BILINEAR 已经足够快，如果 fast_mode 开启，我们坚持使用它
-        resample_mode = Image.BILINEAR if fast_mode else Image.LANCZOS
-        img_resized = img.resize((new_width, new_height), resample_mode)
-        
-        # Pad 到正方形 (114, 114, 114) 是 YOLO 惯用填充色
-        img_padded = Image.new('RGB', (imgsz, imgsz), (114, 114, 114))
-        img_padded.paste(img_resized, (0, 0))
+        if out is None:
+            out = self._input_buffer(1)
+        canvas = out[0]
         
-        # 转换为 numpy 数组并归一化
-        img_array = np.array(img_padded).astype(np.float32) / 255.0
+        # 缩小时使用 INTER_AREA (抗锯齿，等价于 PIL resize 的效果)；
+        # 放大时 fast_mode 使用 INTER_LINEAR, 正常模式使用 LANCZOS4 提升精度
+        if scale < 1.0:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = cv2.INTER_LINEAR if fast_mode else cv2.INTER_LANCZOS4
+        if (new_width, new_height) == (orig_width, orig_height):
+            # 已按模型输入尺寸渲染 (如指纹快速路径)，只需 pad
+            img_resized = img
+        else:
+            img_resized = cv2.resize(img, (new_width, new_height), interpolation=interpolation)
         
-        # 转换为 CHW 格式
-        img_array = img_array.transpose(2, 0, 1)
+        # HWC -> CHW 直接写入缓冲区视图，并原地归一化
+        content = canvas[:, :new_height, :new_width]
+        content[...] = img_resized.transpose(2, 0, 1)
+        content /= 255.0
         
-        # 添加 batch 维度
-        img_array = np.expand_dims(img_array, axis=0)
+        # Pad 到正方形 (114, 114, 114) 是 YOLO 惯用填充色
+        canvas[:, new_height:, :] = _PAD_VALUE
+        canvas[:, :new_height, new_width:] = _PAD_VALUE
         
-        return img_array, scale, (orig_width, orig_height), (new_width, new_height)
+        return out, scale, (orig_width, orig_height), (new_width, new_height)
 
-    def postprocess_outputs(self, outputs, scale, orig_size, resized_size, conf=0.25, iou=0.45, imgsz=1280):
+    def postprocess_outputs(self, outputs, scale, orig_size, resized_size, conf=0.25, iou=0.45, imgsz=1280, agnostic_nms=False):
         """
-        后处理 ONNX 模型输出
+        后处理 ONNX 模型输出 (全向量化)
         """
         # YOLOv10 输出格式处理
         # 兼容两种格式：
@@ -203,94 +372,242 @@ class LayoutEngine:
             predictions = raw_output[0]
             print(f"Detected standard output format: {raw_output.shape}")
 
-        resized_w, resized_h = resized_size
-        boxes = []
-        
-        for pred in predictions:
-            if len(pred) == 6:
-                # 已经过 NMS 的格式
-                x1, y1, x2, y2, confidence, cls_id = pred
-            elif len(pred) == 14:
-                # 未过 NMS 的原始格式 [x_center, y_center, w, h, score0...score9]
-                # 注意：YOLOv10 原始输出每个 anchor 只有一个最高分类别，或者需要我们计算
-                # 这里假设前 4 位是 box，后 10 位是类别置信度
-                box = pred[:4]
-                scores = pred[4:]
-                cls_id = np.argmax(scores)
-                confidence = scores[cls_id]
-                
-                if confidence < conf:
-                    continue
-                
-                # xywh 转 x1y1x2y2
-                xc, yc, w, h = box
-                x1, y1, x2, y2 = xc - w/2, yc - h/2, xc + w/2, yc + h/2
-            else:
-                continue
-            
-            # 置信度过滤 (如果上面没过滤)
-            if confidence < conf:
-                continue
-            
-            # 使用实际缩放后尺寸归一化（关键修复）
-            # YOLO 输出的坐标是相对于 imgsz x imgsz 画布的绝对像素值
-            # 但图像只占据画布的 (0,0) 到 (resized_w, resized_h) 区域
-            x1_norm = x1 / resized_w
-            y1_norm = y1 / resized_h
-            x2_norm = x2 / resized_w
-            y2_norm = y2 / resized_h
+        if predictions.ndim != 2 or predictions.shape[1] not in (6, 14):
+            return []
+
+        if predictions.shape[1] == 6:
+            # 已经过 NMS 的格式
+            confidence = predictions[:, 4]
+            mask = confidence >= conf
+            xyxy = predictions[mask, :4].astype(np.float64)
+            confidence = confidence[mask]
+            cls_ids = predictions[mask, 5].astype(np.int64)
+        else:
+            # 未过 NMS 的原始格式 [x_center, y_center, w, h, score0...score9]
+            # 每个 anchor 取最高分类别，先做置信度筛选再做坐标转换，避免处理全部 21504 个 anchor
+            scores = predictions[:, 4:]
+            cls_ids = np.argmax(scores, axis=1)
+            confidence = scores[np.arange(len(scores)), cls_ids]
+            mask = confidence >= conf
             
-            # 裁剪到 [0, 1] 范围
-            x1_norm = max(0.0, min(1.0, x1_norm))
-            y1_norm = max(0.0, min(1.0, y1_norm))
-            x2_norm = max(0.0, min(1.0, x2_norm))
-            y2_norm = max(0.0, min(1.0, y2_norm))
+            cls_ids = cls_ids[mask]
+            confidence = confidence[mask]
+            xyxy = xywh_to_xyxy(predictions[mask, :4].astype(np.float64))
             
-            w_norm = x2_norm - x1_norm
-            h_norm = y2_norm - y1_norm
+            # 原始输出未经过 NMS，此处执行按类别的 NMS (保持 anchor 原始顺序)
+            keep = np.sort(batched_nms(xyxy, confidence, cls_ids, iou, agnostic=agnostic_nms))
+            xyxy, confidence, cls_ids = xyxy[keep], confidence[keep], cls_ids[keep]
+
+        if len(xyxy) == 0:
+            return []
+
+        # 使用实际缩放后尺寸归一化（关键修复）
+        # YOLO 输出的坐标是相对于 imgsz x imgsz 画布的绝对像素值
+        # 但图像只占据画布的 (0,0) 到 (resized_w, resized_h) 区域
+        resized_w, resized_h = resized_size
+        norm = np.array([resized_w, resized_h, resized_w, resized_h], dtype=np.float64)
+        
+        # 裁剪到 [0, 1] 范围
+        xyxy_norm = np.clip(xyxy / norm, 0.0, 1.0)
+        w_norm = xyxy_norm[:, 2] - xyxy_norm[:, 0]
+        
+        # === Heuristic Correction for Manufacturing Documents ===
+        # 制造业单据优化：
+        # 1. 如果识别为"图片" (id=3) 且宽度较大 (>50% 页面宽度)，通常是通栏的表格或表单，强转为 Table
+        # 2. 如果识别为"图片" (id=3) 但置信度不高，弱图片检测可能是表格，倾向于认为是表格
+        to_table = (cls_ids == 3) & ((w_norm > 0.5) | (confidence < 0.6))
+        if to_table.any():
+            print(f"Heuristic: Converting {int(to_table.sum())} Figure(s) to Table")
+            cls_ids = np.where(to_table, 5, cls_ids)
+        
+        return [
+            {
+                'x1': x1,
+                'y1': y1,
+                'x2': x2,
+                'y2': y2,
+                'confidence': c,
+                'class_id': k
+            }
+            for (x1, y1, x2, y2), c, k in zip(xyxy_norm.tolist(), confidence.astype(np.float64).tolist(), cls_ids.tolist())
+        ]
+
+    def _cache_key(self, image, array, conf, iou, imgsz, fast_mode, agnostic_nms, mode="") -> str:
+        return get_layout_cache().make_key(
+            image_digest(image, array), self.model_tag + mode, conf, iou, imgsz, fast_mode, agnostic_nms
+        )
+
+    def _infer_arrays(self, arrays, conf, imgsz, iou, agnostic_nms, fast_mode, max_batch_size) -> List[List[Dict]]:
+        """
+        分块批量推理，返回与 arrays 一一对应的 boxes (postprocess_outputs 格式)。
+        
+        模型支持动态 batch 时，将最多 max_batch_size 张堆叠为 [N, 3, H, W] 单次推理；
+        否则退化为逐张推理，但仍按 max_batch_size 分块以限制预处理内存峰值。
+        """
+        results = []
+        for chunk_start in range(0, len(arrays), max_batch_size):
+            chunk = arrays[chunk_start:chunk_start + max_batch_size]
+            # 每张直接 letterbox 写入批量缓冲区的对应槽位，无需再拼接
+            batch = self._input_buffer(len(chunk))
+            prepared = [
+                self.preprocess_image(img, imgsz, fast_mode=fast_mode, out=batch[i:i + 1])
+                for i, img in enumerate(chunk)
+            ]
             
-            # === Heuristic Correction for Manufacturing Documents ===
-            # 制造业单据优化：
-            # 1. 如果识别为"图片" (id=3) 且宽度较大 (>50% 页面宽度)，通常是通栏的表格或表单，强转为 Table
-            if int(cls_id) == 3 and w_norm > 0.5:
-                 print(f"Heuristic: Converting widespread Figure to Table (w={w_norm:.2f})")
-                 cls_id = 5 # Switch to Table
-            # 2. 如果识别为"图片" (id=3) 但看起来很有可能是表格，且置信度不高，倾向于认为是表格
-            elif int(cls_id) == 3 and confidence < 0.6:
-                 # 弱图片检测可能是表格
-                 cls_id = 5
+            if self.supports_dynamic_batch and len(prepared) > 1:
+                outputs = self.session.run(None, {self.input_name: batch})
+                per_image_outputs = [[out[i:i + 1] for out in outputs] for i in range(len(prepared))]
+            else:
+                per_image_outputs = [self.session.run(None, {self.input_name: p[0]}) for p in prepared]
             
-            boxes.append({
-                'x1': float(x1_norm),
-                'y1': float(y1_norm),
-                'x2': float(x2_norm),
-                'y2': float(y2_norm),
-                'confidence': float(confidence),
-                'class_id': int(cls_id)
-            })
-        
-        # NMS (简化版本，ONNX 模型通常已内置 NMS)
-        return boxes
+            for (input_data, scale, orig_size, resized_size), outputs in zip(prepared, per_image_outputs):
+                results.append(self.postprocess_outputs(outputs, scale, orig_size, resized_size, conf, iou, imgsz, agnostic_nms=agnostic_nms))
+        return results
 
-    def predict(self, image_path, device=None, conf=0.25, imgsz=1024, iou=0.45, agnostic_nms=False, fast_mode=False):
+    def predict(self, image_path, device=None, conf=0.25, imgsz=1024, iou=0.45, agnostic_nms=False, fast_mode=False,
+                use_cache=True, tiling="off", dpi=None):
         """
-        预测布局区域
+        预测布局区域 (相同像素 + 相同参数的结果从 layout_cache 复用)
+        
+        tiling: off | auto | on，大幅面图纸见 predict_tiled；
+        dpi 用于判断物理幅面，默认取自 PageRaster
         """
+        source = image_path if isinstance(image_path, str) else type(image_path).__name__
+        image = to_rgb_array(image_path)
+        
+        if tiling != "off":
+            tiles = plan_tiles(image.shape[1], image.shape[0], dpi or source_dpi(image_path), self.input_size, tiling)
+            if tiles:
+                return self.predict_tiled(image_path, tiles, conf=conf, imgsz=imgsz, iou=iou, agnostic_nms=agnostic_nms,
+                                          fast_mode=fast_mode, use_cache=use_cache, image=image)
+        
+        cache = get_layout_cache() if use_cache else None
+        if cache is not None:
+            cache_key = self._cache_key(image_path, image, conf, iou, imgsz, fast_mode, agnostic_nms)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print(f"Layout cache hit: {len(cached)} regions in {source}")
+                return cached
+        
         if fast_mode:
             print(f"Running ONNX prediction in FAST MODE (conf={conf})")
         else:
             print(f"Running ONNX prediction (conf={conf}, imgsz={imgsz})")
         
         # 预处理 (Use updated imgsz)
-        input_data, scale, orig_size, resized_size = self.preprocess_image(image_path, imgsz, fast_mode=fast_mode)
+        input_data, scale, orig_size, resized_size = self.preprocess_image(image, imgsz, fast_mode=fast_mode)
         
         # 推理
         outputs = self.session.run(None, {self.input_name: input_data})
         
         # 后处理
-        boxes = self.postprocess_outputs(outputs, scale, orig_size, resized_size, conf, iou, imgsz)
+        boxes = self.postprocess_outputs(outputs, scale, orig_size, resized_size, conf, iou, imgsz, agnostic_nms=agnostic_nms)
         
-        # 转换为项目格式
+        regions = self._boxes_to_regions(boxes)
+        if cache is not None:
+            cache.put(cache_key, regions)
+        
+        print(f"Detected {len(regions)} regions in {source}")
+        return regions
+
+    def predict_tiled(self, image_path, tiles=None, device=None, conf=0.25, imgsz=1024, iou=0.45, agnostic_nms=False,
+                      fast_mode=False, use_cache=True, merge=None, max_batch_size=None, image=None):
+        """
+        大幅面切片推理 (A0/A1 工程图纸等)：
+        整页缩略图 + 重叠切片一并分批推理，空白切片直接跳过；
+        切片内贴着内部接缝的框视为被截断而丢弃 (完整目标由相邻切片或整页结果提供)，
+        其余框映射回整页坐标后按 WBF (默认) 或 NMS 融合。
+        """
+        source = image_path if isinstance(image_path, str) else type(image_path).__name__
+        if image is None:
+            image = to_rgb_array(image_path)
+        height, width = image.shape[:2]
+        if tiles is None:
+            tiles = plan_tiles(width, height, source_dpi(image_path), self.input_size, "on")
+        merge = merge or os.environ.get("LAYOUT_TILE_MERGE", "wbf")
+        if max_batch_size is None:
+            max_batch_size = int(os.environ.get("LAYOUT_MAX_BATCH", "4"))
+        
+        cache = get_layout_cache() if use_cache else None
+        if cache is not None:
+            cache_key = self._cache_key(image_path, image, conf, iou, imgsz, fast_mode, agnostic_nms,
+                                        mode=f"|tiled:{merge}:{tiles}")
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print(f"Layout cache hit (tiled): {len(cached)} regions in {source}")
+                return cached
+        
+        blank_ink = float(os.environ.get("LAYOUT_TILE_BLANK_INK", "0.0005"))
+        windows = [(0, 0, width, height)]
+        windows += [t for t in tiles if not _is_blank(image[t[1]:t[3], t[0]:t[2]], blank_ink)]
+        print(f"Running tiled ONNX prediction: {len(windows) - 1}/{len(tiles)} non-blank tiles + full page "
+              f"({width}x{height}, conf={conf})")
+        
+        crops = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in windows]
+        per_window = self._infer_arrays(crops, conf, imgsz, iou, agnostic_nms, fast_mode, max(1, max_batch_size))
+        
+        boxes = _merge_window_boxes(per_window, windows, width, height, iou, merge)
+        regions = self._boxes_to_regions(boxes)
+        if cache is not None:
+            cache.put(cache_key, regions)
+        
+        print(f"Detected {len(regions)} regions in {source} (tiled)")
+        return regions
+
+    def predict_batch(self, images, device=None, conf=0.25, imgsz=1024, iou=0.45, agnostic_nms=False,
+                      fast_mode=False, max_batch_size=None, use_cache=True, tiling="off", dpis=None):
+        """
+        多页批量预测布局区域，返回与 images 一一对应的 regions 列表。
+        已缓存的页面不参与推理；需要切片的大幅面页面单独走 predict_tiled。
+        """
+        sources = list(images)
+        if not sources:
+            return []
+        
+        if max_batch_size is None:
+            max_batch_size = int(os.environ.get("LAYOUT_MAX_BATCH", "4"))
+        max_batch_size = max(1, max_batch_size)
+        
+        images = [to_rgb_array(img) for img in sources]
+        results: List[Optional[List[Dict]]] = [None] * len(images)
+        
+        if tiling != "off":
+            for i, (src, img) in enumerate(zip(sources, images)):
+                dpi = (dpis[i] if dpis else None) or source_dpi(src)
+                tiles = plan_tiles(img.shape[1], img.shape[0], dpi, self.input_size, tiling)
+                if tiles:
+                    results[i] = self.predict_tiled(src, tiles, conf=conf, imgsz=imgsz, iou=iou, agnostic_nms=agnostic_nms,
+                                                    fast_mode=fast_mode, use_cache=use_cache,
+                                                    max_batch_size=max_batch_size, image=img)
+        
+        cache = get_layout_cache() if use_cache else None
+        cache_keys = {}
+        if cache is not None:
+            for i, (src, img) in enumerate(zip(sources, images)):
+                if results[i] is None:
+                    cache_keys[i] = self._cache_key(src, img, conf, iou, imgsz, fast_mode, agnostic_nms)
+                    results[i] = cache.get(cache_keys[i])
+        
+        pending = [i for i, r in enumerate(results) if r is None]
+        print(f"Running ONNX batch prediction: {len(pending)}/{len(images)} pages pending "
+              f"(dynamic_batch={self.supports_dynamic_batch}, max_batch={max_batch_size}, conf={conf})")
+        
+        per_page_boxes = self._infer_arrays([images[i] for i in pending], conf, imgsz, iou, agnostic_nms, fast_mode, max_batch_size)
+        for page_i, boxes in zip(pending, per_page_boxes):
+            results[page_i] = self._boxes_to_regions(boxes)
+            if cache is not None:
+                cache.put(cache_keys[page_i], results[page_i])
+        
+        print(f"Detected {[len(r) for r in results]} regions across {len(results)} pages")
+        return results
+
+    def warm_up(self):
+        """空白页空推理一次：触发图优化、内存 arena 分配与预处理缓冲区创建"""
+        blank = np.full((self.input_size, int(self.input_size * 0.707), 3), 255, dtype=np.uint8)
+        self.predict(blank, fast_mode=True, use_cache=False)
+
+    def _boxes_to_regions(self, boxes: List[Dict]) -> List[Dict]:
+        """转换为项目格式"""
         regions = []
         for i, box in enumerate(boxes):
             cls_id = box['class_id']
@@ -305,15 +622,311 @@ class LayoutEngine:
                 "height": float(box['y2'] - box['y1']),
                 "label": label
             })
-        
-        print(f"Detected {len(regions)} regions in {image_path}")
         return regions
 
+def source_dpi(image) -> Optional[float]:
+    """PDF 渲染栅格的 DPI (用于换算物理尺寸)；上传的图片未知时返回 None"""
+    raster = image if isinstance(image, PageRaster) else (get_page_raster(image) if isinstance(image, str) else None)
+    return raster.dpi if raster is not None else None
+
+def _tile_starts(length: int, tile: int, overlap: float) -> List[int]:
+    if length <= tile:
+        return [0]
+    stride = tile * (1.0 - overlap)
+    n = int(np.ceil((length - tile) / stride)) + 1
+    return np.linspace(0, length - tile, n).round().astype(int).tolist()
+
+def plan_tiles(width: int, height: int, dpi: Optional[float] = None, imgsz: int = 1024, tiling: str = "auto") -> List[Tuple[int, int, int, int]]:
+    """
+    根据页面尺寸规划切片窗口 [(x0, y0, x1, y1), ...]，无需切片时返回 []。
+    
+    auto: 整页缩放倍数 > LAYOUT_TILE_TRIGGER_SCALE (默认 2.5) 且物理长边 >= LAYOUT_TILE_MIN_MM
+          (默认 594mm，即 A2 及以上) 时切片；DPI 未知时要求缩放倍数再翻倍
+    on:   整页需要缩小即切片
+    
+    切片边长 = imgsz * LAYOUT_TILE_SCALE (默认 2.0)，相邻切片重叠 LAYOUT_TILE_OVERLAP (默认 0.2)；
+    切片数超过 LAYOUT_MAX_TILES (默认 16) 时逐步放大切片。
+    """
+    long_side = max(width, height)
+    downscale = long_side / float(imgsz)
+    if tiling == "off" or downscale <= 1.0:
+        return []
+    
+    if tiling == "auto":
+        trigger = float(os.environ.get("LAYOUT_TILE_TRIGGER_SCALE", "2.5"))
+        if dpi:
+            long_mm = long_side / dpi * 25.4
+            if downscale <= trigger or long_mm < float(os.environ.get("LAYOUT_TILE_MIN_MM", "594")):
+                return []
+        elif downscale <= trigger * 2:
+            return []
+    
+    overlap = float(os.environ.get("LAYOUT_TILE_OVERLAP", "0.2"))
+    max_tiles = max(1, int(os.environ.get("LAYOUT_MAX_TILES", "16")))
+    tile = int(imgsz * float(os.environ.get("LAYOUT_TILE_SCALE", "2.0")))
+    while True:
+        xs = _tile_starts(width, tile, overlap)
+        ys = _tile_starts(height, tile, overlap)
+        if len(xs) * len(ys) <= max_tiles or tile >= long_side:
+            break
+        tile = int(tile * 1.25)
+    if len(xs) * len(ys) <= 1:
+        return []
+    return [(x, y, min(x + tile, width), min(y + tile, height)) for y in ys for x in xs]
+
+def _is_blank(tile: np.ndarray, max_ink: float) -> bool:
+    """稀疏采样判断切片是否空白 (墨迹像素占比低于 max_ink)"""
+    sample = tile[::4, ::4]
+    if sample.size == 0:
+        return True
+    return float((sample.min(axis=2) < 200).mean()) < max_ink
+
+def _merge_window_boxes(per_window: List[List[Dict]], windows, width: int, height: int,
+                        iou: float, merge: str = "wbf") -> List[Dict]:
+    """
+    将各窗口 (首个为整页) 的归一化框映射回整页坐标并融合。
+    切片中贴着内部接缝 (非页面边界) 的框视为截断框丢弃。
+    """
+    edge_tol = 0.005
+    xyxy_list, conf_list, cls_list = [], [], []
+    for w_idx, (boxes, (x0, y0, x1, y1)) in enumerate(zip(per_window, windows)):
+        if not boxes:
+            continue
+        b = np.array([[d['x1'], d['y1'], d['x2'], d['y2']] for d in boxes], dtype=np.float64)
+        c = np.array([d['confidence'] for d in boxes], dtype=np.float64)
+        k = np.array([d['class_id'] for d in boxes], dtype=np.int64)
+        
+        if w_idx > 0:
+            truncated = np.zeros(len(b), dtype=bool)
+            if x0 > 0:
+                truncated |= b[:, 0] <= edge_tol
+            if y0 > 0:
+                truncated |= b[:, 1] <= edge_tol
+            if x1 < width:
+                truncated |= b[:, 2] >= 1.0 - edge_tol
+            if y1 < height:
+                truncated |= b[:, 3] >= 1.0 - edge_tol
+            b, c, k = b[~truncated], c[~truncated], k[~truncated]
+        
+        win = np.array([x1 - x0, y1 - y0, x1 - x0, y1 - y0], dtype=np.float64)
+        offset = np.array([x0, y0, x0, y0], dtype=np.float64)
+        xyxy_list.append(b * win + offset)
+        conf_list.append(c)
+        cls_list.append(k)
+    
+    if not xyxy_list:
+        return []
+    xyxy = np.concatenate(xyxy_list)
+    confidence = np.concatenate(conf_list)
+    cls_ids = np.concatenate(cls_list)
+    
+    if merge == "nms":
+        keep = batched_nms(xyxy, confidence, cls_ids, iou)
+        xyxy, confidence, cls_ids = xyxy[keep], confidence[keep], cls_ids[keep]
+    else:
+        wbf_iou = float(os.environ.get("LAYOUT_TILE_WBF_IOU", "0.55"))
+        xyxy, confidence, cls_ids = weighted_boxes_fusion(xyxy, confidence, cls_ids, wbf_iou)
+    
+    norm = np.array([width, height, width, height], dtype=np.float64)
+    xyxy_norm = np.clip(xyxy / norm, 0.0, 1.0)
+    return [
+        {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'confidence': cf, 'class_id': k}
+        for (x1, y1, x2, y2), cf, k in zip(xyxy_norm.tolist(), confidence.tolist(), cls_ids.tolist())
+    ]
+
+class PoolSaturatedError(RuntimeError):
+    """会话池已饱和 (等待者过多或等待超时)"""
+    pass
+
+class LayoutEnginePool:
+    """
+    LayoutEngine 会话池：N 个独立 ONNX 会话，每个会话分配 intra/inter-op 线程，
+    通过 checkout/checkin 并发使用，避免多个请求挤占同一会话导致线程超额订阅。
+    
+    配置 (环境变量):
+        LAYOUT_POOL_SIZE           会话数 (默认 1)
+        LAYOUT_POOL_INTRA_THREADS  每会话 intra-op 线程数 (默认 ort_profile 设置，否则 线程预算 // 会话数)
+        LAYOUT_POOL_INTER_THREADS  每会话 inter-op 线程数 (默认 ort_profile 设置，否则 ORT 默认值)
+        LAYOUT_POOL_TIMEOUT        checkout 最长等待秒数 (默认 30)
+        LAYOUT_POOL_MAX_WAITERS    最大排队数，超过即拒绝 (默认 会话数 * 4)
+    """
+    def __init__(self, size=None, intra_op_num_threads=None, inter_op_num_threads=None,
+                 acquire_timeout=None, max_waiters=None, model_path=None, device=None):
+        self.size = max(1, int(size or os.environ.get("LAYOUT_POOL_SIZE", "1")))
+        profile_options = get_profile()["options"]
+        self.intra_op_num_threads = int(
+            intra_op_num_threads
+            or os.environ.get("LAYOUT_POOL_INTRA_THREADS", 0)
+            or profile_options.get("intra_op_num_threads")
+            or max(1, default_thread_budget() // self.size)
+        )
+        self.inter_op_num_threads = int(
+            inter_op_num_threads
+            or os.environ.get("LAYOUT_POOL_INTER_THREADS", 0)
+            or profile_options.get("inter_op_num_threads")
+            or 0
+        ) or None
+        self.acquire_timeout = float(acquire_timeout if acquire_timeout is not None else os.environ.get("LAYOUT_POOL_TIMEOUT", "30"))
+        self.max_waiters = int(max_waiters if max_waiters is not None else os.environ.get("LAYOUT_POOL_MAX_WAITERS", self.size * 4))
+        self.model_path = model_path
+        self.device_request = device
+        
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._waiting = 0
+        
+        # Metrics
+        self._checkouts = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        
+        print(f"Initializing LayoutEnginePool: size={self.size}, intra_threads={self.intra_op_num_threads}, "
+              f"inter_threads={self.inter_op_num_threads}")
+        
+        # 预先创建首个会话 (模型缺失时尽早报错)，其余会话按需创建
+        first = self._create_engine()
+        self._created = 1
+        self.device = first.device
+        self.variant = first.variant
+        self.session_info = first.session_info
+        self._idle.put(first)
+
+    def _create_engine(self) -> LayoutEngine:
+        engine = LayoutEngine(
+            model_path=self.model_path,
+            device=self.device_request,
+            intra_op_num_threads=self.intra_op_num_threads,
+            inter_op_num_threads=self.inter_op_num_threads
+        )
+        # 只通过 checkout 独占使用，预处理缓冲区挂在引擎上
+        engine.pooled = True
+        return engine
+
+    def _acquire(self, timeout=None) -> LayoutEngine:
+        timeout = self.acquire_timeout if timeout is None else timeout
+        with self._lock:
+            if self._waiting >= self.max_waiters:
+                self._rejected += 1
+                raise PoolSaturatedError(f"Layout pool saturated: {self._waiting} requests waiting")
+            self._waiting += 1
+        
+        start = time.perf_counter()
+        try:
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                engine = None
+                with self._lock:
+                    can_grow = self._created < self.size
+                    if can_grow:
+                        # 预占名额，避免并发扩容超过 size
+                        self._created += 1
+                if can_grow:
+                    try:
+                        engine = self._create_engine()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                else:
+                    try:
+                        engine = self._idle.get(timeout=timeout)
+                    except queue.Empty:
+                        with self._lock:
+                            self._rejected += 1
+                        raise PoolSaturatedError(f"No layout session available within {timeout}s")
+        finally:
+            waited = time.perf_counter() - start
+            with self._lock:
+                self._waiting -= 1
+        
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return engine
+
+    def _release(self, engine: LayoutEngine):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(engine)
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        """
+        借出一个会话，使用完毕自动归还::
+        
+            with get_layout_pool().checkout() as engine:
+                regions = engine.predict(image)
+        """
+        engine = self._acquire(timeout)
+        try:
+            yield engine
+        finally:
+            self._release(engine)
+
+    def predict(self, image, **kwargs):
+        with self.checkout() as engine:
+            return engine.predict(image, **kwargs)
+
+    def predict_batch(self, images, **kwargs):
+        with self.checkout() as engine:
+            return engine.predict_batch(images, **kwargs)
+
+    def warm_up(self):
+        """创建全部会话并逐个预热 (启动时由 warmup 后台线程调用)"""
+        engines = []
+        try:
+            for _ in range(self.size):
+                engines.append(self._acquire())
+            for engine in engines:
+                engine.warm_up()
+        finally:
+            for engine in engines:
+                self._release(engine)
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "rejected": self._rejected,
+                "wait_time_total": round(self._wait_total, 4),
+                "wait_time_avg": round(self._wait_total / self._checkouts, 4) if self._checkouts else 0.0,
+                "wait_time_max": round(self._wait_max, 4),
+                "model_variant": self.variant,
+                "intra_op_num_threads": self.intra_op_num_threads,
+                "inter_op_num_threads": self.inter_op_num_threads,
+                "session": self.session_info,
+            }
+
 # 全局单例
 _engine = None
+_pool = None
+_pool_lock = threading.Lock()
 
 def get_layout_engine():
     global _engine
     if _engine is None:
         _engine = LayoutEngine()
     return _engine
+
+def get_layout_pool() -> LayoutEnginePool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = LayoutEnginePool()
+    return _pool
+
+def get_layout_pool_metrics() -> Optional[Dict]:
+    """会话池指标 (未初始化时返回 None，不触发模型加载)"""
+    return _pool.metrics() if _pool is not None else None
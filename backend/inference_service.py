@@ -0,0 +1,226 @@
+"""
+Out-of-process inference service for the layout (ONNX) and OCR (RapidOCR) models.
+
+When enabled (INFERENCE_WORKERS > 0), model work runs in a pool of worker
+processes instead of the uvicorn process, so it no longer competes with the
+event loop and GIL-bound pdfplumber parsing. Each worker loads its models once
+in the pool initializer; page pixels are handed over through shared memory and
+only the (small) region / OCR results are pickled back.
+
+Configuration (environment variables):
+    INFERENCE_WORKERS          number of worker processes (0 = disabled, default)
+    INFERENCE_WORKER_THREADS   intra-op threads per worker (default: budget // workers)
+    INFERENCE_MAX_PENDING      max in-flight requests before rejecting (default: workers * 4)
+
+Callers should use predict_layout / predict_layout_batch, which fall back to
+the in-process LayoutEnginePool when the service is disabled;
+ocr_utils.run_ocr_on_image dispatches to the service on its own.
+"""
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from inference import (
+    PoolSaturatedError, default_thread_budget, get_device_providers, get_layout_pool, source_dpi, to_rgb_array,
+)
+from utils import get_page_raster
+
+# ========== Worker side ==========
+
+_IN_WORKER = False
+_worker_engine = None
+
+
+def _worker_init(intra_threads: int):
+    """进程池初始化：每个 worker 只加载一次模型"""
+    global _IN_WORKER, _worker_engine
+    _IN_WORKER = True
+    from inference import LayoutEngine
+    _worker_engine = LayoutEngine(intra_op_num_threads=intra_threads)
+
+
+def _attach(spec: Tuple[str, Tuple[int, ...], str]):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shm, arr
+
+
+def _worker_predict(specs: List[Tuple], kwargs: Dict, batch: bool):
+    shms, images = [], []
+    for spec in specs:
+        shm, arr = _attach(spec)
+        shms.append(shm)
+        images.append(arr)
+    try:
+        if batch:
+            return _worker_engine.predict_batch(images, **kwargs)
+        return _worker_engine.predict(images[0], **kwargs)
+    finally:
+        # 释放对共享内存的引用后再关闭映射
+        images.clear()
+        arr = None
+        for shm in shms:
+            shm.close()
+
+
+def _worker_warmup():
+    """预热 worker 内的版面与 OCR 会话"""
+    _worker_engine.warm_up()
+    if os.environ.get("WARMUP_OCR", "1").lower() not in ("0", "false", "no"):
+        from ocr_utils import run_ocr_on_image
+        run_ocr_on_image(np.full((64, 256, 3), 255, dtype=np.uint8))
+    return os.getpid()
+
+
+def _worker_ocr(spec_or_path):
+    from ocr_utils import run_ocr_on_image
+    if isinstance(spec_or_path, str):
+        return run_ocr_on_image(spec_or_path)
+    shm, arr = _attach(spec_or_path)
+    try:
+        # RapidOCR 可能持有输入引用，拷贝一份后再释放共享内存
+        return run_ocr_on_image(np.array(arr))
+    finally:
+        arr = None
+        shm.close()
+
+
+# ========== Client side ==========
+
+class InferenceService:
+    """基于 ProcessPoolExecutor 的推理服务 (spawn 模式，兼容 Windows / macOS 打包环境)"""
+
+    def __init__(self, workers: int, intra_threads: Optional[int] = None, max_pending: Optional[int] = None):
+        self.workers = max(1, workers)
+        self.intra_threads = intra_threads or max(1, default_thread_budget() // self.workers)
+        self.max_pending = max_pending or self.workers * 4
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_worker_init,
+            initargs=(self.intra_threads,)
+        )
+        print(f"Inference service started: {self.workers} workers x {self.intra_threads} threads")
+
+    @staticmethod
+    def _share(array: np.ndarray):
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        del view
+        return shm, (shm.name, array.shape, array.dtype.str)
+
+    def _submit(self, fn, *args, shared=()):
+        # 背压：在途请求过多时直接拒绝，而不是无限排队
+        if not self._slots.acquire(blocking=False):
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+            raise PoolSaturatedError(f"Inference service saturated: {self.max_pending} requests in flight")
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+
+    def predict(self, image, **kwargs) -> List[Dict]:
+        # 栅格 DPI 不随共享内存传递，切片规划需要时显式带上
+        if kwargs.get("tiling", "off") != "off" and not kwargs.get("dpi"):
+            kwargs["dpi"] = source_dpi(image)
+        shm, spec = self._share(to_rgb_array(image))
+        return self._submit(_worker_predict, [spec], kwargs, False, shared=(shm,))
+
+    def predict_batch(self, images, **kwargs) -> List[List[Dict]]:
+        images = list(images)
+        if kwargs.get("tiling", "off") != "off" and not kwargs.get("dpis"):
+            kwargs["dpis"] = [source_dpi(img) for img in images]
+        shared = [self._share(to_rgb_array(img)) for img in images]
+        return self._submit(
+            _worker_predict, [spec for _, spec in shared], kwargs, True,
+            shared=tuple(shm for shm, _ in shared)
+        )
+
+    def ocr(self, image: Union[str, np.ndarray]):
+        if isinstance(image, str):
+            raster = get_page_raster(image)
+            if raster is None:
+                # 页面不在本进程内存中，由 worker 直接读取文件
+                return self._submit(_worker_ocr, image)
+            image = raster.bgr()
+        shm, spec = self._share(image)
+        return self._submit(_worker_ocr, spec, shared=(shm,))
+
+    def warm_up(self):
+        """同时提交 workers 个预热任务，拉起并预热所有 worker 进程"""
+        futures = [self._executor.submit(_worker_warmup) for _ in range(self.workers)]
+        pids = {f.result() for f in futures}
+        print(f"Inference service warmed up: {len(pids)} worker process(es)")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_inference_service() -> Optional[InferenceService]:
+    """INFERENCE_WORKERS > 0 时返回全局服务实例；worker 进程内始终返回 None"""
+    global _service
+    if _IN_WORKER:
+        return None
+    workers = int(os.environ.get("INFERENCE_WORKERS", "0") or 0)
+    if workers <= 0:
+        return None
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                threads = int(os.environ.get("INFERENCE_WORKER_THREADS", "0") or 0) or None
+                pending = int(os.environ.get("INFERENCE_MAX_PENDING", "0") or 0) or None
+                _service = InferenceService(workers, intra_threads=threads, max_pending=pending)
+    return _service
+
+
+def shutdown_inference_service():
+    global _service
+    if _service is not None:
+        _service.shutdown()
+        _service = None
+
+
+def predict_layout(image, **kwargs) -> List[Dict]:
+    """版面推理：优先进程池服务，否则使用进程内会话池"""
+    service = get_inference_service()
+    if service is not None:
+        return service.predict(image, **kwargs)
+    return get_layout_pool().predict(image, **kwargs)
+
+
+def predict_layout_batch(images, **kwargs) -> List[List[Dict]]:
+    service = get_inference_service()
+    if service is not None:
+        return service.predict_batch(images, **kwargs)
+    return get_layout_pool().predict_batch(images, **kwargs)
+
+
+def layout_device() -> str:
+    """当前版面推理使用的设备 (服务模式下不在 API 进程内加载模型)"""
+    if get_inference_service() is not None:
+        providers = get_device_providers()
+        if 'CUDAExecutionProvider' in providers:
+            return 'cuda'
+        if 'CoreMLExecutionProvider' in providers:
+            return 'mps'
+        return 'cpu'
+    return get_layout_pool().device
@@ -0,0 +1,183 @@
+"""
+Layout detection result cache.
+
+Results of LayoutEngine.predict are keyed by the page pixel content hash plus
+everything that changes the output (model variant, conf, iou, imgsz,
+fast_mode, agnostic_nms), so re-uploads, template editing sessions and
+fingerprint extraction of an already-seen page never run inference twice.
+
+Two tiers:
+    memory  per-process LRU (LAYOUT_CACHE_MEM_ENTRIES, default 256)
+    disk    JSON files under <APP_DATA_DIR>/cache/layout, shared by all
+            processes and evicted oldest-first once LAYOUT_CACHE_DISK_MB
+            (default 64) is exceeded
+
+Set LAYOUT_CACHE_ENABLED=0 to disable.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils import PageRaster, array_digest, get_page_raster
+
+logger = logging.getLogger("backend.layout_cache")
+
+base_data = os.environ.get("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+LAYOUT_CACHE_DIR = os.path.join(base_data, "cache", "layout")
+
+
+def image_digest(image, array: np.ndarray) -> str:
+    """优先复用 PageRaster 上已计算的哈希，否则对解码后的像素求哈希"""
+    raster = image if isinstance(image, PageRaster) else (get_page_raster(image) if isinstance(image, str) else None)
+    if raster is not None:
+        return raster.content_hash()
+    return array_digest(array)
+
+
+class LayoutCache:
+    def __init__(self, cache_dir: str = LAYOUT_CACHE_DIR, mem_entries: int = 256, disk_bytes: int = 64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.mem_entries = mem_entries
+        self.disk_bytes = disk_bytes
+        self._mem: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_used = None  # 首次写入时扫描目录
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(digest: str, variant: str, conf: float, iou: float, imgsz: int,
+                 fast_mode: bool, agnostic_nms: bool) -> str:
+        params = f"{variant}|{conf:g}|{iou:g}|{imgsz}|{int(bool(fast_mode))}|{int(bool(agnostic_nms))}"
+        return hashlib.blake2b(f"{digest}|{params}".encode(), digest_size=16).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            regions = self._mem.get(key)
+            if regions is not None:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return [dict(r) for r in regions]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                regions = json.load(f)
+            os.utime(path)  # 刷新访问时间，淘汰按 mtime 近似 LRU
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            logger.error(f"Failed to load layout cache {path}: {e}")
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, regions)
+        return [dict(r) for r in regions]
+
+    def put(self, key: str, regions: List[Dict]):
+        regions = [dict(r) for r in regions]
+        with self._lock:
+            self._remember(key, regions)
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(regions, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Failed to save layout cache: {e}")
+            return
+
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = self._scan_disk_usage()
+            else:
+                self._disk_used += size
+            if self._disk_used > self.disk_bytes:
+                self._evict_disk()
+
+    def _remember(self, key: str, regions: List[Dict]):
+        self._mem[key] = regions
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_entries:
+            self._mem.popitem(last=False)
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                try:
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def _scan_disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict_disk(self):
+        """删除最久未访问的文件，直到占用降到上限的 90%"""
+        entries = sorted(self._entries())
+        used = sum(size for _, size, _ in entries)
+        target = int(self.disk_bytes * 0.9)
+        for _, size, path in entries:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except FileNotFoundError:
+                used -= size
+            except OSError as e:
+                logger.error(f"Failed to evict layout cache {path}: {e}")
+        self._disk_used = used
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "memory_entries": len(self._mem),
+                "memory_hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_bytes": self._disk_used,
+                "disk_limit_bytes": self.disk_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_layout_cache() -> Optional[LayoutCache]:
+    """全局缓存实例；LAYOUT_CACHE_ENABLED=0 时返回 None"""
+    global _cache
+    if os.environ.get("LAYOUT_CACHE_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LayoutCache(
+                    mem_entries=int(os.environ.get("LAYOUT_CACHE_MEM_ENTRIES", "256")),
+                    disk_bytes=int(float(os.environ.get("LAYOUT_CACHE_DISK_MB", "64")) * 1024 * 1024),
+                )
+    return _cache
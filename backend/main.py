@@ -1,11 +1,11 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import os
 import uvicorn
 import shutil
-import hashlib
 import json
 import time
 import pdfplumber
@@ -13,9 +13,17 @@ from typing import List, Optional, Any, Literal
 
 # Local imports
 from utils import pdf_to_images, document_to_images, is_pdf_file, is_image_file, get_file_type, SUPPORTED_EXTENSIONS
-from inference import get_layout_engine
+from utils import page_image_available, load_page_array, wait_for_page_writes, file_md5, copy_and_hash
+from inference import get_layout_pool_metrics, PoolSaturatedError
+from layout_cache import get_layout_cache
+from match_cache import get_match_cache
+from ort_profile import get_profile as get_ort_profile
+from warmup import start_warmup, get_warmup_status
+from inference_service import predict_layout, predict_layout_batch, layout_device, get_inference_service, shutdown_inference_service
 from database import db # SQLite integration
-from fingerprint import engine as fp_engine # Enhanced Fingerprinting
+from fingerprint import engine as fp_engine, extraction_page, fingerprint_max_pages # Enhanced Fingerprinting
+from fingerprint_index import get_template_index, refresh_template, remove_template
+from migration_job import start_migration_job, get_migration_job
 from ocr_utils import get_ocr_chars_for_page, inject_ocr_chars_to_page, is_page_scanned
 from anchor_capture import router as anchor_router, init_anchor_capture
 from positioning import resolve_region_bounds # [NEW]
@@ -356,11 +364,7 @@ def get_file_fingerprint(file_path):
     In a real system, this would be more robust (e.g. key-point hashing).
     For POC, we use file hash as a proxy for the 'type' of document.
     """
-    hasher = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        buf = f.read()
-        hasher.update(buf)
-    return hasher.hexdigest()
+    return file_md5(file_path)
 def get_page_words_from_image(image_path: str, fingerprint: Optional[str] = None) -> list:
     """
     从图片中提取文字信息（用于图片输入场景）。
@@ -417,7 +421,7 @@ def get_page_words(file_path, page_idx=0, image_path=None, p_fp=None):
             
             # Use OCR if page is scanned
             if is_page_scanned(page):
-                if image_path and os.path.exists(image_path):
+                if page_image_available(image_path):
                     ocr_chars = get_ocr_chars_for_page(image_path, p_width, p_height, page.bbox, fingerprint=p_fp, page_idx=page_idx+1)
                     inject_ocr_chars_to_page(page, ocr_chars)
             
@@ -589,12 +593,14 @@ def extract_text_from_regions_image(image_path: str, regions: List[Region], fing
     return results
 
 
-def extract_text_from_regions(file_path, regions: List[Region], image_path: Optional[str] = None, fingerprint: Optional[str] = None):
+def extract_text_from_regions(file_path, regions: List[Region], image_path: Optional[str] = None, fingerprint: Optional[str] = None,
+                              page_idx: int = 0):
     """
     统一的区域文本提取函数，支持 PDF 和图片输入。
     
     对于 PDF 文件：使用 pdfplumber 提取文本（支持扫描件 OCR 注入）
     对于图片文件：直接使用 OCR 提取文本
+    page_idx (0-based) 为模板匹配到的页，image_path 应为该页的图片
     """
     # 检查是否为图片文件输入
     if is_image_file(file_path):
@@ -606,7 +612,7 @@ def extract_text_from_regions(file_path, regions: List[Region], image_path: Opti
     logger.info(f"Extracting text from regions in {file_path}")
     results = []
     with pdfplumber.open(file_path) as pdf:
-        first_page = pdf.pages[0]
+        first_page = pdf.pages[page_idx] if page_idx < len(pdf.pages) else pdf.pages[0]
         width, height = first_page.width, first_page.height
         page_bbox = first_page.bbox # (x0, top, x1, bottom)
         
@@ -614,9 +620,9 @@ def extract_text_from_regions(file_path, regions: List[Region], image_path: Opti
         is_scanned = is_page_scanned(first_page)
         if is_scanned:
             logger.info(f"Scanned PDF detected, attempting OCR injection...")
-            if image_path and os.path.exists(image_path):
+            if page_image_available(image_path):
                 try:
-                    ocr_chars = get_ocr_chars_for_page(image_path, width, height, page_bbox, fingerprint=fingerprint, page_idx=1)
+                    ocr_chars = get_ocr_chars_for_page(image_path, width, height, page_bbox, fingerprint=fingerprint, page_idx=first_page.page_number)
                     inject_ocr_chars_to_page(first_page, ocr_chars)
                     logger.info(f"OCR injection successful: {len(ocr_chars)} chars")
                 except Exception as e:
@@ -708,43 +714,36 @@ def extract_text_from_regions(file_path, regions: List[Region], image_path: Opti
                 content = text.strip() if text else ""
             
             # --- Fallback: If content is still empty but we have an image, try a targeted OCR ---
-            if not content and image_path and os.path.exists(image_path):
+            if not content and page_image_available(image_path):
                 logger.info(f"Region {reg.id} ({reg.type}) extraction is empty, falling back to direct OCR crop...")
                 try:
                     from ocr_utils import run_ocr_on_image
-                    from PIL import Image
+                    import cv2
                     
-                    # 1. Load the page image
-                    with Image.open(image_path) as img:
-                        img_w, img_h = img.size
-                        # 2. Map normalized coords to pixel coords
-                        px_x0 = int(reg.x * img_w)
-                        px_y0 = int(reg.y * img_h)
-                        px_w = int(reg.width * img_w)
-                        px_h = int(reg.height * img_h)
-                        
-                        # 3. Crop region from image
-                        # Pillow crop bbox is (left, top, right, bottom)
-                        bbox_crop = (
-                            max(0, px_x0),
-                            max(0, px_y0),
-                            min(img_w, px_x0 + px_w),
-                            min(img_h, px_y0 + px_h)
-                        )
-                        
-                        if (bbox_crop[2] > bbox_crop[0]) and (bbox_crop[3] > bbox_crop[1]):
-                            # 4. Save temp crop and run OCR
-                            crop_img = img.crop(bbox_crop)
-                            temp_crop_path = os.path.join(UPLOAD_DIR, f"temp_ocr_{reg.id}.png")
-                            crop_img.save(temp_crop_path)
-                            
-                            ocr_results = run_ocr_on_image(temp_crop_path)
-                            if ocr_results:
-                                content = " ".join([res[1] for res in ocr_results])
-                                logger.info(f"Fallback OCR success for {reg.id}: {content[:30]}...")
-                            
-                            if os.path.exists(temp_crop_path):
-                                os.remove(temp_crop_path)
+                    # 1. Load the page pixels (shared in-memory raster, no PNG decode)
+                    page_pixels = load_page_array(image_path)
+                    img_h, img_w = page_pixels.shape[:2]
+                    # 2. Map normalized coords to pixel coords
+                    px_x0 = int(reg.x * img_w)
+                    px_y0 = int(reg.y * img_h)
+                    px_w = int(reg.width * img_w)
+                    px_h = int(reg.height * img_h)
+                    
+                    # 3. Crop region from image (left, top, right, bottom)
+                    bbox_crop = (
+                        max(0, px_x0),
+                        max(0, px_y0),
+                        min(img_w, px_x0 + px_w),
+                        min(img_h, px_y0 + px_h)
+                    )
+                    
+                    if (bbox_crop[2] > bbox_crop[0]) and (bbox_crop[3] > bbox_crop[1]):
+                        # 4. Run OCR on the in-memory crop (BGR)
+                        crop = page_pixels[bbox_crop[1]:bbox_crop[3], bbox_crop[0]:bbox_crop[2]]
+                        ocr_results = run_ocr_on_image(cv2.cvtColor(crop, cv2.COLOR_RGB2BGR))
+                        if ocr_results:
+                            content = " ".join([res[1] for res in ocr_results])
+                            logger.info(f"Fallback OCR success for {reg.id}: {content[:30]}...")
                 except Exception as ex:
                     logger.error(f"Fallback OCR failed for region {reg.id}: {ex}")
 
@@ -771,7 +770,15 @@ def sort_regions_spatially(regions):
 
 @app.get("/health")
 async def root():
-    return {"message": "HITL Document Extraction API is running"}
+    return {"message": "HITL Document Extraction API is running", **get_warmup_status()}
+
+@app.get("/health/ready")
+async def readiness():
+    """就绪探针：模型预热完成前或版面模型加载失败时返回 503"""
+    status = get_warmup_status()
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content=status)
+    return status
 
 @app.post("/analyze")
 def analyze_document(
@@ -785,18 +792,21 @@ def analyze_document(
     refresh: bool = False,
     skip_history: bool = False,  # 模板制作时跳过历史记录
     require_template: bool = False,  # 如果开启，则未匹配到模板时直接报错
-    fallback_to_layout: bool = False # 如果开启，未匹配到模板时自动进行版面分析
+    fallback_to_layout: bool = False, # 如果开启，未匹配到模板时自动进行版面分析
+    all_pages: bool = False, # 如果开启，对所有页批量进行版面分析 (结果见 page_regions)
+    tiling: str = "auto" # 大幅面图纸切片推理: auto (按页面尺寸自动) / on / off
 ):
     import traceback
     try:
         if device and device.lower() == "auto":
             device = None
+        if tiling not in ("auto", "on", "off"):
+            raise HTTPException(status_code=400, detail=f"Invalid tiling mode: {tiling}")
         
         # Determine input file path
         if file:
             file_path = os.path.join(UPLOAD_DIR, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            copy_and_hash(file.file, file_path)
             actual_filename = file.filename
         elif filename:
             actual_filename = filename
@@ -823,11 +833,11 @@ def analyze_document(
         matched_template_info = None
         
         if not refresh:
-            # Get all candidates
-            candidates = db.get_all_auto_templates()
-            if candidates:
+            # In-memory index over all auto templates (refreshed on save/delete)
+            template_index = get_template_index()
+            if len(template_index):
                 # Match using engine (Threshold tuned for DocLayout-YOLO: 0.7)
-                match_cand, score = fp_engine.find_best_match(file_path, candidates, threshold=0.7)
+                match_cand, score = fp_engine.find_best_match(file_path, threshold=0.7, index=template_index)
                 
                 if match_cand:
                     print(f"Matched template {match_cand['id']} with score {score}")
@@ -839,12 +849,18 @@ def analyze_document(
                                 # Ensure images are generated before extraction if needed for OCR
                                 img_subdir = f"images_{fingerprint[:8]}"
                                 img_save_path = os.path.join(UPLOAD_DIR, img_subdir)
-                                image_paths = document_to_images(file_path, img_save_path)
-                                
-                                regions_objs = [Region(**r) for r in t_data.get("regions", [])]
-                                matching_regions = extract_text_from_regions(file_path, regions_objs, image_path=image_paths[0] if image_paths else None, fingerprint=fingerprint)
-                                template_found = True
-                                matched_template_info = match_cand
+                                image_paths = document_to_images(file_path, img_save_path, background_write=True)
+                                # 多页匹配：从与模板第 1 页对应的那一页提取 (例如首页为封面)
+                                page_idx = extraction_page(match_cand, len(image_paths))
+                                if page_idx is None:
+                                    print(f"Template {match_cand['id']} matched on template page {match_cand.get('template_page')}, "
+                                          f"but the document has no page for template page 1; treating as no match")
+                                else:
+                                    regions_objs = [Region(**r) for r in t_data.get("regions", [])]
+                                    matching_regions = extract_text_from_regions(file_path, regions_objs, image_path=image_paths[page_idx] if image_paths else None,
+                                                                                 fingerprint=fingerprint, page_idx=page_idx)
+                                    template_found = True
+                                    matched_template_info = match_cand
                          except Exception as e:
                              print(f"Error loading matched template {match_cand['id']}: {e}")
                 else:
@@ -853,7 +869,7 @@ def analyze_document(
         # 3. Convert to images
         img_subdir = f"images_{fingerprint[:8]}"
         img_save_path = os.path.join(UPLOAD_DIR, img_subdir)
-        image_paths = document_to_images(file_path, img_save_path)
+        image_paths = document_to_images(file_path, img_save_path, background_write=True)
         relative_images = [os.path.join(img_subdir, os.path.basename(p)) for p in image_paths]
 
         # 4. Use AI (Apply frontend params)
@@ -862,32 +878,51 @@ def analyze_document(
             logger.warning(f"Template mismatch for {actual_filename} in strict mode.")
             # We will handle this as a failed result below instead of raising exception
             
-        engine = get_layout_engine()
-        device_used = device or engine.device
+        device_used = device or layout_device()
         start_time = time.time()
         
         # MODIFIED: Skip AI inference if no template matched in auto mode (unless refreshing or fallback requested)
         if refresh or template_found or fallback_to_layout:
             try:
                 # Override with layout inference even if template exists if we want to "re-identify"
-                ai_regions = engine.predict(
-                    image_paths[0], 
-                    device=device, 
-                    conf=conf,
-                    imgsz=imgsz,
-                    iou=iou,
-                    agnostic_nms=agnostic_nms
-                )
+                # (dispatched to the process-pool service when enabled, otherwise the in-process session pool)
+                if all_pages and len(image_paths) > 1:
+                    page_regions = predict_layout_batch(
+                        image_paths,
+                        device=device,
+                        conf=conf,
+                        imgsz=imgsz,
+                        iou=iou,
+                        agnostic_nms=agnostic_nms,
+                        tiling=tiling
+                    )
+                    ai_regions = page_regions[0]
+                else:
+                    ai_regions = predict_layout(
+                        image_paths[0], 
+                        device=device, 
+                        conf=conf,
+                        imgsz=imgsz,
+                        iou=iou,
+                        agnostic_nms=agnostic_nms,
+                        tiling=tiling
+                    )
+                    page_regions = [ai_regions]
                 inference_time = time.time() - start_time
                 # If refreshing or fallback triggered, use AI results
                 if refresh or (fallback_to_layout and not template_found):
                     matching_regions = ai_regions
                     template_found = False # Reset flag for UI feedback
+            except PoolSaturatedError as e:
+                # 背压：推理会话池饱和时直接告知客户端稍后重试
+                logger.warning(f"Layout pool saturated: {e}")
+                raise HTTPException(status_code=503, detail="推理服务繁忙，请稍后重试")
             except Exception as e:
                 print(f"Inference error: {e}")
                 if not template_found:
                     matching_regions = []
                 ai_regions = []
+                page_regions = []
         else:
             # Auto mode failed to match, and we are not forcing refresh/AI
             # MODIFIED: As per user request, do NOT fallback to AI inference if template not found
@@ -895,6 +930,7 @@ def analyze_document(
             print("No template matched, skipping AI fallback to ensure strict template matching.")
             matching_regions = []
             ai_regions = []
+            page_regions = []
             inference_time = 0
 
         
@@ -961,6 +997,7 @@ def analyze_document(
             "images": relative_images,
             "regions": matching_regions,
             "ai_regions": ai_regions if template_found else [], 
+            "page_regions": page_regions if all_pages else None,
             "template_found": template_found,
             "matched_template": matched_template_info,
             "is_source": False,
@@ -969,8 +1006,12 @@ def analyze_document(
             "device_used": device_used,
             "inference_time": round(inference_time, 3) if 'inference_time' in locals() else 0
         }
+        # 前端静态预览需要 PNG，返回前确保后台写入已完成
+        wait_for_page_writes(image_paths)
         return base_response
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"CRITICAL ERROR in /analyze: {e}")
         logger.error(traceback.format_exc())
@@ -1002,7 +1043,7 @@ def analyze_from_source(template_id: str):
     # 3. Convert to images (as usual)
     img_subdir = f"images_{fingerprint[:8]}"
     img_save_path = os.path.join(UPLOAD_DIR, img_subdir)
-    image_paths = document_to_images(source_path, img_save_path)
+    image_paths = document_to_images(source_path, img_save_path, background_write=True)
     relative_images = [os.path.join(img_subdir, os.path.basename(p)) for p in image_paths]
 
     # 4. Load template regions
@@ -1050,6 +1091,7 @@ def analyze_from_source(template_id: str):
 
     # 5. Extract Words for Dynamic Positioning UI
     words_data = get_page_words(source_path, page_idx=0, image_path=image_paths[0] if image_paths else None, p_fp=fingerprint)
+    wait_for_page_writes(image_paths)
 
     return {
         "id": template_id,
@@ -1090,7 +1132,7 @@ def analyze_table_structure(req: TableAnalysisRequest):
                 fingerprint = get_file_fingerprint(file_path)
                 img_subdir = f"images_{fingerprint[:8]}"
                 img_path = os.path.join(UPLOAD_DIR, img_subdir, "page_1.png")
-                if os.path.exists(img_path):
+                if page_image_available(img_path):
                     try:
                         ocr_chars = get_ocr_chars_for_page(img_path, page.width, page.height, page.bbox, fingerprint=fingerprint, page_idx=1)
                         inject_ocr_chars_to_page(page, ocr_chars)
@@ -1259,7 +1301,7 @@ def extract_multiple_regions(
         results = extract_text_from_regions(
             file_path, 
             region_objs, 
-            image_path=img_path if os.path.exists(img_path) else None,
+            image_path=img_path if page_image_available(img_path) else None,
             fingerprint=fingerprint
         )
         return results
@@ -1290,7 +1332,7 @@ def save_template(template: Template):
     if template.filename:
         src_full_path = os.path.join(UPLOAD_DIR, template.filename)
         if os.path.exists(src_full_path):
-            f_features = fp_engine.extract_features(src_full_path)
+            f_features = fp_engine.extract_features(src_full_path, max_pages=fingerprint_max_pages())
     
     # 2. Save JSON definition
     # Update template object with extracted features so it is also in the JSON
@@ -1309,6 +1351,7 @@ def save_template(template: Template):
         fingerprint_text=json.dumps(f_features),
         tags=template.tags
     )
+    refresh_template(template.id)
     
     # 4. Preserved PDF source library
     if template.filename:
@@ -1342,6 +1385,7 @@ async def delete_template(template_id: str):
 
     # 2. Delete from DB
     db.delete_template(template_id)
+    remove_template(template_id)
 
     # 3. Delete physical files
     # Delete JSON
@@ -1362,55 +1406,25 @@ async def delete_template(template_id: str):
     return {"status": "success", "message": f"Template {template_id} deleted"}
 
 @app.post("/templates/migrate")
-def migrate_templates_fingerprints():
+def migrate_templates_fingerprints(force: bool = False):
     """
     Utility to upgrade all existing templates to v2_visual fingerprints.
     It uses the preserved source PDFs in data/template_sources.
+    后台任务执行 (跳过源文件与特征版本均未变化的模板)，进度见 GET /templates/migrate/status
     """
-    templates = db.list_templates()
-    migrated_count = 0
-    errors = []
-    
-    for t in templates:
-        t_id = t['id']
-        source_pdf = os.path.join(TEMPLATES_SOURCE_DIR, f"{t_id}.pdf")
-        
-        if os.path.exists(source_pdf):
-            try:
-                # 重新提取视觉特征
-                new_features = fp_engine.extract_features(source_pdf)
-                features_json = json.dumps(new_features)
-                
-                # 更新数据库
-                db.save_template(
-                    t_id=t_id,
-                    mode=t['mode'],
-                    name=t['name'],
-                    filename=t['filename'],
-                    fingerprint=t['fingerprint'],
-                    fingerprint_text=features_json,
-                    tags=t['tags']
-                )
-                
-                # 同步更新 JSON 文件内容 (可选但推荐保持一致)
-                if t['filename'] and os.path.exists(t['filename']):
-                    with open(t['filename'], "r", encoding="utf-8") as f:
-                        data = json.load(f)
-                    data['fingerprint_text'] = features_json
-                    with open(t['filename'], "w", encoding="utf-8") as f:
-                        json.dump(data, f, indent=2, ensure_ascii=False)
-                        
-                migrated_count += 1
-            except Exception as e:
-                errors.append({"id": t_id, "error": str(e)})
-        else:
-            errors.append({"id": t_id, "error": "Source PDF not found in repository"})
-            
-    return {
-        "status": "success" if not errors else "partial",
-        "migrated": migrated_count,
-        "errors": errors
-    }
+    def resolve_source(t):
+        return os.path.join(TEMPLATES_SOURCE_DIR, f"{t['id']}.pdf")
+
+    job, started = start_migration_job(db.list_templates(), resolve_source, force=force)
+    return {"status": "started" if started else "running", "job": job.snapshot()}
+
+
+@app.get("/templates/migrate/status")
+def migrate_templates_status():
+    job = get_migration_job()
+    if job is None:
+        raise HTTPException(status_code=404, detail="No migration job has been started")
+    return job.snapshot()
 
 
 @app.post("/extract/{template_id}")
@@ -1480,14 +1494,13 @@ def extract_with_custom_template(
             
         # 2. Save Uploaded File
         file_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        copy_and_hash(file.file, file_path)
             
         # 3. Extract
         fingerprint = get_file_fingerprint(file_path)
         img_subdir = f"images_{fingerprint[:8]}"
         img_save_path = os.path.join(UPLOAD_DIR, img_subdir)
-        image_paths = document_to_images(file_path, img_save_path)
+        image_paths = document_to_images(file_path, img_save_path, background_write=True)
         
         regions_objs = [Region(**r) for r in t_data.get("regions", [])]
         extracted_regions = extract_text_from_regions(file_path, regions_objs, image_path=image_paths[0] if image_paths else None, fingerprint=fingerprint)
@@ -1593,8 +1606,8 @@ def create_extraction_task(
     filename = file.filename
     file_path = os.path.join(UPLOAD_DIR, filename)
     
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # 写入的同时计算 MD5，任务执行时直接命中哈希缓存
+    copy_and_hash(file.file, file_path)
     
     # 获取模板名称
     if template_id.lower() == 'auto':
@@ -1736,6 +1749,10 @@ def get_model_status():
 async def get_system_status():
     return {
         "models": get_model_status(),
+        "layout_pool": get_layout_pool_metrics(),
+        "layout_cache": get_layout_cache().stats() if get_layout_cache() else None,
+        "match_cache": get_match_cache().stats() if get_match_cache() else None,
+        "ort_profile": get_ort_profile(),
         "app_data_dir": base_data_dir,
         "platform": sys.platform,
         "version": "1.1.0"
@@ -1896,6 +1913,10 @@ task_worker = TaskWorker(sys.modules[__name__])
 async def startup_event():
     """应用启动时执行"""
     print("=== Starting Application ===")
+    # 启用时预先拉起推理进程池 (INFERENCE_WORKERS > 0)
+    get_inference_service()
+    # 后台预热版面与 OCR 会话，首个请求无需承担冷启动
+    start_warmup()
     task_worker.start()
 
 @app.on_event("shutdown")
@@ -1903,6 +1924,7 @@ async def shutdown_event():
     """应用关闭时执行"""
     print("=== Shutting Down Application ===")
     task_worker.stop()
+    shutdown_inference_service()
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8291)
@@ -0,0 +1,90 @@
+"""
+Template match result cache.
+
+/analyze and TaskWorker._extract_auto_mode call find_best_match for every
+upload; duplicate uploads and retries of documents that match nothing used to
+extract features and score the whole library again. Results are cached per
+process, keyed by
+
+    (file MD5, template library version, threshold, matching configuration)
+
+The library version is a counter in the SQLite meta table that
+Database.save_template / delete_template (when the row is or was an auto
+template) and update_fingerprints bump in the same transaction as the write,
+so any change to the auto-template library makes every older entry
+unreachable (including changes made by other processes); editing custom
+templates leaves the cache intact. No-match
+results are cached as negative entries. Only the template id is stored for a
+hit; the candidate record is read back from the fingerprint index.
+
+Configuration (environment variables):
+    MATCH_CACHE_ENABLED  1 (default) | 0
+    MATCH_CACHE_ENTRIES  LRU capacity (default 4096)
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class MatchCache:
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Optional[Dict]:
+        """-> {"template_id" (None 表示未匹配), "score", "match"} 或 None (未缓存)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if entry["template_id"] is None:
+                self.negative_hits += 1
+            return entry
+
+    def put(self, key: Tuple, template_id: Optional[str], score: float, match: Optional[Dict] = None):
+        """match 为附加到候选上的匹配信息 (matched_page / template_page / match_tier)"""
+        with self._lock:
+            self._entries[key] = {"template_id": template_id, "score": score, "match": dict(match or {})}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            negative = sum(1 for e in self._entries.values() if e["template_id"] is None)
+            return {
+                "entries": len(self._entries),
+                "negative_entries": negative,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_match_cache() -> Optional[MatchCache]:
+    """全局缓存实例；MATCH_CACHE_ENABLED=0 时返回 None"""
+    global _cache
+    if os.environ.get("MATCH_CACHE_ENABLED", "1").lower() in ("0", "false", "no"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = MatchCache(int(os.environ.get("MATCH_CACHE_ENTRIES", "4096")))
+    return _cache
@@ -0,0 +1,200 @@
+"""
+Background fingerprint migration job.
+
+POST /templates/migrate used to re-extract every template serially inside the
+request and rewrite each DB row and JSON file one by one. A MigrationJob
+runs on a background thread instead:
+
+    * templates whose stored features already have the current feature
+      version and were extracted from a source PDF with the same MD5 are
+      skipped (force=True re-extracts everything); with FINGERPRINT_MAX_PAGES
+      > 1 the stored features must also be multi-page (page_count), and
+      they must include the text-layer tier (text_layer, None for scans)
+    * extraction runs in a thread pool; inference goes through predict_layout,
+      i.e. the session pool or the INFERENCE_WORKERS process pool, and
+      features are reused from feature_cache when the PDF was seen before
+    * DB updates are written in batched transactions (Database.update_fingerprints),
+      followed by the template JSON files and the in-memory fingerprint index
+    * progress is exposed by snapshot() (GET /templates/migrate/status)
+
+Configuration (environment variables):
+    MIGRATION_WORKERS     extraction threads (default 2)
+    MIGRATION_BATCH_SIZE  templates per DB transaction (default 20)
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+from feature_cache import FEATURE_VERSION, extract_features_cached
+from fingerprint import fingerprint_max_pages
+from text_fingerprint import TEXT_LAYER_VERSION
+from utils import file_md5
+
+
+def _is_current(fingerprint_text: Optional[str], md5: str, max_pages: int = 1) -> bool:
+    try:
+        features = json.loads(fingerprint_text or '{}')
+    except ValueError:
+        return False
+    return (
+        features.get("version") == FEATURE_VERSION
+        and features.get("md5") == md5
+        and bool(features.get("layout_boxes"))
+        and "text_layer" in features
+        and (features["text_layer"] or {}).get("version", TEXT_LAYER_VERSION) == TEXT_LAYER_VERSION
+        and (max_pages <= 1 or "page_count" in features)
+    )
+
+
+class MigrationJob:
+    def __init__(self, templates: List[Dict], resolve_source: Callable[[Dict], Optional[str]],
+                 workers: Optional[int] = None, batch_size: Optional[int] = None, force: bool = False):
+        self.id = uuid.uuid4().hex[:12]
+        self.templates = templates
+        self.resolve_source = resolve_source
+        self.workers = max(1, workers or int(os.environ.get("MIGRATION_WORKERS", "2")))
+        self.batch_size = max(1, batch_size or int(os.environ.get("MIGRATION_BATCH_SIZE", "20")))
+        self.force = force
+        self.max_pages = fingerprint_max_pages()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._status = {
+            "job_id": self.id,
+            "status": "pending",
+            "feature_version": FEATURE_VERSION,
+            "force": force,
+            "total": len(templates),
+            "processed": 0,
+            "migrated": 0,
+            "skipped": 0,
+            "errors": [],
+            "started_at": None,
+            "finished_at": None,
+        }
+
+    # ---------- 状态 ----------
+
+    def _update(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            status = dict(self._status)
+            status["errors"] = list(self._status["errors"])
+        if status["started_at"]:
+            elapsed = (status["finished_at"] or time.time()) - status["started_at"]
+            status["elapsed_seconds"] = round(elapsed, 1)
+            status["templates_per_second"] = round(status["processed"] / elapsed, 2) if elapsed > 0 else None
+        return status
+
+    @property
+    def running(self) -> bool:
+        with self._lock:
+            return self._status["status"] in ("pending", "running")
+
+    # ---------- 执行 ----------
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"migration-{self.id}", daemon=True)
+        self._thread.start()
+
+    def _process(self, template: Dict) -> Dict:
+        """worker：判断是否需要迁移并提取特征"""
+        t_id = template['id']
+        source = self.resolve_source(template)
+        if not source or not os.path.exists(source):
+            return {"id": t_id, "error": "Source PDF not found in repository"}
+        if not self.force and _is_current(template.get('fingerprint_text'), file_md5(source), self.max_pages):
+            return {"id": t_id, "skipped": True}
+        features, _ = extract_features_cached(source, max_pages=self.max_pages)
+        return {"id": t_id, "fingerprint_text": json.dumps(features)}
+
+    def _flush(self, batch: List[Dict]):
+        """一个事务写入数据库，再同步模板 JSON 文件与内存指纹索引"""
+        from database import db
+        from fingerprint_index import refresh_template
+        db.update_fingerprints([(item["id"], item["fingerprint_text"]) for item in batch])
+        for item in batch:
+            filename = item["template"].get('filename')
+            if filename and os.path.exists(filename):
+                try:
+                    with open(filename, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    data['fingerprint_text'] = item["fingerprint_text"]
+                    with open(filename, "w", encoding="utf-8") as f:
+                        json.dump(data, f, indent=2, ensure_ascii=False)
+                except Exception as e:
+                    print(f"Failed to update template file {filename}: {e}")
+            refresh_template(item["id"])
+
+    def run(self):
+        self._update(status="running", started_at=time.time())
+        by_id = {t['id']: t for t in self.templates}
+        batch = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="migration") as executor:
+                futures = {executor.submit(self._process, t): t['id'] for t in self.templates}
+                for future in as_completed(futures):
+                    t_id = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"id": t_id, "error": str(e)}
+
+                    with self._lock:
+                        self._status["processed"] += 1
+                        if "error" in result:
+                            self._status["errors"].append({"id": t_id, "error": result["error"]})
+                        elif result.get("skipped"):
+                            self._status["skipped"] += 1
+
+                    if "fingerprint_text" in result:
+                        result["template"] = by_id[t_id]
+                        batch.append(result)
+                        if len(batch) >= self.batch_size:
+                            self._flush(batch)
+                            with self._lock:
+                                self._status["migrated"] += len(batch)
+                            batch = []
+
+            if batch:
+                self._flush(batch)
+                with self._lock:
+                    self._status["migrated"] += len(batch)
+            with self._lock:
+                self._status["status"] = "completed" if not self._status["errors"] else "partial"
+        except Exception as e:
+            traceback.print_exc()
+            self._update(status="failed", error=str(e))
+        finally:
+            self._update(finished_at=time.time())
+        return self.snapshot()
+
+
+# ========== 全局任务 (同一时间只运行一个) ==========
+
+_job: Optional[MigrationJob] = None
+_job_lock = threading.Lock()
+
+
+def start_migration_job(templates: List[Dict], resolve_source: Callable[[Dict], Optional[str]],
+                        force: bool = False):
+    """返回 (job, 是否新启动)；已有任务在运行时直接返回该任务"""
+    global _job
+    with _job_lock:
+        if _job is not None and _job.running:
+            return _job, False
+        _job = MigrationJob(templates, resolve_source, force=force)
+        _job.start()
+        return _job, True
+
+
+def get_migration_job() -> Optional[MigrationJob]:
+    return _job
@@ -7,11 +7,13 @@ This module provides functionality to:
 3. Inject these objects into a pdfplumber page to enable table extraction
 """
 
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Union
 import os
 import json
 import logging
-from PIL import Image
+import threading
+import numpy as np
+from utils import get_page_raster, get_page_size
 logger = logging.getLogger("backend.ocr")
 
 # Cache directory configuration
@@ -20,73 +22,89 @@ OCR_CACHE_DIR = os.path.join(base_data, "cache", "ocr")
 
 # Lazy load RapidOCR to avoid import overhead if not used
 _ocr_engine = None
+# 启动预热线程与首个请求可能同时初始化
+_ocr_engine_lock = threading.Lock()
 
 def get_ocr_engine():
     """Get or initialize the RapidOCR engine (singleton)."""
     global _ocr_engine
     if _ocr_engine is None:
-        try:
-            import os
-            import sys
-            from rapidocr_onnxruntime import RapidOCR
+        with _ocr_engine_lock:
+            if _ocr_engine is None:
+                try:
+                    import os
+                    import sys
+                    from rapidocr_onnxruntime import RapidOCR
             
-            # Discovery logic for OCR models
-            base_data = os.environ.get("APP_DATA_DIR", "data")
+                    # Discovery logic for OCR models
+                    base_data = os.environ.get("APP_DATA_DIR", "data")
             
-            def find_model(filename):
-                candidates = [
-                    # 1. User Data Directory (Highest Priority)
-                    os.path.join(base_data, "models", filename),
-                    os.path.join(base_data, "models", "ocr", filename),
-                ]
-                # 2. Bundled Resources (App bundle)
-                if getattr(sys, 'frozen', False):
-                    candidates.append(os.path.join(sys._MEIPASS, "models", filename))
-                    candidates.append(os.path.join(sys._MEIPASS, "models", "ocr", filename))
+                    def find_model(filename):
+                        candidates = [
+                            # 1. User Data Directory (Highest Priority)
+                            os.path.join(base_data, "models", filename),
+                            os.path.join(base_data, "models", "ocr", filename),
+                        ]
+                        # 2. Bundled Resources (App bundle)
+                        if getattr(sys, 'frozen', False):
+                            candidates.append(os.path.join(sys._MEIPASS, "models", filename))
+                            candidates.append(os.path.join(sys._MEIPASS, "models", "ocr", filename))
                 
-                # 3. Development / CWD locations
-                candidates.extend([
-                    os.path.join("data", "models", filename),
-                    os.path.join("data", "models", "ocr", filename),
-                    os.path.join("models", filename),
-                    os.path.join("models", "ocr", filename),
-                ])
+                        # 3. Development / CWD locations
+                        candidates.extend([
+                            os.path.join("data", "models", filename),
+                            os.path.join("data", "models", "ocr", filename),
+                            os.path.join("models", filename),
+                            os.path.join("models", "ocr", filename),
+                        ])
                 
-                for c in candidates:
-                    if os.path.exists(c):
-                        return c
-                return None
+                        for c in candidates:
+                            if os.path.exists(c):
+                                return c
+                        return None
 
-            det_path = find_model("ch_PP-OCRv4_det_infer.onnx")
-            rec_path = find_model("ch_PP-OCRv4_rec_infer.onnx")
+                    det_path = find_model("ch_PP-OCRv4_det_infer.onnx")
+                    rec_path = find_model("ch_PP-OCRv4_rec_infer.onnx")
             
-            ocr_kwargs = {}
-            if det_path:
-                ocr_kwargs['det_model_path'] = det_path
-            if rec_path:
-                ocr_kwargs['rec_model_path'] = rec_path
+                    ocr_kwargs = {}
+                    if det_path:
+                        ocr_kwargs['det_model_path'] = det_path
+                    if rec_path:
+                        ocr_kwargs['rec_model_path'] = rec_path
                 
-            _ocr_engine = RapidOCR(**ocr_kwargs)
-            logger.info(f"RapidOCR engine initialized. Models: {det_path}, {rec_path}")
-        except ImportError as e:
-            logger.error(f"Failed to import RapidOCR: {e}")
-            raise
+                    _ocr_engine = RapidOCR(**ocr_kwargs)
+                    logger.info(f"RapidOCR engine initialized. Models: {det_path}, {rec_path}")
+                except ImportError as e:
+                    logger.error(f"Failed to import RapidOCR: {e}")
+                    raise
     return _ocr_engine
 
 
-def run_ocr_on_image(image_path: str) -> List[Tuple[List[List[float]], str, float]]:
+def run_ocr_on_image(image: Union[str, np.ndarray]) -> List[Tuple[List[List[float]], str, float]]:
     """
-    Run OCR on an image file.
+    Run OCR on an image file or an in-memory BGR array.
     
     Args:
-        image_path: Path to the image file.
+        image: Path to the image file, or a HxWx3 BGR NumPy array.
+            Page images already rendered in this process are read from the
+            in-memory raster registry instead of re-decoding the PNG.
         
     Returns:
         List of tuples: (box_coordinates, text, confidence)
         box_coordinates is [[x1,y1], [x2,y1], [x2,y2], [x1,y2]] in pixels.
     """
+    # 启用进程池推理服务时，OCR 在 worker 进程中执行
+    from inference_service import get_inference_service
+    service = get_inference_service()
+    if service is not None:
+        return service.ocr(image)
+    
     engine = get_ocr_engine()
-    result, _ = engine(image_path)
+    if isinstance(image, str):
+        raster = get_page_raster(image)
+        if raster is not None:
+            image = raster.bgr()
+    result, _ = engine(image)
     
     if result is None:
         return []
@@ -263,8 +281,7 @@ def get_ocr_chars_for_page(
             return cached
 
     # Get image dimensions
-    with Image.open(image_path) as img:
-        img_width, img_height = img.size
+    img_width, img_height = get_page_size(image_path)
     
     # Calculate scale factors
     scale_x = pdf_width / img_width
@@ -0,0 +1,296 @@
+"""
+ONNX Runtime performance profile for LayoutEngine sessions.
+
+A profile bundles every ORT knob we tune per server SKU: execution
+providers, intra/inter-op threads, execution mode, graph optimization level,
+CPU memory arena, memory pattern, thread spinning and the offline optimized
+model cache. Nothing here requires patching code:
+
+    1. built-in presets (PRESETS), selected with ORT_PROFILE (default "default")
+    2. <APP_DATA_DIR>/ort_profile.json or the file named by ORT_PROFILE_FILE,
+       either a flat option dict or {"active": name, "profiles": {name: {...}}}
+    3. per-option environment overrides (ENV_OVERRIDES), highest priority
+
+Threads left unset fall back to the LayoutEnginePool budget split.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import onnxruntime as ort
+
+logger = logging.getLogger("backend.ort_profile")
+
+base_data = os.environ.get("APP_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+ORT_CACHE_DIR = os.path.join(base_data, "cache", "ort")
+PROFILE_FILENAME = "ort_profile.json"
+
+DEFAULT_OPTIONS = {
+    # "auto" = CUDA > CoreML > CPU；也可显式列出，如 ["OpenVINOExecutionProvider", "CPUExecutionProvider"]
+    "providers": "auto",
+    "provider_options": {},
+    "intra_op_num_threads": None,
+    "inter_op_num_threads": None,
+    "execution_mode": "sequential",          # sequential | parallel
+    "graph_optimization_level": "all",       # disable | basic | extended | all
+    "enable_cpu_mem_arena": True,
+    "enable_mem_pattern": True,
+    "allow_spinning": None,                  # None = ORT 默认
+    "optimized_model_cache": True,
+}
+
+PRESETS = {
+    "default": {},
+    # 桌面端/小内存机器：关闭 arena 与内存模式，空闲时不自旋占用 CPU
+    "low_memory": {"enable_cpu_mem_arena": False, "enable_mem_pattern": False, "allow_spinning": False},
+    # 独占服务器：YOLO 图分支较少，inter-op 并行收益有限，保持顺序执行但允许自旋降低延迟
+    "latency": {"allow_spinning": True},
+    # 已安装 onnxruntime-openvino / DNNL 构建时优先使用加速 CPU 提供者
+    "openvino": {"providers": ["OpenVINOExecutionProvider", "CPUExecutionProvider"]},
+    "dnnl": {"providers": ["DnnlExecutionProvider", "CPUExecutionProvider"]},
+}
+
+# option -> (环境变量, 类型)
+ENV_OVERRIDES = {
+    "providers": ("ORT_PROVIDERS", "list"),
+    "intra_op_num_threads": ("ORT_INTRA_OP_THREADS", "int"),
+    "inter_op_num_threads": ("ORT_INTER_OP_THREADS", "int"),
+    "execution_mode": ("ORT_EXECUTION_MODE", "str"),
+    "graph_optimization_level": ("ORT_GRAPH_OPT_LEVEL", "str"),
+    "enable_cpu_mem_arena": ("ORT_CPU_MEM_ARENA", "bool"),
+    "enable_mem_pattern": ("ORT_MEM_PATTERN", "bool"),
+    "allow_spinning": ("ORT_ALLOW_SPINNING", "bool"),
+    "optimized_model_cache": ("ORT_OPTIMIZED_MODEL_CACHE", "bool"),
+}
+
+_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def _parse_env(value: str, kind: str):
+    if kind == "int":
+        return int(value) or None
+    if kind == "bool":
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if kind == "list":
+        return [p.strip() for p in value.split(",") if p.strip()] or "auto"
+    return value.strip().lower()
+
+
+def _read_profile_file() -> Tuple[Optional[str], Optional[Dict]]:
+    path = os.environ.get("ORT_PROFILE_FILE") or os.path.join(base_data, PROFILE_FILENAME)
+    if not os.path.exists(path):
+        return None, None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return path, json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to read ORT profile {path}: {e}")
+        return None, None
+
+
+def load_profile() -> Dict:
+    """合并 预设 -> 配置文件 -> 环境变量，返回 {"name", "sources", "options"}"""
+    name = os.environ.get("ORT_PROFILE", "").strip()
+    options = dict(DEFAULT_OPTIONS)
+    sources = []
+
+    path, data = _read_profile_file()
+    file_options = None
+    if data is not None:
+        if "profiles" in data:
+            name = name or data.get("active", "")
+            file_options = data["profiles"].get(name)
+        else:
+            file_options = data
+
+    name = name or "default"
+    if name in PRESETS:
+        options.update(PRESETS[name])
+        sources.append(f"preset:{name}")
+    elif file_options is None:
+        logger.warning(f"Unknown ORT profile '{name}', using defaults")
+
+    if file_options:
+        unknown = set(file_options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            logger.warning(f"Ignoring unknown ORT profile options: {sorted(unknown)}")
+        options.update({k: v for k, v in file_options.items() if k in DEFAULT_OPTIONS})
+        sources.append(f"file:{path}")
+
+    for option, (env_name, kind) in ENV_OVERRIDES.items():
+        value = os.environ.get(env_name)
+        if value is not None and value != "":
+            try:
+                options[option] = _parse_env(value, kind)
+                sources.append(f"env:{env_name}")
+            except ValueError:
+                logger.warning(f"Invalid value for {env_name}: {value!r}")
+
+    return {"name": name, "sources": sources, "options": options}
+
+
+_profile = None
+_profile_lock = threading.Lock()
+
+
+def get_profile() -> Dict:
+    """进程内只解析一次"""
+    global _profile
+    if _profile is None:
+        with _profile_lock:
+            if _profile is None:
+                _profile = load_profile()
+    return _profile
+
+
+def auto_providers() -> List[str]:
+    """
+    获取可用的 ONNX Runtime 执行提供者
+    优先级: CUDA > CoreML (MPS) > CPU
+    """
+    available = ort.get_available_providers()
+
+    if 'CUDAExecutionProvider' in available:
+        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    elif 'CoreMLExecutionProvider' in available:
+        return ['CoreMLExecutionProvider', 'CPUExecutionProvider']
+    else:
+        return ['CPUExecutionProvider']
+
+
+def resolve_providers(options: Dict, device: Optional[str] = None) -> List[str]:
+    """显式 device 优先；否则按 profile 过滤出本机已安装的提供者，始终以 CPU 兜底"""
+    if device == 'cuda':
+        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    if device == 'mps':
+        return ['CoreMLExecutionProvider', 'CPUExecutionProvider']
+
+    requested = options.get("providers") or "auto"
+    if requested == "auto":
+        return auto_providers()
+
+    available = set(ort.get_available_providers())
+    providers = [p for p in requested if p in available]
+    missing = [p for p in requested if p not in available]
+    if missing:
+        print(f"ORT providers not installed, skipping: {missing}")
+    if 'CPUExecutionProvider' not in providers:
+        providers.append('CPUExecutionProvider')
+    return providers
+
+
+def build_session_options(options: Dict, intra_threads: int, inter_threads: Optional[int]) -> ort.SessionOptions:
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = _OPT_LEVELS.get(
+        options.get("graph_optimization_level"), ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    sess_options.execution_mode = _EXECUTION_MODES.get(options.get("execution_mode"), ort.ExecutionMode.ORT_SEQUENTIAL)
+    sess_options.enable_cpu_mem_arena = bool(options.get("enable_cpu_mem_arena", True))
+    sess_options.enable_mem_pattern = bool(options.get("enable_mem_pattern", True))
+    sess_options.intra_op_num_threads = intra_threads
+    if inter_threads:
+        sess_options.inter_op_num_threads = inter_threads
+    if options.get("allow_spinning") is not None:
+        sess_options.add_session_config_entry(
+            "session.intra_op.allow_spinning", "1" if options["allow_spinning"] else "0"
+        )
+        sess_options.add_session_config_entry(
+            "session.inter_op.allow_spinning", "1" if options["allow_spinning"] else "0"
+        )
+    return sess_options
+
+
+# 离线保存的最高优化级别：高于 extended 的优化 (NCHWc 布局等) 与 CPU 指令集相关，
+# 保存后的文件只能在同一硬件上使用，因此只在加载时执行
+_MAX_SAVED_LEVEL = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+# 缓存格式版本：旧版缓存按 "all" 级别保存 (与硬件相关)，换键后不再加载
+_CACHE_FORMAT = "x1"
+
+
+def _saved_level(level: "ort.GraphOptimizationLevel") -> "ort.GraphOptimizationLevel":
+    return level if int(level) <= int(_MAX_SAVED_LEVEL) else _MAX_SAVED_LEVEL
+
+
+def optimized_model_path(model_tag: str, options: Dict, providers: List[str]) -> str:
+    """离线优化模型的缓存路径：模型文件 / ORT 版本 / 优化级别 / 提供者任一变化即换新文件"""
+    key = (f"{model_tag}|{ort.__version__}|{options.get('graph_optimization_level')}|{','.join(providers)}"
+           f"|{_CACHE_FORMAT}")
+    digest = hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+    stem = model_tag.split(":")[1].rsplit(".", 1)[0] if ":" in model_tag else "model"
+    return os.path.join(ORT_CACHE_DIR, f"{stem}.{digest}.opt.onnx")
+
+
+def create_session(model_path: str, model_tag: str, options: Dict, providers: List[str],
+                   intra_threads: int, inter_threads: Optional[int]) -> Tuple[ort.InferenceSession, Dict]:
+    """
+    按 profile 创建会话。仅 CPU 提供者时使用离线优化模型缓存：
+    缓存中保存的是 extended 级别 (与硬件无关) 的优化结果，命中时跳过这部分优化，
+    "all" 级别特有的硬件相关优化仍在加载时执行；未命中则写入缓存供下次启动使用。
+    """
+    info = {"optimized_model": None, "optimized_model_cache": "disabled"}
+    use_cache = bool(options.get("optimized_model_cache")) and providers == ['CPUExecutionProvider']
+
+    provider_options = options.get("provider_options") or {}
+    provider_kwargs = {}
+    if provider_options:
+        provider_kwargs["provider_options"] = [provider_options.get(p, {}) for p in providers]
+
+    if use_cache:
+        cached_path = optimized_model_path(model_tag, options, providers)
+        info["optimized_model"] = cached_path
+        if os.path.exists(cached_path):
+            sess_options = build_session_options(options, intra_threads, inter_threads)
+            # 已离线优化到 extended 的模型：请求级别不高于 extended 时不再优化，否则只补做硬件相关优化
+            if int(sess_options.graph_optimization_level) <= int(_MAX_SAVED_LEVEL):
+                sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            try:
+                session = ort.InferenceSession(cached_path, sess_options=sess_options, providers=providers, **provider_kwargs)
+                info["optimized_model_cache"] = "hit"
+                return session, info
+            except Exception as e:
+                print(f"Optimized model cache unusable, rebuilding: {e}")
+                try:
+                    os.remove(cached_path)
+                except OSError:
+                    pass
+
+        sess_options = build_session_options(options, intra_threads, inter_threads)
+        requested_level = sess_options.graph_optimization_level
+        saved_level = _saved_level(requested_level)
+        os.makedirs(ORT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if saved_level == requested_level:
+            sess_options.optimized_model_filepath = tmp_path
+            session = ort.InferenceSession(model_path, sess_options=sess_options, providers=providers, **provider_kwargs)
+        else:
+            # 先以 extended 级别离线保存 (与硬件无关)，再从该文件以完整级别创建服务会话
+            save_options = build_session_options(options, intra_threads, inter_threads)
+            save_options.graph_optimization_level = saved_level
+            save_options.optimized_model_filepath = tmp_path
+            ort.InferenceSession(model_path, sess_options=save_options, providers=providers, **provider_kwargs)
+            session = ort.InferenceSession(tmp_path, sess_options=sess_options, providers=providers, **provider_kwargs)
+        try:
+            os.replace(tmp_path, cached_path)
+            info["optimized_model_cache"] = "miss"
+        except OSError as e:
+            print(f"Failed to store optimized model: {e}")
+            info["optimized_model_cache"] = "error"
+        return session, info
+
+    sess_options = build_session_options(options, intra_threads, inter_threads)
+    session = ort.InferenceSession(model_path, sess_options=sess_options, providers=providers, **provider_kwargs)
+    return session, info
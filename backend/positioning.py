@@ -4,6 +4,7 @@ import cv2
 import os
 from typing import List, Optional, Tuple, Any
 from pydantic import BaseModel
+from utils import load_page_array, page_image_available
 
 # 假设我们在 main.py 所在的同级目录，或者可以从 main 导入模型
 # 为了避免循环引用，我们在这里重新定义简化的解析器逻辑，或者接收字典
@@ -176,7 +177,7 @@ def find_image_position(locator: Any, image_path: str) -> Optional[Tuple[float,
     """
     使用 OpenCV 模板匹配寻找图像位置
     """
-    if not locator.image_ref or not os.path.exists(image_path):
+    if not locator.image_ref or not page_image_available(image_path):
         return None
     
     # 获取参考图像（模板）
@@ -190,7 +191,8 @@ def find_image_position(locator: Any, image_path: str) -> Optional[Tuple[float,
         return None
         
     try:
-        img_target = cv2.imread(image_path)
+        # 页面像素来自内存栅格 (若已渲染)，无需重新解码 PNG
+        img_target = cv2.cvtColor(load_page_array(image_path), cv2.COLOR_RGB2BGR)
         img_template = cv2.imread(template_path)
         
         if img_target is None or img_template is None:
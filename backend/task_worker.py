@@ -133,16 +133,16 @@ class TaskWorker:
         # 转换为图片
         img_subdir = f"images_{fingerprint[:8]}"
         img_save_path = os.path.join(self.main_module.UPLOAD_DIR, img_subdir)
-        image_paths = pdf_to_images(file_path, img_save_path)
+        image_paths = pdf_to_images(file_path, img_save_path, background_write=True)
         
-        # 尝试自动匹配模板
-        candidates = self.main_module.db.get_all_auto_templates()
+        # 尝试自动匹配模板 (使用内存中的模板指纹索引)
+        template_index = self.main_module.get_template_index()
         matched_template = None
         matching_regions = []
         
-        if candidates:
+        if len(template_index):
             match_cand, score = self.main_module.fp_engine.find_best_match(
-                file_path, candidates, threshold=0.7
+                file_path, threshold=0.7, index=template_index
             )
             
             if match_cand:
@@ -155,12 +155,16 @@ class TaskWorker:
                     with open(t_path, "r", encoding="utf-8") as f:
                         t_data = json.load(f)
                     regions_objs = [Region(**r) for r in t_data.get("regions", [])]
-                    matching_regions = self.main_module.extract_text_from_regions(
-                        file_path, regions_objs,
-                        image_path=image_paths[0] if image_paths else None,
-                        fingerprint=fingerprint
-                    )
-                    matched_template = match_cand
+                    # 多页匹配：从与模板第 1 页对应的那一页提取；文件中没有该页时视为未匹配
+                    page_idx = self.main_module.extraction_page(match_cand, len(image_paths))
+                    if page_idx is not None:
+                        matching_regions = self.main_module.extract_text_from_regions(
+                            file_path, regions_objs,
+                            image_path=image_paths[page_idx] if image_paths else None,
+                            fingerprint=fingerprint,
+                            page_idx=page_idx
+                        )
+                        matched_template = match_cand
         
         # 如果没有匹配，抛出异常，不再回退到 AI 识别
         if not matched_template:
@@ -217,7 +221,7 @@ class TaskWorker:
         fingerprint = self.main_module.get_file_fingerprint(file_path)
         img_subdir = f"images_{fingerprint[:8]}"
         img_save_path = os.path.join(self.main_module.UPLOAD_DIR, img_subdir)
-        image_paths = pdf_to_images(file_path, img_save_path)
+        image_paths = pdf_to_images(file_path, img_save_path, background_write=True)
         
         # 提取数据
         regions_objs = [Region(**r) for r in t_data.get("regions", [])]
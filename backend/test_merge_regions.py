@@ -0,0 +1,102 @@
+import random
+import time
+
+from fingerprint import engine
+
+
+def reference_merge(regions, mode='moderate'):
+    """原始的逐对 IoU 循环实现 (向量化版本必须与之完全一致)"""
+    if mode == 'off' or not regions:
+        return regions
+    iou_threshold = 0.3 if mode == 'aggressive' else 0.5
+
+    def get_rect(r):
+        w = r[3]
+        h = r[4]
+        return {'x': r[1] - w / 2, 'y': r[2] - h / 2, 'w': w, 'h': h, 'cls': r[0]}
+
+    rects = [get_rect(r) for r in regions]
+    merged_indices = set()
+    final_rects = []
+    for i in range(len(rects)):
+        if i in merged_indices:
+            continue
+        current = rects[i].copy()
+        merged_indices.add(i)
+        for j in range(i + 1, len(rects)):
+            if j in merged_indices:
+                continue
+            other = rects[j]
+            if current['cls'] != other['cls']:
+                continue
+            x1 = max(current['x'], other['x'])
+            y1 = max(current['y'], other['y'])
+            x2 = min(current['x'] + current['w'], other['x'] + other['w'])
+            y2 = min(current['y'] + current['h'], other['y'] + other['h'])
+            if x2 <= x1 or y2 <= y1:
+                intersection = 0
+            else:
+                intersection = (x2 - x1) * (y2 - y1)
+            union = current['w'] * current['h'] + other['w'] * other['h'] - intersection
+            iou = 0 if union <= 0 else intersection / union
+            if iou >= iou_threshold:
+                new_x = min(current['x'], other['x'])
+                new_y = min(current['y'], other['y'])
+                new_x2 = max(current['x'] + current['w'], other['x'] + other['w'])
+                new_y2 = max(current['y'] + current['h'], other['y'] + other['h'])
+                current['x'] = new_x
+                current['y'] = new_y
+                current['w'] = new_x2 - new_x
+                current['h'] = new_y2 - new_y
+                merged_indices.add(j)
+        final_rects.append(current)
+
+    return [[r['cls'], round(r['x'] + r['w'] / 2, 4), round(r['y'] + r['h'] / 2, 4),
+             round(r['w'], 4), round(r['h'], 4)] for r in final_rects]
+
+
+def random_regions(rng, n, classes):
+    regions = []
+    for _ in range(n):
+        if regions and rng.random() < 0.4:
+            # 在已有框附近生成抖动框，制造大量重叠 (conf=0.1 时的典型情况)
+            base = rng.choice(regions)
+            box = [base[0]] + [round(v + rng.uniform(-0.02, 0.02), 4) for v in base[1:]]
+        else:
+            box = [rng.choice(classes), round(rng.random(), 4), round(rng.random(), 4),
+                   round(rng.uniform(0.0, 0.4), 4), round(rng.uniform(0.0, 0.2), 4)]
+        regions.append(box)
+    return regions
+
+
+def test():
+    rng = random.Random(17)
+    cases = 0
+    print("--- Equivalence: vectorized vs reference ---")
+    for mode in ('moderate', 'aggressive', 'off'):
+        for trial in range(300):
+            n = rng.choice([0, 1, 2, 5, 20, 60, 150])
+            regions = random_regions(rng, n, classes=[0, 1, 2, 3, 5] if trial % 2 else [1])
+            # 边界情况：零面积框、完全重合的框
+            if n and trial % 7 == 0:
+                regions.append([regions[0][0], regions[0][1], regions[0][2], 0.0, 0.0])
+                regions.append(list(regions[0]))
+            expected = reference_merge([list(r) for r in regions], mode)
+            actual = engine.merge_overlapping_regions([list(r) for r in regions], mode)
+            assert actual == expected, f"Mismatch ({mode}, n={n}):\n{expected}\n{actual}"
+            cases += 1
+    print(f"  {cases} cases identical")
+
+    print("--- Timing (400 boxes, moderate) ---")
+    regions = random_regions(rng, 400, classes=[0, 1, 3, 5])
+    start = time.perf_counter()
+    reference_merge([list(r) for r in regions])
+    ref_time = time.perf_counter() - start
+    start = time.perf_counter()
+    engine.merge_overlapping_regions([list(r) for r in regions])
+    vec_time = time.perf_counter() - start
+    print(f"  reference {ref_time * 1000:.1f} ms, vectorized {vec_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    test()
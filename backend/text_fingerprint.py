@@ -0,0 +1,190 @@
+"""
+Text-layer fingerprint tier for born-digital PDFs.
+
+The visual fingerprint renders page 1 and runs the layout model at conf=0.1,
+even when the PDF carries a text layer that pdfplumber reads in milliseconds.
+For native pages (ocr_utils.is_page_scanned is False) features["text_layer"]
+holds a second, model-free fingerprint of page 1:
+
+    grid     word-box coverage on a GRID_ROWS x GRID_COLS grid, uint8 (255 = cell fully covered)
+    h_lines  horizontal ruling lines (lines + rect edges) binned by y, total length
+             per bin in per-mille of the page width
+    v_lines  vertical ruling lines binned by x, per-mille of the page height
+    tokens   key-label tokens: words without digits, lower-cased and stripped of
+             punctuation (labels such as "invoice", "total", "税号" rather than values)
+
+Two text layers score
+    0.45 * Dice(tokens) + 0.35 * cosine(grid) + 0.20 * cosine(lines)
+with the line term dropped (weights renormalised) when neither page has ruling
+lines, behind the same 0.05 aspect-ratio gate as the visual tier. Scanned
+pages get text_layer = None and are matched visually only.
+
+Configuration (environment variables):
+    FINGERPRINT_TEXT_TIER       1 (default) | 0: try the text tier first in find_best_match
+    FINGERPRINT_TEXT_THRESHOLD  minimum text-tier score to accept a match (default 0.7)
+"""
+
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+import pdfplumber
+
+from ocr_utils import is_page_scanned
+
+TEXT_LAYER_VERSION = "t1"
+GRID_ROWS = 16
+GRID_COLS = 12
+LINE_BINS = 32
+MAX_TOKENS = 128
+AR_GATE = 0.05
+
+W_TOKENS = 0.45
+W_GRID = 0.35
+W_LINES = 0.20
+
+_PUNCT = re.compile(r"[\s\.,:;：，。、()（）\[\]【】#№/\\\-_'\"|*]+")
+_DIGIT = re.compile(r"\d")
+
+
+def text_tier_enabled() -> bool:
+    return os.environ.get("FINGERPRINT_TEXT_TIER", "1").lower() not in ("0", "false", "no", "off")
+
+
+def text_threshold() -> float:
+    return float(os.environ.get("FINGERPRINT_TEXT_THRESHOLD", "0.7"))
+
+
+# ========== 提取 ==========
+
+def _coverage(lo: np.ndarray, hi: np.ndarray, bins: int) -> np.ndarray:
+    """归一化区间 [lo, hi] 在每个格子内的覆盖长度 (以格子宽度为 1)，形状 (n, bins)"""
+    edges = np.arange(bins, dtype=np.float64)
+    return np.clip(np.minimum(hi[:, None] * bins, edges + 1) - np.maximum(lo[:, None] * bins, edges), 0.0, None)
+
+
+def _label_tokens(words: List[Dict]) -> List[str]:
+    tokens = []
+    seen = set()
+    for w in words:
+        token = _PUNCT.sub("", w.get("text", "")).lower()
+        if len(token) < 2 or _DIGIT.search(token) or token in seen:
+            continue
+        seen.add(token)
+        tokens.append(token)
+        if len(tokens) >= MAX_TOKENS:
+            break
+    return tokens
+
+
+def extract_text_layer(page) -> Optional[Dict]:
+    """pdfplumber Page -> text_layer；扫描页 (无文本层) 返回 None"""
+    if is_page_scanned(page):
+        return None
+    x0, top, x1, bottom = (float(v) for v in page.bbox)
+    width, height = (x1 - x0) or 1.0, (bottom - top) or 1.0
+
+    words = page.extract_words()
+    grid = np.zeros((GRID_ROWS, GRID_COLS), dtype=np.float64)
+    if words:
+        boxes = np.array([[w["x0"], w["top"], w["x1"], w["bottom"]] for w in words], dtype=np.float64)
+        nx = np.clip((boxes[:, [0, 2]] - x0) / width, 0.0, 1.0)
+        ny = np.clip((boxes[:, [1, 3]] - top) / height, 0.0, 1.0)
+        # 每个词框对格子的覆盖面积 = 行覆盖 x 列覆盖 (外积)，向量化累加
+        grid = _coverage(ny[:, 0], ny[:, 1], GRID_ROWS).T @ _coverage(nx[:, 0], nx[:, 1], GRID_COLS)
+
+    h_lines = np.zeros(LINE_BINS, dtype=np.float64)
+    v_lines = np.zeros(LINE_BINS, dtype=np.float64)
+    for edge in page.edges:
+        if edge.get("orientation") == "h":
+            pos = (float(edge["top"]) - top) / height
+            h_lines[min(max(int(pos * LINE_BINS), 0), LINE_BINS - 1)] += (float(edge["x1"]) - float(edge["x0"])) / width
+        elif edge.get("orientation") == "v":
+            pos = (float(edge["x0"]) - x0) / width
+            v_lines[min(max(int(pos * LINE_BINS), 0), LINE_BINS - 1)] += (float(edge["bottom"]) - float(edge["top"])) / height
+
+    return {
+        "version": TEXT_LAYER_VERSION,
+        "grid": np.round(np.clip(grid, 0.0, 1.0) * 255).astype(int).ravel().tolist(),
+        "h_lines": np.clip(np.round(h_lines * 1000), 0, 65535).astype(int).tolist(),
+        "v_lines": np.clip(np.round(v_lines * 1000), 0, 65535).astype(int).tolist(),
+        "tokens": _label_tokens(words),
+    }
+
+
+def extract_text_features(file_path: str, page_idx: int = 0) -> Optional[Dict]:
+    """
+    上传文件的文本层指纹 {"aspect_ratio", "text_layer"}，只读取 PDF 文本层，不渲染、不推理。
+    非 PDF、页码越界或扫描页返回 None (由视觉指纹处理)。
+    """
+    try:
+        with pdfplumber.open(file_path) as pdf:
+            if page_idx >= len(pdf.pages):
+                return None
+            page = pdf.pages[page_idx]
+            text_layer = extract_text_layer(page)
+            if text_layer is None:
+                return None
+            return {
+                "aspect_ratio": round(float(page.width) / float(page.height), 3),
+                "text_layer": text_layer,
+            }
+    except Exception as e:
+        print(f"Text-layer fingerprint unavailable for {file_path}: {e}")
+        return None
+
+
+# ========== 打分 ==========
+
+def _unit(values) -> np.ndarray:
+    vec = np.asarray(values, dtype=np.float64)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+class PreparedText:
+    """解析后的文本层：网格与直线直方图为单位向量 (余弦 = 点积)，关键词为 frozenset"""
+    __slots__ = ('aspect_ratio', 'grid', 'lines', 'has_lines', 'tokens')
+
+    def __init__(self, text_layer: Dict, aspect_ratio: float):
+        self.aspect_ratio = float(aspect_ratio or 0)
+        self.grid = _unit(text_layer.get("grid", []))
+        lines = list(text_layer.get("h_lines", [])) + list(text_layer.get("v_lines", []))
+        self.lines = _unit(lines)
+        self.has_lines = bool(np.any(self.lines))
+        self.tokens = frozenset(text_layer.get("tokens", []))
+
+    @classmethod
+    def from_features(cls, features: Dict) -> Optional["PreparedText"]:
+        """版本不符或网格尺寸不一致的文本层不可比较，返回 None"""
+        text_layer = features.get("text_layer")
+        if not text_layer or text_layer.get("version") != TEXT_LAYER_VERSION:
+            return None
+        if len(text_layer.get("grid", [])) != GRID_ROWS * GRID_COLS:
+            return None
+        if len(text_layer.get("h_lines", [])) + len(text_layer.get("v_lines", [])) != 2 * LINE_BINS:
+            return None
+        return cls(text_layer, features.get("aspect_ratio", 0))
+
+
+def token_dice(a: frozenset, b: frozenset) -> float:
+    if not a and not b:
+        return 0.0
+    return 2.0 * len(a & b) / (len(a) + len(b))
+
+
+def combine_scores(dice, grid_sim, line_sim, both_without_lines):
+    """加权合成 (标量或 NumPy 数组)；双方都没有直线时去掉直线项并重新归一化权重"""
+    with_lines = W_TOKENS * dice + W_GRID * grid_sim + W_LINES * line_sim
+    without_lines = (W_TOKENS * dice + W_GRID * grid_sim) / (W_TOKENS + W_GRID)
+    return np.where(both_without_lines, without_lines, with_lines)
+
+
+def text_similarity(t: PreparedText, c: PreparedText) -> float:
+    """两个文本层的相似度 (与 FingerprintIndex.match_text 的向量化打分一致)"""
+    if abs(t.aspect_ratio - c.aspect_ratio) > AR_GATE:
+        return 0.0
+    line_sim = float(c.lines @ t.lines) if (t.has_lines and c.has_lines) else 0.0
+    both_without = not t.has_lines and not c.has_lines
+    return float(combine_scores(token_dice(t.tokens, c.tokens), float(c.grid @ t.grid), line_sim, both_without))
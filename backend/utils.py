@@ -3,6 +3,14 @@ import os
 from PIL import Image
 import io
 import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
 
 # 支持的文件扩展名
 SUPPORTED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp', '.gif'}
@@ -35,7 +43,7 @@ def get_file_type(file_path: str) -> str:
     return 'unknown'
 
 
-def document_to_images(file_path: str, output_dir: str, dpi=200, target_long_side=4000, max_px=8000) -> list:
+def document_to_images(file_path: str, output_dir: str, dpi=200, target_long_side=4000, max_px=8000, background_write=False) -> list:
     """
     统一的文档转图片函数，支持 PDF 和图片文件输入。
     
@@ -52,7 +60,7 @@ def document_to_images(file_path: str, output_dir: str, dpi=200, target_long_sid
     
     if file_type == 'pdf':
         # PDF 文件使用原有的转换逻辑
-        return pdf_to_images(file_path, output_dir, dpi, target_long_side, max_px)
+        return pdf_to_images(file_path, output_dir, dpi, target_long_side, max_px, background_write=background_write)
     
     elif file_type == 'image':
         # 图片文件处理
@@ -128,65 +136,347 @@ def image_to_images(image_path: str, output_dir: str, target_long_side=4000, max
     return image_paths
 
 
-def pdf_to_images(pdf_path, output_dir, dpi=200, target_long_side=4000, max_px=8000):
+
+# ========== File Hash Cache ==========
+# 上传文件的 MD5 (模板匹配键 / 图片目录名) 流式分块计算，按 (路径, 大小, mtime) 缓存：
+# 同一文件在 /analyze、指纹匹配、任务队列、/regions/extract 等处只哈希一次。
+_HASH_CHUNK_SIZE = 1024 * 1024
+_FILE_HASH_ENTRIES = int(os.environ.get("FILE_HASH_CACHE_ENTRIES", "4096"))
+_FILE_HASH_CACHE: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_FILE_HASH_LOCK = threading.Lock()
+
+
+def _file_hash_key(file_path: str) -> Tuple[str, int, int]:
+    st = os.stat(file_path)
+    return (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+
+
+def _remember_file_hash(key: Tuple[str, int, int], digest: str):
+    with _FILE_HASH_LOCK:
+        _FILE_HASH_CACHE[key] = digest
+        _FILE_HASH_CACHE.move_to_end(key)
+        while len(_FILE_HASH_CACHE) > _FILE_HASH_ENTRIES:
+            _FILE_HASH_CACHE.popitem(last=False)
+
+
+def file_md5(file_path: str) -> str:
+    """文件 MD5 (分块读取，不整体载入内存)；文件未变化时直接返回缓存结果"""
+    key = _file_hash_key(file_path)
+    with _FILE_HASH_LOCK:
+        digest = _FILE_HASH_CACHE.get(key)
+        if digest is not None:
+            _FILE_HASH_CACHE.move_to_end(key)
+            return digest
+
+    hasher = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    _remember_file_hash(key, digest)
+    return digest
+
+
+def copy_and_hash(src, dst_path: str) -> str:
+    """替代 shutil.copyfileobj：写入上传文件的同时计算 MD5 并登记缓存，返回 MD5"""
+    hasher = hashlib.md5()
+    with open(dst_path, 'wb') as dst:
+        for chunk in iter(lambda: src.read(_HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            dst.write(chunk)
+    digest = hasher.hexdigest()
+    _remember_file_hash(_file_hash_key(dst_path), digest)
+    return digest
+
+
+def array_digest(array: np.ndarray) -> str:
+    """像素内容哈希 (含形状与类型)"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{array.shape}|{array.dtype.str}".encode())
+    h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+
+class PageRaster:
+    """
+    单页栅格：持有解码后的像素缓冲区 (HxWx3 uint8 RGB)。
+    同一请求内的版面推理、OCR 与 OpenCV 模板匹配共享该缓冲区，避免重复 PNG 编解码。
+    """
+    __slots__ = ('array', 'page_idx', 'dpi', 'path', '_digest')
+
+    def __init__(self, array: np.ndarray, page_idx: int = 0, dpi: Optional[float] = None, path: Optional[str] = None):
+        self.array = array
+        self.page_idx = page_idx
+        self.dpi = dpi
+        self.path = path
+        self._digest = None
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes
+
+    def bgr(self) -> np.ndarray:
+        """OpenCV / RapidOCR 约定的 BGR 通道顺序 (新数组)"""
+        return cv2.cvtColor(self.array, cv2.COLOR_RGB2BGR)
+
+    def content_hash(self) -> str:
+        """像素内容哈希 (首次调用时计算并缓存，栅格内容视为不可变)"""
+        if self._digest is None:
+            self._digest = array_digest(self.array)
+        return self._digest
+
+
+# ========== In-memory Raster Registry ==========
+# 以 PNG 路径为键登记已解码的页面栅格，使仍以 image_path 传参的调用方 (OCR / 定位 / 推理)
+# 直接复用内存像素。按总字节数做 LRU 淘汰。
+_RASTER_CACHE_BYTES = int(float(os.environ.get("RASTER_CACHE_MB", "512")) * 1024 * 1024)
+_RASTER_REGISTRY: "OrderedDict[str, PageRaster]" = OrderedDict()
+_RASTER_REGISTRY_BYTES = 0
+_RASTER_LOCK = threading.Lock()
+
+# PNG 仅供前端静态预览使用，改为后台写入
+_PNG_WRITER = ThreadPoolExecutor(max_workers=2, thread_name_prefix="png-writer")
+_PENDING_WRITES: Dict[str, "object"] = {}
+_PENDING_LOCK = threading.Lock()
+
+
+def _pending_write(image_path: str):
+    with _PENDING_LOCK:
+        return _PENDING_WRITES.get(os.path.abspath(image_path))
+
+
+def _await_pending_write(image_path: str, timeout: Optional[float] = None) -> bool:
+    """等待该页的后台 PNG 写入 (栅格可能已被 LRU 淘汰而文件尚未落盘)；返回写入是否成功"""
+    future = _pending_write(image_path)
+    if future is None:
+        return True
+    try:
+        future.result(timeout=timeout)
+        return True
+    except Exception as e:
+        print(f"Background PNG write failed for {image_path}: {e}")
+        return False
+
+
+def register_raster(raster: PageRaster) -> PageRaster:
+    """登记栅格到内存注册表 (需要 raster.path)"""
+    global _RASTER_REGISTRY_BYTES
+    if not raster.path:
+        return raster
+    key = os.path.abspath(raster.path)
+    with _RASTER_LOCK:
+        previous = _RASTER_REGISTRY.pop(key, None)
+        if previous is not None:
+            _RASTER_REGISTRY_BYTES -= previous.nbytes
+        _RASTER_REGISTRY[key] = raster
+        _RASTER_REGISTRY_BYTES += raster.nbytes
+        while _RASTER_REGISTRY_BYTES > _RASTER_CACHE_BYTES and len(_RASTER_REGISTRY) > 1:
+            _, evicted = _RASTER_REGISTRY.popitem(last=False)
+            _RASTER_REGISTRY_BYTES -= evicted.nbytes
+    return raster
+
+
+def get_page_raster(image_path: Optional[str]) -> Optional[PageRaster]:
+    """从内存注册表获取栅格 (不触发磁盘读取)"""
+    if not image_path:
+        return None
+    key = os.path.abspath(image_path)
+    with _RASTER_LOCK:
+        raster = _RASTER_REGISTRY.get(key)
+        if raster is not None:
+            _RASTER_REGISTRY.move_to_end(key)
+        return raster
+
+
+def load_page_raster(image_path: str) -> PageRaster:
+    """获取页面栅格：优先内存，否则从磁盘解码一次并登记，供后续调用复用"""
+    raster = get_page_raster(image_path)
+    if raster is not None:
+        return raster
+    _await_pending_write(image_path)
+    data = np.fromfile(image_path, dtype=np.uint8)
+    bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError(f"Unable to decode image: {image_path}")
+    return register_raster(PageRaster(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB), path=image_path))
+
+
+def load_page_array(image_path: str) -> np.ndarray:
+    """页面像素 (HxWx3 RGB)"""
+    return load_page_raster(image_path).array
+
+
+def get_page_size(image_path: str) -> Tuple[int, int]:
+    """页面像素尺寸 (width, height)，内存中存在时无需读取文件"""
+    raster = get_page_raster(image_path)
+    if raster is not None:
+        return raster.width, raster.height
+    with Image.open(image_path) as img:
+        return img.size
+
+
+def page_image_available(image_path: Optional[str]) -> bool:
+    """页面图像可用：已在内存中，或磁盘文件存在 (后台写入尚未完成时等待其完成)"""
+    if not image_path:
+        return False
+    if get_page_raster(image_path) is not None:
+        return True
+    return _await_pending_write(image_path) and os.path.exists(image_path)
+
+
+def _write_png(raster: PageRaster, img_path: str):
+    # 先写临时文件再原子替换，避免其他请求读到半个 PNG
+    tmp_path = img_path + ".tmp"
+    ok, encoded = cv2.imencode(".png", raster.bgr())
+    if not ok:
+        raise ValueError(f"PNG encode failed: {img_path}")
+    encoded.tofile(tmp_path)
+    os.replace(tmp_path, img_path)
+
+
+def save_raster_png(raster: PageRaster, img_path: str, background: bool = False):
+    """将栅格保存为 PNG，background=True 时在后台线程写入"""
+    if not background:
+        _write_png(raster, img_path)
+        return
+    key = os.path.abspath(img_path)
+    with _PENDING_LOCK:
+        future = _PNG_WRITER.submit(_write_png, raster, img_path)
+        _PENDING_WRITES[key] = future
+    future.add_done_callback(lambda f, k=key: _finish_pending_write(k, f))
+
+
+def _finish_pending_write(key: str, future):
+    with _PENDING_LOCK:
+        if _PENDING_WRITES.get(key) is future:
+            del _PENDING_WRITES[key]
+
+
+def wait_for_page_writes(image_paths: List[str], timeout: Optional[float] = None):
+    """等待指定页面的后台 PNG 写入完成 (用于需要静态预览的响应)"""
+    for p in image_paths:
+        _await_pending_write(p, timeout=timeout)
+
+
+def _pdf_render_dpi(page, dpi=200, target_long_side=4000, max_px=8000) -> float:
+    rect = page.rect
+    w_pt, h_pt = rect.width, rect.height
+    long_side_pt = max(w_pt, h_pt)
+    
+    adaptive_dpi = (target_long_side / long_side_pt) * 72
+    final_dpi = max(dpi, min(600, adaptive_dpi))
+    
+    if (long_side_pt * final_dpi / 72) > max_px:
+        final_dpi = (max_px / long_side_pt) * 72
+    return final_dpi
+
+
+def pixmap_to_array(pix) -> np.ndarray:
+    """PyMuPDF Pixmap -> HxWx3 uint8 RGB (单次拷贝，不经过 PIL/PNG)"""
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    arr = arr[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1:
+        return cv2.cvtColor(arr, cv2.COLOR_GRAY2RGB)
+    if pix.n == 4:
+        return np.ascontiguousarray(arr[:, :, :3])
+    return arr
+
+
+def render_pdf_page(page, dpi=200, target_long_side=4000, max_px=8000) -> PageRaster:
+    """以自适应 DPI 将 PDF 页渲染为内存栅格"""
+    final_dpi = _pdf_render_dpi(page, dpi, target_long_side, max_px)
+    matrix = fitz.Matrix(final_dpi / 72, final_dpi / 72)
+    pix = page.get_pixmap(matrix=matrix)
+    return PageRaster(pixmap_to_array(pix), page_idx=page.number, dpi=final_dpi)
+
+
+def render_pdf_page_for_model(pdf_path, imgsz=1024, page_idx=0) -> Optional[PageRaster]:
+    """
+    指纹专用快速路径：只渲染单页，长边直接对齐模型输入尺寸 (imgsz)。
+    不落盘、不登记注册表，推理前无需再缩放。
+    """
+    with fitz.open(pdf_path) as doc:
+        if page_idx >= len(doc):
+            return None
+        page = doc.load_page(page_idx)
+        long_side_pt = max(page.rect.width, page.rect.height)
+        zoom = imgsz / long_side_pt
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return PageRaster(pixmap_to_array(pix), page_idx=page_idx, dpi=zoom * 72)
+
+
+def render_pdf_pages_for_model(pdf_path, page_indices, imgsz=1024) -> List[PageRaster]:
+    """render_pdf_page_for_model 的多页版本：只打开一次文档，跳过超出页数的页码"""
+    rasters = []
+    with fitz.open(pdf_path) as doc:
+        for page_idx in page_indices:
+            if page_idx >= len(doc):
+                continue
+            page = doc.load_page(page_idx)
+            zoom = imgsz / max(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            rasters.append(PageRaster(pixmap_to_array(pix), page_idx=page_idx, dpi=zoom * 72))
+    return rasters
+
+
+def pdf_to_rasters(pdf_path, output_dir=None, dpi=200, target_long_side=4000, max_px=8000,
+                   write_png=True, background_write=False) -> List[PageRaster]:
+    """
+    将 PDF 渲染为内存栅格列表。
+    output_dir 非空时为每页分配 page_N.png 路径并登记到内存注册表；
+    write_png 控制是否落盘 (background_write=True 时后台写入)。
+    """
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    
+    rasters = []
+    with fitz.open(pdf_path) as doc:
+        for i in range(len(doc)):
+            raster = render_pdf_page(doc.load_page(i), dpi, target_long_side, max_px)
+            if output_dir:
+                raster.path = os.path.join(output_dir, f"page_{i+1}.png")
+                register_raster(raster)
+                if write_png:
+                    save_raster_png(raster, raster.path, background=background_write)
+            rasters.append(raster)
+    return rasters
+
+
+def pdf_to_images(pdf_path, output_dir, dpi=200, target_long_side=4000, max_px=8000, background_write=False):
     """
     Converts PDF pages to images with adaptive DPI.
     Targeting a specific pixel count for the long side to ensure OCR accuracy
     regardless of physical PDF dimensions (A4 vs A0).
+    
+    渲染结果同时登记为内存栅格；background_write=True 时 PNG 在后台写入，
+    调用方可立即通过返回的路径使用内存像素。
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Fast path: check if images already exist before opening PDF
-    # This assumes we want all pages. If we need page count, we must open.
-    # However, for performance, we can open once and cache the count if needed, 
-    # but here we'll just check if page_1.png exists as a heuristic or better, 
-    # open the doc once to get count.
-    
+    # Fast path: check if images already exist (on disk or in memory) before rendering
     doc = fitz.open(pdf_path)
     total_pages = len(doc)
     
-    image_paths = []
-    all_exist = True
-    for i in range(total_pages):
-        img_path = os.path.join(output_dir, f"page_{i+1}.png")
-        if not os.path.exists(img_path) or os.path.getsize(img_path) == 0:
-            all_exist = False
-            break
-        image_paths.append(img_path)
-        
-    if all_exist and len(image_paths) == total_pages:
-        doc.close()
-        # print(f"Using existing images in {output_dir}")
-        return image_paths
-
-    # Reset image_paths and do actual conversion
-    image_paths = []
-    for i in range(total_pages):
-        img_filename = f"page_{i+1}.png"
-        img_path = os.path.join(output_dir, img_filename)
-        
-        if os.path.exists(img_path) and os.path.getsize(img_path) > 0:
-            image_paths.append(img_path)
-            continue
-            
-        page = doc.load_page(i)
-        rect = page.rect
-        w_pt, h_pt = rect.width, rect.height
-        long_side_pt = max(w_pt, h_pt)
-        
-        adaptive_dpi = (target_long_side / long_side_pt) * 72
-        final_dpi = max(dpi, min(600, adaptive_dpi))
-        
-        if (long_side_pt * final_dpi / 72) > max_px:
-            final_dpi = (max_px / long_side_pt) * 72
-            
-        matrix = fitz.Matrix(final_dpi / 72, final_dpi / 72)
-        pix = page.get_pixmap(matrix=matrix)
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        img.save(img_path)
-        image_paths.append(img_path)
+    image_paths = [os.path.join(output_dir, f"page_{i+1}.png") for i in range(total_pages)]
+    missing = [
+        i for i, p in enumerate(image_paths)
+        if get_page_raster(p) is None and (not os.path.exists(p) or os.path.getsize(p) == 0)
+    ]
+    
+    for i in missing:
+        raster = render_pdf_page(doc.load_page(i), dpi, target_long_side, max_px)
+        raster.path = image_paths[i]
+        register_raster(raster)
+        save_raster_png(raster, raster.path, background=background_write)
         
     doc.close()
     return image_paths
@@ -0,0 +1,117 @@
+"""
+Background model warm-up.
+
+startup_event calls start_warmup(), which loads the layout sessions and the
+RapidOCR engine on a daemon thread and runs one dummy inference through each,
+so graph optimization and memory-arena allocation happen before the first
+real request instead of inside it. Per-model readiness and timings are
+reported by get_warmup_status() (served on /health). A failed layout model
+keeps the service not ready (/health/ready returns 503); a failed OCR
+engine is listed but does not block readiness.
+
+Configuration (environment variables):
+    WARMUP_ENABLED   0 disables warm-up (models load lazily on first use)
+    WARMUP_OCR       0 skips the OCR engine (e.g. deployments that never OCR)
+"""
+
+import os
+import threading
+import time
+import traceback
+from typing import Dict
+
+import numpy as np
+
+_status_lock = threading.Lock()
+_status: Dict[str, Dict] = {
+    "layout": {"status": "pending"},
+    "ocr": {"status": "pending"},
+}
+_thread = None
+
+# 失败时不影响就绪状态的模型 (OCR 只用于扫描件)
+OPTIONAL_MODELS = ("ocr",)
+
+
+def _set(model: str, **fields):
+    with _status_lock:
+        _status[model].update(fields)
+
+
+def _enabled(name: str) -> bool:
+    return os.environ.get(name, "1").lower() not in ("0", "false", "no")
+
+
+def _warm(model: str, load, run):
+    """load() 创建会话，run() 执行一次空推理；分别计时"""
+    _set(model, status="loading", started_at=time.time())
+    try:
+        start = time.perf_counter()
+        load()
+        loaded = time.perf_counter()
+        _set(model, status="warming", load_seconds=round(loaded - start, 3))
+        run()
+        _set(model, status="ready", warmup_seconds=round(time.perf_counter() - loaded, 3))
+    except Exception as e:
+        traceback.print_exc()
+        _set(model, status="failed", error=str(e))
+
+
+def _warm_layout():
+    from inference_service import get_inference_service
+    service = get_inference_service()
+    if service is not None:
+        # 进程池模式：模型在 worker 初始化时加载，空推理同时拉起全部 worker
+        _warm("layout", load=lambda: None, run=service.warm_up)
+        _set("layout", mode="process_pool")
+        return
+
+    from inference import get_layout_pool
+    _warm("layout", load=get_layout_pool, run=lambda: get_layout_pool().warm_up())
+    _set("layout", mode="in_process")
+
+
+def _warm_ocr():
+    from inference_service import get_inference_service
+    if get_inference_service() is not None:
+        # worker 进程的 OCR 由 service.warm_up 一并预热
+        _set("ocr", status="ready", mode="process_pool")
+        return
+
+    from ocr_utils import get_ocr_engine, run_ocr_on_image
+    blank = np.full((64, 256, 3), 255, dtype=np.uint8)
+    _warm("ocr", load=get_ocr_engine, run=lambda: run_ocr_on_image(blank))
+    _set("ocr", mode="in_process")
+
+
+def _run():
+    _warm_layout()
+    if _enabled("WARMUP_OCR"):
+        _warm_ocr()
+    else:
+        _set("ocr", status="disabled")
+
+
+def start_warmup():
+    """在后台线程中预热模型 (重复调用无副作用)"""
+    global _thread
+    if not _enabled("WARMUP_ENABLED"):
+        for model in _status:
+            _set(model, status="disabled")
+        return
+    if _thread is not None:
+        return
+    _thread = threading.Thread(target=_run, name="model-warmup", daemon=True)
+    _thread.start()
+
+
+def get_warmup_status() -> Dict:
+    with _status_lock:
+        models = {name: dict(info) for name, info in _status.items()}
+    # 预热结束即视为就绪；必需模型 (版面) 加载失败时不就绪，可选模型 (OCR) 失败仅单独列出
+    failed = [name for name, info in models.items() if info["status"] == "failed"]
+    ready = all(
+        info["status"] in ("ready", "disabled") or (info["status"] == "failed" and name in OPTIONAL_MODELS)
+        for name, info in models.items()
+    )
+    return {"ready": ready, "failed": failed, "models": models}
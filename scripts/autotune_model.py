@@ -0,0 +1,167 @@
+"""
+Pick the fastest layout model variant for this host without giving up accuracy.
+
+Benchmarks every variant found in the models directory (fp32 / simplified /
+int8_dynamic / int8_static, see inference.MODEL_VARIANTS) on a calibration
+set of page images, compares each variant's boxes against FP32 and writes the
+fastest variant whose agreement stays within tolerance to
+<models>/layout_autotune.json. LayoutEngine picks it up on the next start
+(LAYOUT_MODEL_VARIANT still takes precedence).
+
+Variants are produced by scripts/optimize_model.py and
+scripts/quantize_model_legacy.py.
+
+Usage:
+    python scripts/autotune_model.py [--images GLOB] [--limit 20] [--tolerance 0.02]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+# Add backend to path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import numpy as np
+
+from box_ops import match_f1
+from inference import (
+    AUTOTUNE_FILENAME, DOCLAYOUT_CLASSES, DEFAULT_MODEL_VARIANT, LayoutEngine,
+    available_model_variants, get_models_dir, host_signature, to_rgb_array,
+)
+
+CLASS_IDS = {name.lower(): cls_id for cls_id, name in DOCLAYOUT_CLASSES.items()}
+
+
+def regions_to_arrays(regions):
+    """predict() 输出的归一化区域 -> (xyxy, class)"""
+    xyxy = np.array(
+        [[r["x"], r["y"], r["x"] + r["width"], r["y"] + r["height"]] for r in regions], dtype=np.float32
+    ).reshape(-1, 4)
+    cls = np.array([CLASS_IDS.get(r["type"], -1) for r in regions], dtype=np.int64)
+    return xyxy, cls
+
+
+def benchmark_variant(variant, path, images, repeats, predict_kwargs):
+    engine = LayoutEngine(model_path=path, variant=variant)
+    # 预热：首次运行包含图优化与内存分配
+    engine.predict(images[0], **predict_kwargs)
+
+    outputs, latencies = [], []
+    for img in images:
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            boxes = engine.predict(img, **predict_kwargs)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        outputs.append(boxes)
+        latencies.append(best * 1000)
+    return outputs, latencies
+
+
+def main():
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    default_images = os.path.join(base_dir, "backend", "data", "uploads", "images_*", "*.png")
+
+    parser = argparse.ArgumentParser(description="Select the fastest accurate layout model variant for this host")
+    parser.add_argument("--images", default=default_images, help="calibration image glob")
+    parser.add_argument("--limit", type=int, default=20, help="max calibration images")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per image (best is kept)")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="max allowed drop of mean box F1 vs FP32")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU needed for two boxes to agree")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--imgsz", type=int, default=1024)
+    parser.add_argument("--fast-mode", action="store_true", help="benchmark without image enhancement")
+    parser.add_argument("--dry-run", action="store_true", help="print the result without writing it")
+    args = parser.parse_args()
+
+    image_paths = sorted(glob.glob(args.images))[:args.limit]
+    if not image_paths:
+        print(f"No calibration images found for {args.images}")
+        sys.exit(1)
+
+    variants = available_model_variants()
+    if DEFAULT_MODEL_VARIANT not in variants:
+        print(f"Reference model ({DEFAULT_MODEL_VARIANT}) not found in {get_models_dir()}")
+        sys.exit(1)
+
+    print(f"Calibration set: {len(image_paths)} images; variants: {', '.join(variants)}")
+    images = [to_rgb_array(p) for p in image_paths]
+    predict_kwargs = dict(conf=args.conf, imgsz=args.imgsz, fast_mode=args.fast_mode, use_cache=False)
+
+    reference = None
+    results = {}
+    for variant, path in variants.items():
+        try:
+            outputs, latencies = benchmark_variant(variant, path, images, args.repeats, predict_kwargs)
+        except Exception as e:
+            print(f"  {variant:<14} failed: {e}")
+            results[variant] = {"path": os.path.basename(path), "error": str(e)}
+            continue
+
+        if variant == DEFAULT_MODEL_VARIANT:
+            reference = [regions_to_arrays(o) for o in outputs]
+        results[variant] = {
+            "path": os.path.basename(path),
+            "latency_ms_mean": round(float(np.mean(latencies)), 2),
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+            "_outputs": outputs,
+        }
+
+    if reference is None:
+        # 没有 FP32 参照就无法验证其他变体的一致性，不做选择
+        print(f"Reference model ({DEFAULT_MODEL_VARIANT}) failed: "
+              f"{results[DEFAULT_MODEL_VARIANT].get('error')}; cannot check agreement, no variant selected")
+        sys.exit(1)
+
+    # 与 FP32 对比框一致性
+    for variant, res in results.items():
+        outputs = res.pop("_outputs", None)
+        if outputs is None:
+            continue
+        scores = [
+            match_f1(ref_xyxy, ref_cls, *regions_to_arrays(o), iou_threshold=args.iou)
+            for (ref_xyxy, ref_cls), o in zip(reference, outputs)
+        ]
+        res["agreement_mean"] = round(float(np.mean(scores)), 4)
+        res["agreement_min"] = round(float(np.min(scores)), 4)
+        res["accepted"] = variant == DEFAULT_MODEL_VARIANT or res["agreement_mean"] >= 1.0 - args.tolerance
+
+    accepted = [v for v, r in results.items() if r.get("accepted")]
+    selected = min(accepted, key=lambda v: results[v]["latency_ms_mean"]) if accepted else DEFAULT_MODEL_VARIANT
+
+    print(f"\n{'variant':<14} {'mean ms':>9} {'p95 ms':>9} {'F1 mean':>8} {'F1 min':>8}  accepted")
+    for variant, res in results.items():
+        if "error" in res:
+            print(f"{variant:<14} {'error':>9}")
+            continue
+        mark = "*" if variant == selected else ""
+        print(f"{variant:<14} {res['latency_ms_mean']:>9.1f} {res['latency_ms_p95']:>9.1f} "
+              f"{res['agreement_mean']:>8.3f} {res['agreement_min']:>8.3f}  {res['accepted']} {mark}")
+    print(f"\nSelected variant: {selected}")
+
+    result = {
+        "selected": selected,
+        "host": host_signature(),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "calibration_images": len(image_paths),
+        "tolerance": args.tolerance,
+        "iou": args.iou,
+        "predict": predict_kwargs,
+        "variants": results,
+    }
+    if args.dry_run:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return
+
+    out_path = os.path.join(get_models_dir(), AUTOTUNE_FILENAME)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"Saved to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Measure how much the fingerprint LSH table loses against brute-force scoring.
+
+The library is the auto-template table of the local database (or a folder of
+PDFs with --library-dir). Queries are either PDFs in --queries-dir or, by
+default, every library template matched leave-one-out against the rest.
+
+For every query the exact score is computed against all aspect-ratio-gated
+templates (the brute-force reference) and against the LSH near neighbours
+only. Reported:
+
+    recall@1      queries whose brute-force best match (score >= threshold)
+                  is also the LSH best match
+    match recall  fraction of all (query, template) pairs scoring >= threshold
+                  that the LSH table retrieves
+    candidates    mean templates scored per query, brute force vs LSH
+
+Usage:
+    python scripts/lsh_recall.py [--library-dir DIR] [--queries-dir DIR] [--threshold 0.7]
+                                 [--bands 16] [--rows 2] [--json report.json]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+# Add backend to path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from fingerprint import engine as fp_engine
+from fingerprint_index import FingerprintIndex
+from fingerprint_lsh import LSHTable
+
+
+def load_pdf_features(folder):
+    items = []
+    for path in sorted(glob.glob(os.path.join(folder, "**", "*.pdf"), recursive=True)):
+        try:
+            items.append((os.path.relpath(path, folder), fp_engine.extract_features(path)))
+        except Exception as e:
+            print(f"  skip {path}: {e}")
+    return items
+
+
+def load_library(args):
+    if args.library_dir:
+        return [
+            {"id": name, "fingerprint": name, "fingerprint_text": json.dumps(features)}
+            for name, features in load_pdf_features(args.library_dir)
+        ]
+    from database import db
+    return db.get_all_auto_templates()
+
+
+def evaluate(index, queries, threshold, leave_one_out):
+    stats = {"queries": 0, "with_match": 0, "top1_hits": 0, "pairs": 0, "pairs_hit": 0,
+             "brute_candidates": 0, "lsh_candidates": 0, "brute_seconds": 0.0, "lsh_seconds": 0.0}
+    misses = []
+    engine = index.engine
+
+    for q_id, features in queries:
+        target = engine.prepare(features)
+        if not target.has_boxes:
+            continue
+        stats["queries"] += 1
+
+        start = time.perf_counter()
+        ids, _, order = index.gated_candidates(target)
+        scored = []
+        for key, o in zip(ids, order):
+            if leave_one_out and key[0] == q_id:
+                continue
+            scored.append((engine.score_prepared(target, index.page(key)), -o, key))
+        stats["brute_seconds"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        near = index.lsh_candidates(target)
+        lsh_ids, _, _ = index.gated_candidates(target, allowed=near)
+        lsh_ids = {key for key in lsh_ids if not (leave_one_out and key[0] == q_id)}
+        lsh_scored = [s for s in scored if s[2] in lsh_ids]
+        stats["lsh_seconds"] += time.perf_counter() - start
+
+        stats["brute_candidates"] += len(scored)
+        stats["lsh_candidates"] += len(lsh_ids)
+
+        matches = [s for s in scored if s[0] >= threshold]
+        stats["pairs"] += len(matches)
+        stats["pairs_hit"] += sum(1 for s in matches if s[2] in lsh_ids)
+        if matches:
+            stats["with_match"] += 1
+            best = max(scored)
+            lsh_best = max(lsh_scored) if lsh_scored else None
+            if lsh_best is not None and lsh_best[2][0] == best[2][0]:
+                stats["top1_hits"] += 1
+            else:
+                misses.append({"query": q_id, "expected": best[2][0], "score": round(best[0], 4),
+                               "lsh_best": lsh_best[2][0] if lsh_best else None})
+    return stats, misses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report fingerprint LSH recall against brute-force scoring")
+    parser.add_argument("--library-dir", help="PDF folder used as template library (default: database auto templates)")
+    parser.add_argument("--queries-dir", help="PDF folder of queries (default: leave-one-out over the library)")
+    parser.add_argument("--threshold", type=float, default=0.7, help="match threshold used by find_best_match")
+    parser.add_argument("--bands", type=int, default=None, help="LSH bands (default FINGERPRINT_LSH_BANDS)")
+    parser.add_argument("--rows", type=int, default=None, help="rows per band (default FINGERPRINT_LSH_ROWS)")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    args = parser.parse_args()
+
+    library = load_library(args)
+    if not library:
+        print("Template library is empty")
+        sys.exit(1)
+
+    index = FingerprintIndex()
+    index.lsh = LSHTable(bands=args.bands, rows=args.rows)
+    start = time.perf_counter()
+    index.build(library)
+    build_seconds = time.perf_counter() - start
+
+    if args.queries_dir:
+        queries = load_pdf_features(args.queries_dir)
+        leave_one_out = False
+    else:
+        queries = [(c["id"], json.loads(c.get("fingerprint_text") or "{}")) for c in library]
+        leave_one_out = True
+
+    stats, misses = evaluate(index, queries, args.threshold, leave_one_out)
+    n = max(stats["queries"], 1)
+    report = {
+        "templates": len(index),
+        "bands": index.lsh.bands,
+        "rows": index.lsh.rows,
+        "threshold": args.threshold,
+        "build_seconds": round(build_seconds, 3),
+        "queries": stats["queries"],
+        "queries_with_match": stats["with_match"],
+        "recall_at_1": round(stats["top1_hits"] / stats["with_match"], 4) if stats["with_match"] else None,
+        "match_recall": round(stats["pairs_hit"] / stats["pairs"], 4) if stats["pairs"] else None,
+        "mean_candidates_brute": round(stats["brute_candidates"] / n, 2),
+        "mean_candidates_lsh": round(stats["lsh_candidates"] / n, 2),
+        "misses": misses[:50],
+    }
+
+    print(f"Templates: {report['templates']}  (bands={report['bands']}, rows={report['rows']})")
+    print(f"Queries: {report['queries']}  with match >= {args.threshold}: {report['queries_with_match']}")
+    print(f"Recall@1:     {report['recall_at_1']}")
+    print(f"Match recall: {report['match_recall']}")
+    print(f"Candidates per query: brute {report['mean_candidates_brute']}  lsh {report['mean_candidates_lsh']}")
+    for miss in misses[:10]:
+        print(f"  miss {miss['query']}: expected {miss['expected']} ({miss['score']}), lsh best {miss['lsh_best']}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Report written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
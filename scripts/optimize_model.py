@@ -85,9 +85,9 @@ def optimize_model(input_model_path, output_model_path, calibration_images):
     )
     
     # Cleanup temporary files
-    for p in [simplified_path, pre_processed_path]:
-        if p != input_model_path and os.path.exists(p):
-            os.remove(p)
+    # 保留 _sim.onnx 作为 "simplified" 变体，供 scripts/autotune_model.py 评估
+    if pre_processed_path != input_model_path and os.path.exists(pre_processed_path):
+        os.remove(pre_processed_path)
             
     print(f"Optimization finished. Saved to: {output_model_path}")
     